@@ -0,0 +1,212 @@
+import asyncio
+import time
+from typing import Awaitable, Callable
+
+from openai import APITimeoutError, RateLimitError
+
+from log_config import get_logger
+
+log = get_logger(__name__)
+
+
+class CircuitBreaker:
+    """
+    Автоматический выключатель для одной модели.
+
+    После failure_threshold ошибок подряд модель выводится из ротации на reset_timeout
+    секунд. Затем пропускается одна пробная попытка: успех возвращает модель в ротацию,
+    ошибка снова выключает ее.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 60.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+
+    def available(self) -> bool:
+        """
+        Можно ли сейчас начать попытку. Состояние не меняет.
+        """
+        if self.state == self.CLOSED:
+            return True
+        return self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout
+
+    def allow(self) -> bool:
+        """
+        Вызывается, когда попытка действительно начинается.
+        """
+        if not self.available():
+            return False
+        if self.state == self.OPEN:
+            # Время вышло - пропускаем одну пробную попытку, остальные ждут ее результата.
+            self.state = self.HALF_OPEN
+        return True
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+
+    def record_cancelled(self):
+        # Пробная попытка была отменена и ничего не показала - разрешаем новую пробу сразу.
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic() - self.reset_timeout
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+class ModelPool:
+    """
+    Список моделей в порядке приоритета с выключателем и статистикой исходов для каждой.
+    """
+
+    # Возможные исходы запроса к модели.
+    OUTCOMES = ("success", "error", "rate_limited", "timeout", "cancelled")
+
+    def __init__(self, models: list[str], failure_threshold: int = 3, reset_timeout: float = 60.0,
+                 on_record: Callable[[str, str, float], None] | None = None):
+        self.models = models
+        # on_record(model, outcome, latency) вызывается на каждый исход, например для метрик.
+        self.on_record = on_record
+        self.breakers = {model: CircuitBreaker(failure_threshold, reset_timeout) for model in models}
+        self.outcomes = {model: dict.fromkeys(self.OUTCOMES, 0) for model in models}
+        self.latency_sum = dict.fromkeys(models, 0.0)
+        # Сколько раз отправлялся хеджированный запрос и сколько ответов дала не основная модель.
+        self.hedges_started = 0
+        self.fallback_wins = 0
+
+    def candidates(self) -> list[str]:
+        """
+        Модели, которые сейчас можно использовать, в порядке приоритета.
+        Если выключены все, возвращаем полный список: лучше попробовать, чем сразу отказать.
+        Выключатели не переводятся в пробный режим: модель может так и не понадобиться.
+        """
+        allowed = [model for model in self.models if self.breakers[model].available()]
+        return allowed or list(self.models)
+
+    def record(self, model: str, outcome: str, latency: float):
+        self.outcomes[model][outcome] += 1
+        if self.on_record is not None:
+            self.on_record(model, outcome, latency)
+        if outcome == "success":
+            self.latency_sum[model] += latency
+            self.breakers[model].record_success()
+        elif outcome == "cancelled":
+            self.breakers[model].record_cancelled()
+        else:
+            self.breakers[model].record_failure()
+
+    def stats(self) -> dict:
+        return {
+            "models": {
+                model: {
+                    "state": self.breakers[model].state,
+                    **self.outcomes[model],
+                    "avg_latency": (self.latency_sum[model] / self.outcomes[model]["success"]
+                                    if self.outcomes[model]["success"] else None),
+                }
+                for model in self.models
+            },
+            "hedges_started": self.hedges_started,
+            "fallback_wins": self.fallback_wins,
+        }
+
+
+def classify_error(error: BaseException) -> str:
+    if isinstance(error, RateLimitError):
+        return "rate_limited"
+    if isinstance(error, (APITimeoutError, asyncio.TimeoutError)):
+        return "timeout"
+    return "error"
+
+
+async def hedged_call(pool: ModelPool, attempt: Callable[[str], Awaitable],
+                      hedge_delay: float, discard: Callable[[object], Awaitable] | None = None):
+    """
+    Выполняет attempt(model) с хеджированием: если текущая попытка не ответила
+    за hedge_delay секунд, параллельно запускается попытка к следующей модели,
+    а при ошибке следующая модель пробуется сразу. Побеждает первый успешный ответ,
+    остальные попытки отменяются (discard освобождает результат проигравшей попытки,
+    если она успела завершиться). Возвращает (model, result) или пробрасывает последнюю ошибку.
+    """
+    candidates = pool.candidates()
+    running: dict[asyncio.Task, tuple[str, float]] = {}
+    last_error: BaseException | None = None
+
+    def launch(required: bool = False) -> str | None:
+        # Выключатель переходит в пробный режим только здесь, когда попытка действительно начинается.
+        # Модель, пробу которой уже начал другой запрос, пропускаем, но оставляем в списке.
+        # required - попытка нужна, даже если ни одна модель сейчас не разрешена.
+        index = next((i for i, model in enumerate(candidates) if pool.breakers[model].allow()), None)
+        if index is None:
+            if not required or not candidates:
+                return None
+            index = 0
+        model = candidates.pop(index)
+        running[asyncio.create_task(attempt(model))] = (model, time.monotonic())
+        return model
+
+    launch(required=True)
+    try:
+        while running:
+            timeout = hedge_delay if candidates else None
+            done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            if not done:
+                # Никто не ответил вовремя - отправляем хеджированный запрос к следующей модели.
+                slow_model = running[next(iter(running))][0]
+                next_model = launch()
+                if next_model is not None:
+                    pool.hedges_started += 1
+                    log.info("Модель не ответила вовремя, отправляем запрос к следующей",
+                             model=slow_model, hedge_delay=hedge_delay, next_model=next_model)
+                continue
+
+            winner = None
+            for task in done:
+                model, started_at = running.pop(task)
+                latency = time.monotonic() - started_at
+                if task.exception() is None:
+                    if winner is None:
+                        winner = (model, task.result())
+                        pool.record(model, "success", latency)
+                    else:
+                        # Одновременно успели две попытки - лишний результат освобождаем.
+                        pool.record(model, "cancelled", latency)
+                        if discard is not None:
+                            await discard(task.result())
+                else:
+                    last_error = task.exception()
+                    pool.record(model, classify_error(last_error), latency)
+                    log.warning("Ошибка запроса к модели", model=model, error=last_error)
+
+            if winner is not None:
+                if winner[0] != pool.models[0]:
+                    pool.fallback_wins += 1
+                return winner
+
+            # Все завершившиеся попытки упали - сразу пробуем следующую модель, если она есть.
+            if not running:
+                launch(required=True)
+
+        raise last_error if last_error is not None else RuntimeError("Нет доступных моделей")
+    finally:
+        # Отменяем проигравшие попытки. Если какая-то успела завершиться, освобождаем ее результат.
+        if running:
+            for task in running:
+                task.cancel()
+            results = await asyncio.gather(*running, return_exceptions=True)
+            for (model, started_at), result in zip(running.values(), results):
+                pool.record(model, "cancelled", time.monotonic() - started_at)
+                if discard is not None and not isinstance(result, BaseException):
+                    await discard(result)
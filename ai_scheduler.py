@@ -0,0 +1,197 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Hashable
+
+from log_config import get_logger
+
+log = get_logger(__name__)
+
+
+class TokenBucket:
+    """
+    Ведро токенов: пополняется со скоростью rate в секунду до capacity.
+    rate <= 0 означает, что ограничения нет.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float) -> float:
+        """
+        Сколько секунд ждать, пока в ведре появится amount токенов.
+        """
+        if not self.enabled:
+            return 0.0
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount: float):
+        # Может увести баланс в минус: долг задержит следующие запросы.
+        if self.enabled:
+            self._refill()
+            self.tokens -= min(amount, self.capacity)
+
+
+@dataclass(order=True)
+class _Waiter:
+    finish_tag: float
+    seq: int
+    cost: int = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+
+
+class FairScheduler:
+    """
+    Планировщик запросов к модели со взвешенной справедливой очередью (WFQ).
+
+    Каждый поток (пользователь) получает долю пропускной способности пропорционально
+    своему весу: запросу присваивается метка завершения
+    max(виртуальное время, метка предыдущего запроса потока) + cost / weight,
+    и первым допускается запрос с наименьшей меткой. Поэтому пользователь, отправляющий
+    много сообщений, не вытесняет остальных, а поток с весом 4 обслуживается
+    в четыре раза чаще потока с весом 1 при той же нагрузке.
+
+    Допуск ограничен числом одновременных запросов, запросами в секунду и токенами в минуту.
+    Ограничения действуют в пределах одного процесса.
+    """
+
+    def __init__(self, max_concurrency: int, requests_per_second: float = 0.0,
+                 tokens_per_minute: float = 0.0, notify_interval: float = 3.0):
+        self.max_concurrency = max_concurrency
+        self.notify_interval = notify_interval
+        self.requests = TokenBucket(requests_per_second, max(1.0, requests_per_second))
+        self.tokens = TokenBucket(tokens_per_minute / 60, tokens_per_minute)
+
+        self.admitted = 0
+        self.queued = 0
+        self.total_wait = 0.0
+
+        self._heap: list[_Waiter] = []
+        self._seq = itertools.count()
+        self._active = 0
+        self._virtual_time = 0.0
+        self._last_finish: dict[Hashable, float] = {}
+        self._timer: asyncio.TimerHandle | None = None
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        while self._heap:
+            waiter = self._heap[0]
+            if waiter.future.done():
+                # Ожидание отменено - просто убираем его из очереди.
+                heapq.heappop(self._heap)
+                continue
+            if self._active >= self.max_concurrency:
+                return
+            delay = max(self.requests.delay(1), self.tokens.delay(waiter.cost))
+            if delay > 0:
+                # Очередь не обгоняет первый запрос, иначе дорогие запросы никогда не дождутся токенов.
+                self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+
+            heapq.heappop(self._heap)
+            self.requests.take(1)
+            self.tokens.take(waiter.cost)
+            self._active += 1
+            self._virtual_time = waiter.finish_tag
+            waiter.future.set_result(None)
+
+        # Метки потоков, которые уже не опережают виртуальное время, ни на что не влияют.
+        if len(self._last_finish) > 10000:
+            self._last_finish = {flow: tag for flow, tag in self._last_finish.items() if tag > self._virtual_time}
+
+    def _position(self, waiter: _Waiter) -> int:
+        return 1 + sum(1 for other in self._heap if other < waiter and not other.future.done())
+
+    async def acquire(self, flow: Hashable, cost: int, weight: float = 1.0,
+                      on_wait: Callable[[int], Awaitable] | None = None):
+        """
+        Ждет допуска запроса стоимостью cost токенов от потока flow.
+        Пока запрос в очереди, раз в notify_interval секунд вызывает on_wait(позиция в очереди).
+        После допуска нужно обязательно вызвать release().
+        """
+        finish_tag = max(self._virtual_time, self._last_finish.get(flow, 0.0)) + cost / weight
+        self._last_finish[flow] = finish_tag
+        waiter = _Waiter(finish_tag, next(self._seq), cost, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._heap, waiter)
+        self._dispatch()
+
+        if waiter.future.done():
+            self.admitted += 1
+            return
+
+        self.queued += 1
+        started_at = time.monotonic()
+        try:
+            while True:
+                try:
+                    timeout = self.notify_interval if on_wait is not None else None
+                    await asyncio.wait_for(asyncio.shield(waiter.future), timeout=timeout)
+                    break
+                except asyncio.TimeoutError:
+                    try:
+                        await on_wait(self._position(waiter))
+                    except Exception as e:
+                        log.warning("Не удалось уведомить о позиции в очереди", error=e)
+        except BaseException:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Допуск уже выдан, но ожидающий отменен - возвращаем место.
+                self.release()
+            else:
+                waiter.future.cancel()
+                self._dispatch()
+            raise
+        finally:
+            self.total_wait += time.monotonic() - started_at
+        self.admitted += 1
+
+    def release(self):
+        self._active -= 1
+        self._dispatch()
+
+    def charge(self, cost: int):
+        """
+        Учитывает дополнительный запрос к провайдеру (например, хеджированный) без ожидания.
+        """
+        self.requests.take(1)
+        self.tokens.take(cost)
+
+    @asynccontextmanager
+    async def slot(self, flow: Hashable, cost: int, weight: float = 1.0,
+                   on_wait: Callable[[int], Awaitable] | None = None):
+        await self.acquire(flow, cost, weight, on_wait)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> dict:
+        return {
+            "active": self._active,
+            "waiting": sum(1 for waiter in self._heap if not waiter.future.done()),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "avg_queue_wait": self.total_wait / self.queued if self.queued else None,
+        }
@@ -1,6 +1,21 @@
+import asyncio
 import os
-from openai import OpenAI
-from db import get_recent_dialogue
+import time
+from collections import OrderedDict
+from functools import partial
+from typing import AsyncIterator, Awaitable, Callable
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+from ai_fallback import ModelPool, hedged_call
+from ai_scheduler import FairScheduler
+from log_config import get_logger
+from metrics import AI_LATENCY, AI_QUEUE, AI_REQUESTS, register_collector
+from db import (get_recent_context_async, get_dialogue_summary_async, save_dialogue_summary_async,
+                get_unsummarized_dialogue_async, has_successful_payment_async)
+
+log = get_logger(__name__)
 
 AI_PERSONA_CONTEXT = """
 Ты дружелюбный и поддерживающий ИИ-помощник для студентов.
@@ -19,78 +34,479 @@ AI_PERSONA_CONTEXT = """
 
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
 
-DEEPSEEK_BASE_URL = "https://openrouter.ai/api/v1"
+# Адрес OpenAI-совместимого API. Переопределяется, например, для нагрузочных тестов с заглушкой.
+DEEPSEEK_BASE_URL = os.getenv("DEEPSEEK_BASE_URL", "https://openrouter.ai/api/v1")
 
 DEEPSEEK_MODEL = 'deepseek/deepseek-chat-v3-0324:free'
 
-# --- Инициализация клиента DeepSeek API ---
-# Создаем клиент OpenAI, но указываем ему базовый URL DeepSeek.
-deepseek_client = None
-if DEEPSEEK_API_KEY:
+# --- Модели и резервирование ---
+# Модели OpenRouter в порядке приоритета через запятую. Первая - основная, остальные - резервные.
+AI_MODELS = [model.strip() for model in os.getenv("AI_MODELS", DEEPSEEK_MODEL).split(",") if model.strip()]
+# Если модель не начала отвечать за столько секунд, параллельно отправляем запрос к следующей.
+AI_HEDGE_DELAY = float(os.getenv("AI_HEDGE_DELAY", "8"))
+# Сколько ошибок подряд выводят модель из ротации и на сколько секунд.
+AI_BREAKER_FAILURES = int(os.getenv("AI_BREAKER_FAILURES", "3"))
+AI_BREAKER_RESET_TIMEOUT = float(os.getenv("AI_BREAKER_RESET_TIMEOUT", "60"))
+
+# --- Настройки пула соединений и ограничений ---
+# Сколько запросов к модели может выполняться одновременно во всем боте.
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "100"))
+# Размер пула HTTP-соединений и число keep-alive соединений, которые держим открытыми.
+AI_POOL_MAX_CONNECTIONS = int(os.getenv("AI_POOL_MAX_CONNECTIONS", str(AI_MAX_CONCURRENCY)))
+AI_POOL_MAX_KEEPALIVE = int(os.getenv("AI_POOL_MAX_KEEPALIVE", "20"))
+AI_POOL_KEEPALIVE_EXPIRY = float(os.getenv("AI_POOL_KEEPALIVE_EXPIRY", "60"))
+# Таймауты (в секундах): на установку соединения и на весь запрос целиком.
+AI_CONNECT_TIMEOUT = float(os.getenv("AI_CONNECT_TIMEOUT", "10"))
+AI_REQUEST_TIMEOUT = float(os.getenv("AI_REQUEST_TIMEOUT", "60"))
+AI_MAX_RETRIES = int(os.getenv("AI_MAX_RETRIES", "1"))
+
+# --- Планировщик запросов ---
+# Общие лимиты провайдера на процесс: запросы в секунду и токены в минуту (0 - без ограничения).
+AI_REQUESTS_PER_SECOND = float(os.getenv("AI_REQUESTS_PER_SECOND", "0"))
+AI_TOKENS_PER_MINUTE = int(os.getenv("AI_TOKENS_PER_MINUTE", "0"))
+# Вес в очереди: во сколько раз чаще обслуживаются пользователи с оплаченной подпиской, чем на пробном периоде.
+AI_PAID_WEIGHT = float(os.getenv("AI_PAID_WEIGHT", "4"))
+# Вес фонового обновления сводок (все сводки делят одну долю).
+AI_SUMMARY_WEIGHT = 0.5
+# Сколько секунд запрос может ждать в очереди и как часто сообщать пользователю его позицию.
+AI_QUEUE_TIMEOUT = float(os.getenv("AI_QUEUE_TIMEOUT", "120"))
+AI_QUEUE_NOTIFY_INTERVAL = float(os.getenv("AI_QUEUE_NOTIFY_INTERVAL", "3"))
+
+# Параметры генерации.
+AI_TEMPERATURE = 0.7 # Температура генерации (от 0 до 2.0). Выше - креативнее, ниже - точнее.
+AI_MAX_TOKENS = 500 # Максимальное количество токенов в ответе от модели.
+
+# --- Сборка контекста ---
+# Бюджет токенов на весь промпт (системная инструкция, сводка, история и текущее сообщение).
+AI_CONTEXT_TOKEN_BUDGET = int(os.getenv("AI_CONTEXT_TOKEN_BUDGET", "3000"))
+# Сколько последних реплик максимум рассматриваем для дословного включения в промпт.
+AI_CONTEXT_MAX_TURNS = int(os.getenv("AI_CONTEXT_MAX_TURNS", "20"))
+# Сводка обновляется, когда за границей сворачивания накопилось столько старых реплик.
+# Больше окна AI_CONTEXT_MAX_TURNS порция быть не может: иначе реплики успевали бы выйти из окна до сводки.
+SUMMARY_BATCH_SIZE = min(int(os.getenv("SUMMARY_BATCH_SIZE", "10")), AI_CONTEXT_MAX_TURNS)
+# Сколько последних реплик никогда не сворачиваем в сводку. Считается от окна: за границей лежит
+# меньше SUMMARY_BATCH_SIZE несвернутых реплик, и все они еще в окне, поэтому любая реплика старше
+# AI_CONTEXT_MAX_TURNS уже учтена в сводке.
+SUMMARY_KEEP_RECENT = AI_CONTEXT_MAX_TURNS - SUMMARY_BATCH_SIZE + 1
+SUMMARY_MAX_TOKENS = 300
+# Сколько сводок держим в памяти, чтобы не читать их из БД на каждом сообщении.
+SUMMARY_CACHE_SIZE = 10000
+
+SUMMARY_INSTRUCTION = """
+Ты ведешь краткую сводку разговора психологического бота-помощника со студентом.
+Тебе дадут текущую сводку (может быть пустой) и новые сообщения разговора.
+Обнови сводку: сохрани важные факты о пользователе, его переживания, темы и договоренности.
+Пиши кратко, от третьего лица, не более 150 слов, на русском языке. Верни только текст сводки.
+"""
+
+# Очередь запросов к модели: лимиты провайдера и справедливое распределение между пользователями.
+_scheduler = FairScheduler(AI_MAX_CONCURRENCY, requests_per_second=AI_REQUESTS_PER_SECOND,
+                           tokens_per_minute=AI_TOKENS_PER_MINUTE, notify_interval=AI_QUEUE_NOTIFY_INTERVAL)
+
+# Выключатели и статистика исходов запросов по каждой модели.
+_models = ModelPool(AI_MODELS, failure_threshold=AI_BREAKER_FAILURES, reset_timeout=AI_BREAKER_RESET_TIMEOUT,
+                    on_record=lambda model, outcome, latency: AI_REQUESTS.inc(model, outcome))
+
+
+def _collect_queue_metrics():
+    stats = _scheduler.stats()
+    AI_QUEUE.set("active", value=stats["active"])
+    AI_QUEUE.set("waiting", value=stats["waiting"])
+
+register_collector(_collect_queue_metrics)
+
+# --- Клиент DeepSeek API ---
+# Асинхронный клиент OpenAI с общим пулом keep-alive соединений и базовым URL DeepSeek.
+# Создается при первом запросе к модели (get_ai_client), а не при импорте модуля.
+deepseek_client: AsyncOpenAI | None = None
+
+
+def get_ai_client() -> AsyncOpenAI | None:
+    """
+    Возвращает клиент DeepSeek API, создавая его при первом обращении.
+    None - ключ API не задан или клиент не удалось создать.
+    """
+    global deepseek_client
+    if deepseek_client is None and DEEPSEEK_API_KEY:
+        try:
+            deepseek_client = AsyncOpenAI(
+                api_key=DEEPSEEK_API_KEY,
+                base_url=DEEPSEEK_BASE_URL,
+                timeout=httpx.Timeout(AI_REQUEST_TIMEOUT, connect=AI_CONNECT_TIMEOUT),
+                max_retries=AI_MAX_RETRIES,
+                http_client=DefaultAsyncHttpxClient(
+                    limits=httpx.Limits(
+                        max_connections=AI_POOL_MAX_CONNECTIONS,
+                        max_keepalive_connections=AI_POOL_MAX_KEEPALIVE,
+                        keepalive_expiry=AI_POOL_KEEPALIVE_EXPIRY,
+                    ),
+                ),
+            )
+            log.info("DeepSeek API клиент успешно инициализирован")
+        except Exception as e:
+            log.error("Ошибка инициализации DeepSeek API клиента", error=e)
+    return deepseek_client
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Грубая оценка числа токенов: для русского текста около 3 символов на токен
+    плюс служебные токены самого сообщения. Точный токенизатор модели не нужен,
+    важно лишь держать размер промпта предсказуемым.
+    """
+    return len(text) // 3 + 4
+
+
+# Сводки диалогов в памяти: user_id -> текст сводки (None, если сводки нет).
+_summaries: OrderedDict[int, str | None] = OrderedDict()
+# Пользователи, для которых сейчас идет обновление сводки, и сами фоновые задачи.
+_summary_refreshing: set[int] = set()
+_background_tasks: set[asyncio.Task] = set()
+
+
+def _remember_summary(user_id: int, summary: str | None):
+    _summaries[user_id] = summary
+    _summaries.move_to_end(user_id)
+    while len(_summaries) > SUMMARY_CACHE_SIZE:
+        _summaries.popitem(last=False)
+
+
+async def _get_summary(user_id: int) -> str | None:
+    if user_id in _summaries:
+        _summaries.move_to_end(user_id)
+        return _summaries[user_id]
+    stored = await get_dialogue_summary_async(user_id)
+    summary = stored[0] if stored else None
+    _remember_summary(user_id, summary)
+    return summary
+
+
+async def _build_messages(user_id: int, current_message_text: str) -> list[dict]:
+    """
+    Формирует список сообщений для DeepSeek API в пределах AI_CONTEXT_TOKEN_BUDGET:
+    системная инструкция, сводка старой части диалога, столько последних реплик,
+    сколько помещается в бюджет, и текущее сообщение пользователя.
+    """
+    # Реплики уже в формате OpenAI-совместимых чат-комплишенов:
+    # список словарей с 'role' ('user' или 'assistant') и 'content'.
+    # Для активного диалога они берутся из кэша в памяти, без запроса к БД.
+    summary = await _get_summary(user_id)
+    dialogue_history = await get_recent_context_async(user_id, limit=AI_CONTEXT_MAX_TURNS)
+
+    # Хэндлер записывает сообщения пользователя до вызова AI, поэтому они уже последние в истории.
+    # Несколько сообщений подряд приходят сюда одной репликой, склеенной через перевод строки.
+    trailing_user_texts = []
+    for message in reversed(dialogue_history):
+        if message["role"] != "user":
+            break
+        trailing_user_texts.insert(0, message["content"])
+        if "\n".join(trailing_user_texts) == current_message_text:
+            dialogue_history = dialogue_history[:-len(trailing_user_texts)]
+            break
+
+    # Первое сообщение всегда должно быть системной инструкцией, за ней - сводка, если она есть.
+    messages = [{"role": "system", "content": AI_PERSONA_CONTEXT}]
+    if summary:
+        messages.append({"role": "system", "content": f"Краткое содержание предыдущей части разговора: {summary}"})
+    current_message = {"role": "user", "content": current_message_text}
+
+    # Заполняем бюджет репликами от самых новых к более старым.
+    used_tokens = sum(estimate_tokens(message["content"]) for message in (*messages, current_message))
+    selected = []
+    for message in reversed(dialogue_history):
+        cost = estimate_tokens(message["content"])
+        if used_tokens + cost > AI_CONTEXT_TOKEN_BUDGET:
+            break
+        selected.append(message)
+        used_tokens += cost
+    selected.reverse()
+
+    # Добавляем историю и текущее сообщение пользователя как последнее сообщение в диалоге.
+    messages.extend(selected)
+    messages.append(current_message)
+
+    log.debug("Отправляем сообщение в DeepSeek", user_id=user_id, history_turns=len(selected),
+              has_summary=bool(summary), tokens=used_tokens)
+    return messages
+
+
+async def _summarize(previous_summary: str, rows: list[tuple]) -> str | None:
+    # Сворачивает новые реплики в сводку отдельным коротким запросом к модели.
+    lines = [f"{'Пользователь' if sender == 'user' else 'Бот'}: {text}" for _, text, sender in rows]
+    prompt = f"Текущая сводка: {previous_summary or '(пусто)'}\n\nНовые сообщения:\n" + "\n".join(lines)
+    _, response = await _create_completion(
+        [{"role": "system", "content": SUMMARY_INSTRUCTION}, {"role": "user", "content": prompt}],
+        temperature=0.3,
+        max_tokens=SUMMARY_MAX_TOKENS,
+        flow="summary",
+        weight=AI_SUMMARY_WEIGHT,
+    )
+    if response.choices and response.choices[0].message and response.choices[0].message.content:
+        return response.choices[0].message.content.strip()
+    return None
+
+
+async def _refresh_summary(user_id: int):
     try:
-        deepseek_client = OpenAI(
-            api_key=DEEPSEEK_API_KEY,
-            base_url=DEEPSEEK_BASE_URL
-        )
-        print("DeepSeek API клиент успешно инициализирован.")
+        stored = await get_dialogue_summary_async(user_id)
+        previous_summary, last_dialogue_id = stored if stored else ("", 0)
+        # Сворачиваем только целыми порциями, чтобы не тратить запросы к модели на каждую реплику.
+        # Если прошлые обновления не удались, догоняем все накопившиеся порции сразу.
+        while True:
+            rows = await get_unsummarized_dialogue_async(user_id, last_dialogue_id, SUMMARY_KEEP_RECENT,
+                                                         SUMMARY_BATCH_SIZE)
+            if len(rows) < SUMMARY_BATCH_SIZE:
+                return
+            new_summary = await _summarize(previous_summary, rows)
+            if not new_summary:
+                return
+            last_dialogue_id = rows[-1][0]
+            await save_dialogue_summary_async(user_id, new_summary, last_dialogue_id)
+            _remember_summary(user_id, new_summary)
+            previous_summary = new_summary
+            log.debug("Сводка диалога обновлена", user_id=user_id, folded_turns=len(rows))
     except Exception as e:
-        print(f"Ошибка инициализации DeepSeek API клиента: {e}")
-        deepseek_client = None # Убедимся, что клиент None в случае ошибки
+        log.warning("Ошибка при обновлении сводки диалога", user_id=user_id, error=e)
+    finally:
+        _summary_refreshing.discard(user_id)
 
 
-async def get_ai_response(user_id: int, current_message_text: str) -> str | None:
+def schedule_summary_refresh(user_id: int):
     """
-    Отправляет сообщение пользователя и историю диалога в DeepSeek API
-    и возвращает ответ нейросети.
+    Запускает в фоне обновление сводки диалога пользователя, если накопилось достаточно
+    старых реплик. Не задерживает ответ пользователю.
     """
-    # Проверяем, инициализирован ли клиент DeepSeek.
-    if deepseek_client is None:
-        print("AI Service Error: DeepSeek API клиент не инициализирован (возможно, нет API ключа).")
-        return "Произошла ошибка конфигурации AI сервиса (нет API ключа DeepSeek)."
+    if get_ai_client() is None or user_id in _summary_refreshing:
+        return
+    _summary_refreshing.add(user_id)
+    task = asyncio.create_task(_refresh_summary(user_id))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+def _request_cost(messages: list[dict], max_tokens: int) -> int:
+    # Оценка токенов, которые запрос израсходует из лимита: промпт и максимальный ответ.
+    return sum(estimate_tokens(message["content"]) for message in messages) + max_tokens
+
+
+async def _user_weight(user_id: int) -> float:
+    return AI_PAID_WEIGHT if await has_successful_payment_async(user_id) else 1.0
 
-    try:
-        # Получаем последние 10 сообщений диалога из БД
-        dialogue_history = get_recent_dialogue(user_id, limit=5)
 
-        # Формируем список сообщений для DeepSeek API в формате OpenAI-совместимых чат-комплишенов.
-        # Этот формат требует список словарей, каждый из которых имеет 'role' и 'content'.
-        # Роли: 'system', 'user', 'assistant'.
+async def _admit(flow, cost: int, weight: float, on_queue: Callable[[int], Awaitable] | None):
+    # Ждет своей очереди в планировщике не дольше AI_QUEUE_TIMEOUT (иначе TimeoutError).
+    with AI_LATENCY.time("queue"):
+        async with asyncio.timeout(AI_QUEUE_TIMEOUT):
+            await _scheduler.acquire(flow, cost, weight, on_queue)
 
-        # Первое сообщение всегда должно быть системной инструкцией.
-        messages = [{"role": "system", "content": AI_PERSONA_CONTEXT}]
 
-        # Добавляем историю диалога.
-        # 'user' из нашей БД соответствует 'user' для API.
-        # 'bot' из нашей БД соответствует 'assistant' для API.
-        for msg_text, timestamp, sender in dialogue_history:
-            role = 'user' if sender == 'user' else 'assistant'
-            messages.append({"role": role, "content": msg_text})
+def _charged(attempt: Callable[[str], Awaitable], cost: int) -> Callable[[str], Awaitable]:
+    # Первая попытка учтена планировщиком при допуске, хеджированные и резервные учитываем отдельно.
+    attempts = 0
 
-        # Добавляем текущее сообщение пользователя как последнее сообщение в диалоге.
-        messages.append({"role": "user", "content": current_message_text})
+    async def charged_attempt(model: str):
+        nonlocal attempts
+        attempts += 1
+        if attempts > 1:
+            _scheduler.charge(cost)
+        return await attempt(model)
 
-        print(f"Отправляем сообщение в DeepSeek для пользователя {user_id} (длина истории: {len(dialogue_history)}).")
-        # print(f"Сообщения для API: {messages}") # Можно включить для детальной отладки
+    return charged_attempt
 
-        # Выполняем запрос к API DeepSeek.
-        response = deepseek_client.chat.completions.create(
-            model=DEEPSEEK_MODEL,
+
+async def _create_completion(messages: list[dict], temperature: float, max_tokens: int, flow, weight: float,
+                             on_queue: Callable[[int], Awaitable] | None = None):
+    """
+    Обычный (непотоковый) запрос с резервированием моделей.
+    Запрос ждет допуска планировщика, wait_for ограничивает время самого запроса.
+    Возвращает (model, response).
+    """
+    async def attempt(model: str):
+        return await get_ai_client().chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+        )
+
+    cost = _request_cost(messages, max_tokens)
+    await _admit(flow, cost, weight, on_queue)
+    try:
+        with AI_LATENCY.time("completion"):
+            return await asyncio.wait_for(hedged_call(_models, _charged(attempt, cost), AI_HEDGE_DELAY),
+                                          timeout=AI_REQUEST_TIMEOUT)
+    finally:
+        _scheduler.release()
+
+
+def _delta_text(chunk) -> str | None:
+    if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
+        return chunk.choices[0].delta.content
+    return None
+
+
+async def _open_stream(messages: list[dict], model: str):
+    """
+    Открывает потоковый запрос к модели и ждет первый непустой фрагмент ответа.
+    Поток нужно закрыть через _close_stream.
+    Возвращает (stream, iterator, first_text).
+    """
+    stream = None
+    try:
+        stream = await get_ai_client().chat.completions.create(
+            model=model,
             messages=messages,
-            temperature=0.7, # Температура генерации (от 0 до 2.0). Выше - креативнее, ниже - точнее.
-            max_tokens=500,  # Максимальное количество токенов в ответе от модели.
+            temperature=AI_TEMPERATURE,
+            max_tokens=AI_MAX_TOKENS,
+            stream=True,
         )
-        print(f"Получен ответ от DeepSeek для пользователя {user_id}.")
+        iterator = aiter(stream)
+        async for chunk in iterator:
+            text = _delta_text(chunk)
+            if text:
+                return stream, iterator, text
+        raise RuntimeError(f"Модель {model} вернула пустой ответ")
+    except BaseException:
+        if stream is not None:
+            await stream.close()
+        raise
+
+
+async def _close_stream(opened: tuple):
+    stream, iterator, first_text = opened
+    await stream.close()
+
+
+def get_model_stats() -> dict:
+    """
+    Возвращает состояние выключателей и счетчики исходов запросов по моделям.
+    """
+    return _models.stats()
+
+
+def get_scheduler_stats() -> dict:
+    """
+    Возвращает состояние очереди запросов к модели: активные, ожидающие и среднее ожидание.
+    """
+    return _scheduler.stats()
+
+
+async def get_ai_response(user_id: int, current_message_text: str,
+                          on_queue: Callable[[int], Awaitable] | None = None) -> str | None:
+    """
+    Отправляет сообщение пользователя и историю диалога в DeepSeek API
+    и возвращает ответ нейросети.
+    Если запрос ждет в очереди, периодически вызывается on_queue(позиция в очереди).
+    """
+    # Проверяем, инициализирован ли клиент DeepSeek.
+    if get_ai_client() is None:
+        log.error("DeepSeek API клиент не инициализирован (возможно, нет API ключа)")
+        return "Произошла ошибка конфигурации AI сервиса (нет API ключа DeepSeek)."
+
+    try:
+        messages = await _build_messages(user_id, current_message_text)
+
+        # Выполняем запрос к API, не блокируя цикл событий. При медленном ответе или ошибке
+        # основной модели запрос дублируется к резервной.
+        model, response = await _create_completion(messages, temperature=AI_TEMPERATURE, max_tokens=AI_MAX_TOKENS,
+                                                   flow=user_id, weight=await _user_weight(user_id),
+                                                   on_queue=on_queue)
+        log.debug("Получен ответ от модели", model=model, user_id=user_id)
 
         ai_response_text = None
         # Извлекаем текст ответа из структуры ответа DeepSeek (OpenAI-совместимой).
         if response.choices and response.choices[0].message and response.choices[0].message.content:
             ai_response_text = response.choices[0].message.content.strip()
         else:
-            print(f"Ответ DeepSeek не содержал текстового контента: {response}")
+            log.warning("Ответ DeepSeek не содержал текстового контента", model=model, user_id=user_id)
             return "Не удалось получить текстовый ответ от нейросети. Пожалуйста, попробуйте еще раз."
 
         return ai_response_text
 
+    except asyncio.TimeoutError:
+        log.warning("Таймаут запроса к DeepSeek API", user_id=user_id, timeout=AI_REQUEST_TIMEOUT)
+        return None
+    except Exception as e:
+        log.error("Ошибка при вызове DeepSeek API", user_id=user_id, error=e)
+        return None
+
+
+class AIStreamError(Exception):
+    """
+    Поток ответа прервался после того, как часть текста уже была отдана.
+    Полученный текст неполный: его нельзя считать ответом модели.
+    """
+
+
+async def stream_ai_response(user_id: int, current_message_text: str,
+                             on_queue: Callable[[int], Awaitable] | None = None) -> AsyncIterator[str]:
+    """
+    Потоковый режим get_ai_response: отдает ответ нейросети по частям (дельтам)
+    по мере генерации. Если модель не начала отвечать, поток просто завершается, поэтому
+    вызывающий код должен сам проверить, что получил непустой текст. Если поток оборвался
+    на середине ответа, выбрасывается AIStreamError.
+    Место в планировщике освобождается при закрытии генератора - используйте contextlib.aclosing.
+    """
+    if get_ai_client() is None:
+        log.error("DeepSeek API клиент не инициализирован (возможно, нет API ключа)")
+        yield "Произошла ошибка конфигурации AI сервиса (нет API ключа DeepSeek)."
+        return
+
+    streaming = False
+    try:
+        messages = await _build_messages(user_id, current_message_text)
+        cost = _request_cost(messages, AI_MAX_TOKENS)
+        await _admit(user_id, cost, await _user_weight(user_id), on_queue)
+
+        # Место в планировщике занято, пока поток не закрыт. Общий срок распространяется
+        # на весь поток, но проверяется только в ожиданиях самого генератора: отмена по таймауту,
+        # пришедшая во время yield, досталась бы задаче, которая читает поток.
+        # Хеджирование идет до первого токена: побеждает модель, которая первой начала отвечать.
+        started_at = time.perf_counter()
+        deadline = asyncio.get_running_loop().time() + AI_REQUEST_TIMEOUT
+        try:
+            async with asyncio.timeout_at(deadline):
+                model, opened = await hedged_call(_models, _charged(partial(_open_stream, messages), cost),
+                                                  AI_HEDGE_DELAY, discard=_close_stream)
+            AI_LATENCY.observe(time.perf_counter() - started_at, "first_token")
+            stream, iterator, first_text = opened
+            try:
+                streaming = True
+                yield first_text
+                while True:
+                    async with asyncio.timeout_at(deadline):
+                        chunk = await anext(iterator, None)
+                    if chunk is None:
+                        break
+                    text = _delta_text(chunk)
+                    if text:
+                        yield text
+            finally:
+                await _close_stream(opened)
+            AI_LATENCY.observe(time.perf_counter() - started_at, "stream")
+        finally:
+            _scheduler.release()
+        log.debug("Получен потоковый ответ от модели", model=model, user_id=user_id)
+
+    except TimeoutError:
+        log.warning("Таймаут потокового запроса к DeepSeek API", user_id=user_id, timeout=AI_REQUEST_TIMEOUT)
+        if streaming:
+            raise AIStreamError("Таймаут потокового ответа") from None
     except Exception as e:
-        print(f"Ошибка при вызове DeepSeek API для пользователя {user_id}: {e}")
-        return None
\ No newline at end of file
+        log.error("Ошибка при потоковом вызове DeepSeek API", user_id=user_id, error=e)
+        if streaming:
+            raise AIStreamError("Поток ответа прервался") from e
+
+
+async def close_ai_client():
+    """
+    Закрывает пул HTTP-соединений клиента DeepSeek. Вызывается при остановке бота.
+    """
+    global deepseek_client
+    for task in list(_background_tasks):
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    if deepseek_client is not None:
+        await deepseek_client.close()
+        deepseek_client = None
+        log.info("DeepSeek API клиент закрыт")
@@ -0,0 +1,347 @@
+"""
+Микробенчмарки слоя доступа к данным (db.py).
+
+Заполняет отдельную базу SQLite синтетическими пользователями, сообщениями и платежами,
+затем измеряет пропускную способность и задержки (p50/p99) основных функций db.py
+в нескольких конфигурациях: режим журнала, наличие индексов, пул соединений.
+Результат печатается в формате JSON, чтобы сравнивать версии между собой.
+
+Примеры:
+    python -m benchmarks.db_bench --rows 10000
+    python -m benchmarks.db_bench --rows 1000000 --configs wal,delete --output bench.json
+    python -m benchmarks.db_bench --rows 10000 --baseline bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import db
+from database.migrations import apply_migrations
+from database.pool import ConnectionPool
+from database.user_cache import UserCache
+from log_config import setup_logging
+
+# Конфигурации для сравнения: режим журнала, synchronous, индексы и пул соединений.
+CONFIGS = {
+    "wal": {"journal_mode": "WAL", "synchronous": "NORMAL", "indexes": True, "pooled": True},
+    "wal-full": {"journal_mode": "WAL", "synchronous": "FULL", "indexes": True, "pooled": True},
+    "delete": {"journal_mode": "DELETE", "synchronous": "FULL", "indexes": True, "pooled": True},
+    "wal-noindex": {"journal_mode": "WAL", "synchronous": "NORMAL", "indexes": False, "pooled": True},
+    "wal-unpooled": {"journal_mode": "WAL", "synchronous": "NORMAL", "indexes": True, "pooled": False},
+}
+
+OPERATIONS = ("add_user", "get_user", "get_recent_dialogue", "add_dialogue_message",
+              "is_subscription_expired", "extend_subscription")
+
+# Индексы, которые удаляются в конфигурациях без индексов.
+INDEXES = ("idx_dialogues_user_id_id", "idx_payments_telegram_charge_id", "idx_payments_user_id")
+
+SAMPLE_TEXTS = (
+    "Привет, мне сложно сосредоточиться на учебе.",
+    "Сессия через неделю, а я ничего не успеваю.",
+    "Понимаю, это действительно непросто. Расскажи, что сейчас тревожит больше всего?",
+    "Спасибо, стало немного легче.",
+    "Не могу найти общий язык с научным руководителем.",
+    "Возможно, стоит разбить подготовку на небольшие шаги?",
+)
+
+SEED_BATCH = 50_000
+# Первый id пользователей, которых добавляет бенчмарк add_user (после синтетических).
+NEW_USER_ID_OFFSET = 10 ** 12
+
+
+class _PerCallPool(ConnectionPool):
+    """
+    "Пул" без переиспользования: новое соединение на каждый вызов connection(),
+    как было до появления ConnectionPool.
+    """
+
+    def connection(self) -> sqlite3.Connection:
+        previous = getattr(self._local, "conn", None)
+        if previous is not None:
+            previous.close()
+            with self._lock:
+                self._connections.remove(previous)
+        conn = self._open()
+        self._local.conn = conn
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+
+def seed_database(path: str, rows: int, seed: int) -> dict:
+    """
+    Создает схему и заполняет базу: rows сообщений, пользователей в 100 раз меньше,
+    платежей - у каждого десятого пользователя. Возвращает размеры таблиц.
+    """
+    rng = random.Random(seed)
+    users = max(1, rows // 100)
+    payments = max(1, users // 10)
+    now = datetime.now()
+
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    apply_migrations(conn)
+
+    def user_rows():
+        for user_id in range(1, users + 1):
+            joined = now - timedelta(days=rng.randint(0, 365))
+            expiry = now + timedelta(days=rng.randint(-30, 30))
+            yield user_id, f"User {user_id}", f"user{user_id}", joined.isoformat(), expiry.isoformat()
+
+    def dialogue_rows():
+        started = now - timedelta(days=365)
+        for row_id in range(rows):
+            moment = started + timedelta(seconds=row_id * 31_536_000 // rows)
+            # Сообщения пользователей перемешаны, как в реальной таблице.
+            yield (row_id % users + 1, rng.choice(SAMPLE_TEXTS), moment.isoformat(), int(moment.timestamp()),
+                   "user" if row_id % 2 == 0 else "bot")
+
+    def payment_rows():
+        for payment_id in range(payments):
+            moment = now - timedelta(days=rng.randint(0, 365))
+            yield (payment_id * 10 % users + 1, 18900, "RUB", moment.isoformat(), int(moment.timestamp()),
+                   "successful", f"tg_{payment_id}", f"pr_{payment_id}", f"sub_{payment_id}")
+
+    for sql, generator in (
+        ("INSERT INTO users (id, full_name, username, join_date, subscription_expiry_date) VALUES (?, ?, ?, ?, ?)",
+         user_rows()),
+        ("INSERT INTO dialogues (user_id, message_text, timestamp, ts, sender) VALUES (?, ?, ?, ?, ?)",
+         dialogue_rows()),
+        ("INSERT INTO payments (user_id, amount, currency, timestamp, ts, status, telegram_charge_id, "
+         "provider_charge_id, invoice_payload) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+         payment_rows()),
+    ):
+        while True:
+            batch = [row for _, row in zip(range(SEED_BATCH), generator)]
+            if not batch:
+                break
+            conn.executemany(sql, batch)
+            conn.commit()
+
+    conn.execute("ANALYZE")
+    conn.commit()
+    conn.close()
+    return {"users": users, "dialogues": rows, "payments": payments}
+
+
+def _use_pool(pool: ConnectionPool, user_cache: bool):
+    # Все функции db.py берут соединения из db._pool - подменяем его на пул бенчмарка.
+    db._pool = pool
+    db._dialogue_buffer.pool = pool
+    db._user_cache = UserCache(max_size=db.USER_CACHE_SIZE if user_cache else 0, ttl=db.USER_CACHE_TTL)
+
+
+def _summarize(operation: str, latencies: list[float], elapsed: float) -> dict:
+    latencies.sort()
+    count = len(latencies)
+    return {
+        "operation": operation,
+        "ops": count,
+        "throughput_ops_s": round(count / elapsed, 1) if elapsed else None,
+        "mean_ms": round(sum(latencies) / count * 1000, 4),
+        "p50_ms": round(latencies[int(0.50 * (count - 1))] * 1000, 4),
+        "p99_ms": round(latencies[int(0.99 * (count - 1))] * 1000, 4),
+        "max_ms": round(latencies[-1] * 1000, 4),
+    }
+
+
+def _operation_calls(operation: str, users: int, rng: random.Random, counter):
+    # Возвращает (синхронная функция, асинхронная функция, аргументы) для одного вызова операции.
+    user_id = rng.randint(1, users)
+    if operation == "add_user":
+        new_id = NEW_USER_ID_OFFSET + next(counter)
+        return db.add_user, db.add_user_async, (new_id, f"Bench {new_id}", None)
+    if operation == "get_user":
+        return db.get_user, db.get_user_async, (user_id,)
+    if operation == "get_recent_dialogue":
+        return db.get_recent_dialogue, db.get_recent_dialogue_async, (user_id, 20)
+    if operation == "add_dialogue_message":
+        return db.add_dialogue_message, db.add_dialogue_message_async, (user_id, rng.choice(SAMPLE_TEXTS), "user")
+    if operation == "is_subscription_expired":
+        return db.is_subscription_expired, db.is_subscription_expired_async, (user_id,)
+    if operation == "extend_subscription":
+        return db.extend_subscription, db.extend_subscription_async, (user_id, 30)
+    raise ValueError(f"Неизвестная операция: {operation}")
+
+
+def run_sync(operation: str, ops: int, users: int, rng: random.Random, counter) -> dict:
+    latencies = []
+    started_at = time.perf_counter()
+    for _ in range(ops):
+        func, _, args = _operation_calls(operation, users, rng, counter)
+        call_started = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - call_started)
+    return _summarize(operation, latencies, time.perf_counter() - started_at)
+
+
+async def run_concurrent(operation: str, ops: int, users: int, rng: random.Random, counter,
+                         concurrency: int) -> dict:
+    # Асинхронные версии функций через пул потоков, как их вызывают хэндлеры бота.
+    latencies = []
+    calls = [_operation_calls(operation, users, rng, counter) for _ in range(ops)]
+    position = iter(range(ops))
+
+    async def worker():
+        for index in position:
+            _, func, args = calls[index]
+            call_started = time.perf_counter()
+            await func(*args)
+            latencies.append(time.perf_counter() - call_started)
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return _summarize(operation, latencies, time.perf_counter() - started_at)
+
+
+def bench_config(name: str, args, data_dir: str) -> dict:
+    config = CONFIGS[name]
+    path = os.path.join(data_dir, f"bench_{name}.db")
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    seed_started = time.perf_counter()
+    sizes = seed_database(path, args.rows, args.seed)
+    seed_seconds = time.perf_counter() - seed_started
+    if not config["indexes"]:
+        conn = sqlite3.connect(path)
+        for index in INDEXES:
+            conn.execute(f"DROP INDEX IF EXISTS {index}")
+        conn.commit()
+        conn.close()
+
+    pool_class = ConnectionPool if config["pooled"] else _PerCallPool
+    pool = pool_class(path, size=args.pool_size, journal_mode=config["journal_mode"],
+                      synchronous=config["synchronous"])
+    _use_pool(pool, args.user_cache)
+
+    rng = random.Random(args.seed)
+    counter = iter(range(10 ** 9))
+    results = []
+    try:
+        for operation in args.operations:
+            # Прогрев: кэш страниц SQLite и подготовленных выражений.
+            run_sync(operation, min(100, args.ops), sizes["users"], rng, counter)
+            if args.concurrency > 1:
+                result = asyncio.run(run_concurrent(operation, args.ops, sizes["users"], rng, counter,
+                                                    args.concurrency))
+            else:
+                result = run_sync(operation, args.ops, sizes["users"], rng, counter)
+            results.append({"config": name, **result})
+            print(f"{name:>14} {operation:<24} {result['throughput_ops_s']:>10} ops/s "
+                  f"p50 {result['p50_ms']:.3f} ms  p99 {result['p99_ms']:.3f} ms", file=sys.stderr)
+    finally:
+        pool.close()
+        if not args.keep:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+    return {"config": name, **config, "seed_seconds": round(seed_seconds, 2), "sizes": sizes, "results": results}
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_with_baseline(report: dict, baseline: dict, threshold: float) -> list[str]:
+    """
+    Сравнивает p50 с предыдущим отчетом. Возвращает описания замедлений больше threshold (0.2 = 20%).
+    """
+    previous = {(result["config"], result["operation"]): result
+                for config in baseline["configs"] for result in config["results"]}
+    regressions = []
+    for config in report["configs"]:
+        for result in config["results"]:
+            old = previous.get((result["config"], result["operation"]))
+            if old and old["p50_ms"] and result["p50_ms"] > old["p50_ms"] * (1 + threshold):
+                regressions.append(f"{result['config']}/{result['operation']}: "
+                                   f"p50 {old['p50_ms']} -> {result['p50_ms']} ms")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Микробенчмарки слоя доступа к данным db.py")
+    parser.add_argument("--rows", type=int, default=10_000,
+                        help="сколько сообщений в dialogues (пользователей в 100 раз меньше), от 10k до 10M")
+    parser.add_argument("--ops", type=int, default=2000, help="вызовов каждой операции")
+    parser.add_argument("--configs", default="wal,delete,wal-noindex,wal-unpooled",
+                        help=f"конфигурации через запятую: {', '.join(CONFIGS)}")
+    parser.add_argument("--operations", default=",".join(OPERATIONS), help="операции через запятую")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="параллельных вызовов асинхронных версий (1 - синхронные вызовы подряд)")
+    parser.add_argument("--pool-size", type=int, default=db.DB_POOL_SIZE)
+    parser.add_argument("--user-cache", action="store_true", help="не выключать кэш пользователей")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--data-dir", default=None, help="каталог для баз (по умолчанию временный)")
+    parser.add_argument("--keep", action="store_true", help="не удалять базы после прогона")
+    parser.add_argument("--output", default=None, help="файл для JSON-отчета (по умолчанию stdout)")
+    parser.add_argument("--baseline", default=None, help="JSON-отчет предыдущей версии для сравнения")
+    parser.add_argument("--threshold", type=float, default=0.2, help="допустимое замедление p50 (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+    args.configs = [name.strip() for name in args.configs.split(",") if name.strip()]
+    args.operations = [name.strip() for name in args.operations.split(",") if name.strip()]
+    unknown = [name for name in args.configs if name not in CONFIGS] + \
+              [name for name in args.operations if name not in OPERATIONS]
+    if unknown:
+        parser.error(f"неизвестные конфигурации или операции: {', '.join(unknown)}")
+    return args
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    setup_logging("WARNING")
+
+    with tempfile.TemporaryDirectory(prefix="psysup_bench_") as temp_dir:
+        data_dir = args.data_dir or temp_dir
+        os.makedirs(data_dir, exist_ok=True)
+        report = {
+            "benchmark": "db",
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "parameters": {"rows": args.rows, "ops": args.ops, "concurrency": args.concurrency,
+                           "pool_size": args.pool_size, "user_cache": args.user_cache, "seed": args.seed},
+            "configs": [bench_config(name, args, data_dir) for name in args.configs],
+        }
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)
+        if baseline.get("parameters") != report["parameters"]:
+            print("Параметры прогона отличаются от базового отчета, сравнение может быть неточным",
+                  file=sys.stderr)
+        regressions = compare_with_baseline(report, baseline, args.threshold)
+        for line in regressions:
+            print(f"Замедление: {line}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
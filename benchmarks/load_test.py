@@ -0,0 +1,374 @@
+"""
+Сквозной нагрузочный тест бота без сети.
+
+Синтетические обновления Telegram подаются в настоящий Dispatcher со всеми роутерами
+из main.py. Запросы к Bot API обрабатывает FakeTelegramSession внутри процесса,
+запросы к модели уходят в заглушку OpenAI-совместимого API (benchmarks.stub_openai),
+запущенную в отдельном процессе, чтобы не делить с ботом цикл событий.
+
+Каждый виртуальный пользователь регистрируется через /start, затем отправляет сообщение,
+ждет полного ответа, делает паузу и повторяет до конца теста. В отчете (JSON):
+устойчивая пропускная способность (ответов в секунду после разгона), перцентили задержки
+от отправки сообщения до полного ответа и задержки цикла событий.
+
+Примеры:
+    python -m benchmarks.load_test --users 200 --duration 60
+    python -m benchmarks.load_test --users 500 --rate-limit-rate 0.05 --error-rate 0.02 --output load.json
+    python -m benchmarks.load_test --users 200 --duration 60 --baseline load.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import get_args
+
+import aiohttp
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Message
+
+from benchmarks.stub_openai import REPLY_PREFIX, REPLY_SUFFIX, add_stub_arguments, stub_command, stub_options_from_args
+
+# Токен должен быть в формате Bot API, но никуда не отправляется.
+BOT_TOKEN = "123456789:load-test-token"
+# id виртуальных пользователей: LOAD_USER_ID_OFFSET + номер.
+LOAD_USER_ID_OFFSET = 7_000_000_000
+
+USER_MESSAGES = (
+    "Привет, мне сложно сосредоточиться на учебе.",
+    "Сессия через неделю, а я ничего не успеваю.",
+    "Спасибо, стало немного легче.",
+    "Не могу найти общий язык с научным руководителем.",
+    "Кажется, я выгораю и ничего не хочу.",
+)
+
+
+class FakeTelegramSession(BaseSession):
+    """
+    Сессия Bot API без сети: отвечает на каждый метод успешным ответом через задержку latency.
+    Ответ проходит ту же проверку и разбор, что и настоящий ответ Telegram.
+    on_text(chat_id, text) вызывается для каждого отправленного или отредактированного сообщения.
+    """
+
+    def __init__(self, on_text, latency: float = 0.0):
+        super().__init__()
+        self.on_text = on_text
+        self.latency = latency
+        self.requests = Counter()
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot, method, timeout=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.requests[type(method).__name__] += 1
+
+        returning = method.__returning__
+        result = True
+        if returning is Message or Message in get_args(returning):
+            chat_id = getattr(method, "chat_id", None)
+            text = getattr(method, "text", None)
+            result = {"message_id": getattr(method, "message_id", None) or next(self._message_ids),
+                      "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}}
+            if text is not None:
+                result["text"] = text
+                self.on_text(chat_id, text)
+        response = self.check_response(bot, method, 200, json.dumps({"ok": True, "result": result}))
+        return response.result
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        # Бот в нагрузочном тесте не скачивает файлы - отдаем пустое содержимое.
+        return
+        yield
+
+    async def close(self):
+        pass
+
+
+def _percentiles(values: list[float]) -> dict:
+    # Значения в секундах, в отчете - миллисекунды.
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    count = len(values)
+    return {
+        "count": count,
+        "mean_ms": round(sum(values) / count * 1000, 2),
+        "p50_ms": round(values[int(0.50 * (count - 1))] * 1000, 2),
+        "p90_ms": round(values[int(0.90 * (count - 1))] * 1000, 2),
+        "p99_ms": round(values[int(0.99 * (count - 1))] * 1000, 2),
+        "max_ms": round(values[-1] * 1000, 2),
+    }
+
+
+class LoadTest:
+    def __init__(self, args, dispatcher, bot_factory, ignored_texts: tuple[str, ...]):
+        self.args = args
+        self.dispatcher = dispatcher
+        # Промежуточные сообщения бота (заглушка "Печатаю...", позиция в очереди) ответом не считаются.
+        self.ignored_texts = ignored_texts
+        self.session = FakeTelegramSession(self._on_text, latency=args.telegram_latency)
+        self.bot = bot_factory(self.session)
+        self.rng = random.Random(args.seed)
+
+        # chat_id -> (future ответа, засчитывать ли любой текст как ответ).
+        self._pending: dict[int, tuple[asyncio.Future, bool]] = {}
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+        self.sent = 0
+        self.outcomes = Counter()
+        self.latencies: list[float] = []
+        self.loop_lag: list[float] = []
+        self.measure_from = 0.0
+
+    def _on_text(self, chat_id: int, text: str):
+        pending = self._pending.get(chat_id)
+        if pending is None or pending[0].done():
+            return
+        future, any_text = pending
+        if any_text:
+            future.set_result("ok")
+        elif text.startswith(REPLY_PREFIX):
+            # Ответ модели показывается частями, полный ответ заканчивается REPLY_SUFFIX.
+            if text.endswith(REPLY_SUFFIX):
+                future.set_result("ok")
+        elif not text.startswith(self.ignored_texts):
+            # Сообщение об ошибке, предложение оплатить подписку и т.п.
+            future.set_result("failed")
+
+    def _update(self, user_id: int, text: str) -> dict:
+        return {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "Load", "last_name": str(user_id)},
+                "text": text,
+            },
+        }
+
+    async def exchange(self, user_id: int, text: str, any_text: bool = False) -> str:
+        """
+        Отправляет сообщение от пользователя и ждет ответа бота. Возвращает исход: ok, failed, timeout.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending[user_id] = (future, any_text)
+        try:
+            await self.dispatcher.feed_raw_update(self.bot, self._update(user_id, text))
+            return await asyncio.wait_for(future, self.args.reply_timeout)
+        except asyncio.TimeoutError:
+            return "timeout"
+        except Exception:
+            return "failed"
+        finally:
+            self._pending.pop(user_id, None)
+
+    async def virtual_user(self, user_id: int, start_delay: float, deadline: float):
+        await asyncio.sleep(start_delay)
+        await self.exchange(user_id, "/start", any_text=True)
+        while time.monotonic() < deadline:
+            sent_at = time.monotonic()
+            self.sent += 1
+            outcome = await self.exchange(user_id, self.rng.choice(USER_MESSAGES))
+            # В статистику попадают только сообщения, отправленные после разгона.
+            if sent_at >= self.measure_from:
+                self.outcomes[outcome] += 1
+                if outcome == "ok":
+                    self.latencies.append(time.monotonic() - sent_at)
+            if self.args.think_time:
+                await asyncio.sleep(self.rng.expovariate(1 / self.args.think_time))
+
+    async def monitor_loop_lag(self, interval: float = 0.05):
+        # Насколько позже запланированного просыпается задача - задержка цикла событий.
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(interval)
+            lag = loop.time() - started - interval
+            if started >= self.measure_from:
+                self.loop_lag.append(max(0.0, lag))
+
+    async def run(self) -> dict:
+        args = self.args
+        started = time.monotonic()
+        self.measure_from = started + args.ramp_up
+        deadline = self.measure_from + args.duration
+        monitor = asyncio.create_task(self.monitor_loop_lag())
+        users = [asyncio.create_task(self.virtual_user(LOAD_USER_ID_OFFSET + number,
+                                                       args.ramp_up * number / args.users, deadline))
+                 for number in range(args.users)]
+        try:
+            await asyncio.gather(*users)
+        finally:
+            monitor.cancel()
+        # Ответы на сообщения, отправленные в окне измерения, засчитываются, даже если пришли после его конца.
+        completed = self.outcomes["ok"]
+        return {
+            "sent": self.sent,
+            "outcomes": dict(self.outcomes),
+            "messages_per_second": round(completed / args.duration, 2),
+            "elapsed_seconds": round(time.monotonic() - started, 2),
+            "reply_latency": _percentiles(self.latencies),
+            "loop_lag": _percentiles(self.loop_lag),
+            "telegram_requests": dict(self.session.requests),
+        }
+
+
+def _start_stub_process(args) -> tuple[subprocess.Popen, str]:
+    # Заглушка - отдельный легкий процесс (без aiogram), адрес API она печатает первой строкой.
+    process = subprocess.Popen(stub_command(stub_options_from_args(args)), stdout=subprocess.PIPE, text=True,
+                               cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    url = process.stdout.readline().strip()
+    if not url:
+        process.kill()
+        raise RuntimeError("Не удалось запустить заглушку OpenAI API")
+    return process, url
+
+
+async def _fetch_stub_stats(base_url: str) -> dict | None:
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"{base_url.removesuffix('/v1')}/stats") as response:
+                return await response.json()
+    except aiohttp.ClientError:
+        return None
+
+
+async def run_load_test(args, stub_url: str) -> dict:
+    # Модули бота читают настройки из окружения при импорте, поэтому импортируем их
+    # только после того, как окружение указывает на заглушку и временную базу.
+    import ai_service
+    import main as bot_main
+    from benchmarks.db_bench import git_revision
+    from handlers.message import MESSAGE_COALESCE_WINDOW, STREAM_PLACEHOLDER_TEXT, STREAM_QUEUE_TEXT
+    from log_config import setup_logging
+
+    setup_logging(args.log_level)
+    dispatcher = bot_main.create_dispatcher(run_background_jobs=False, metrics_port=args.metrics_port)
+    test = LoadTest(args, dispatcher, bot_main.create_bot,
+                    ignored_texts=(STREAM_PLACEHOLDER_TEXT, STREAM_QUEUE_TEXT.split("{")[0]))
+
+    await dispatcher.emit_startup(bot=test.bot)
+    try:
+        results = await test.run()
+    finally:
+        await dispatcher.emit_shutdown(bot=test.bot)
+
+    return {
+        "benchmark": "load",
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {
+            "users": args.users, "duration": args.duration, "ramp_up": args.ramp_up,
+            "think_time": args.think_time, "telegram_latency": args.telegram_latency,
+            "coalesce_window": MESSAGE_COALESCE_WINDOW,
+            "ai_max_concurrency": ai_service.AI_MAX_CONCURRENCY, "seed": args.seed,
+        },
+        "results": results,
+        "scheduler": ai_service.get_scheduler_stats(),
+        "models": ai_service.get_model_stats(),
+        "stub": await _fetch_stub_stats(stub_url),
+    }
+
+
+def compare_with_baseline(report: dict, baseline: dict, threshold: float) -> list[str]:
+    """
+    Сравнивает пропускную способность и p99 задержки ответа с предыдущим отчетом.
+    Возвращает описания ухудшений больше threshold (0.2 = 20%).
+    """
+    regressions = []
+    old, new = baseline["results"], report["results"]
+    if new["messages_per_second"] < old["messages_per_second"] * (1 - threshold):
+        regressions.append(f"пропускная способность {old['messages_per_second']} -> {new['messages_per_second']}"
+                           f" сообщений/с")
+    old_p99, new_p99 = old["reply_latency"].get("p99_ms"), new["reply_latency"].get("p99_ms")
+    if old_p99 and new_p99 and new_p99 > old_p99 * (1 + threshold):
+        regressions.append(f"p99 задержки ответа {old_p99} -> {new_p99} мс")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Сквозной нагрузочный тест бота без сети")
+    parser.add_argument("--users", type=int, default=100, help="виртуальных пользователей")
+    parser.add_argument("--duration", type=float, default=30, help="длительность измерения после разгона, с")
+    parser.add_argument("--ramp-up", type=float, default=5, help="за сколько секунд подключаются все пользователи")
+    parser.add_argument("--think-time", type=float, default=1.0,
+                        help="средняя пауза пользователя между ответом и новым сообщением, с")
+    parser.add_argument("--reply-timeout", type=float, default=120, help="сколько ждать ответа бота, с")
+    parser.add_argument("--telegram-latency", type=float, default=0.03, help="задержка ответа Bot API, с")
+    parser.add_argument("--coalesce-window", type=float, default=None,
+                        help="MESSAGE_COALESCE_WINDOW бота (по умолчанию из окружения)")
+    parser.add_argument("--stub-url", default=None,
+                        help="адрес уже запущенной заглушки (http://host:port/v1), иначе запускается своя")
+    add_stub_arguments(parser)
+    parser.add_argument("--metrics-port", type=int, default=0, help="порт /metrics бота во время теста (0 - нет)")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default=None, help="файл для JSON-отчета (по умолчанию stdout)")
+    parser.add_argument("--baseline", default=None, help="JSON-отчет предыдущей версии для сравнения")
+    parser.add_argument("--threshold", type=float, default=0.2, help="допустимое ухудшение (0.2 = 20%%)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+
+    stub_process = None
+    stub_url = args.stub_url
+    if stub_url is None:
+        stub_process, stub_url = _start_stub_process(args)
+
+    with tempfile.TemporaryDirectory(prefix="psysup_load_") as data_dir:
+        os.environ.update({
+            "PSY_SUP_API": BOT_TOKEN,
+            "DEEPSEEK_API_KEY": "load-test",
+            "DEEPSEEK_BASE_URL": stub_url,
+            "DATABASE_NAME": os.path.join(data_dir, "load_test.db"),
+            "FSM_STORAGE": "memory",
+        })
+        if args.coalesce_window is not None:
+            os.environ["MESSAGE_COALESCE_WINDOW"] = str(args.coalesce_window)
+        try:
+            report = asyncio.run(run_load_test(args, stub_url))
+        finally:
+            if stub_process is not None:
+                stub_process.terminate()
+                stub_process.wait()
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(output)
+    else:
+        print(output)
+
+    results = report["results"]
+    print(f"{results['messages_per_second']} ответов/с, p50 {results['reply_latency'].get('p50_ms')} мс, "
+          f"p99 {results['reply_latency'].get('p99_ms')} мс, задержка цикла событий p99 "
+          f"{results['loop_lag'].get('p99_ms')} мс, исходы {results['outcomes']}", file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)
+        if baseline.get("parameters") != report["parameters"]:
+            print("Параметры прогона отличаются от базового отчета, сравнение может быть неточным",
+                  file=sys.stderr)
+        regressions = compare_with_baseline(report, baseline, args.threshold)
+        for line in regressions:
+            print(f"Ухудшение: {line}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,193 @@
+"""
+Заглушка OpenAI-совместимого API (POST /v1/chat/completions) для нагрузочных тестов без сети.
+
+Отвечает синтетическим текстом с настраиваемой задержкой до первого токена, скоростью
+потока и долей ошибок 500 и 429. Статистика запросов доступна по GET /stats.
+Текст ответа начинается с REPLY_PREFIX и заканчивается REPLY_SUFFIX, чтобы по сообщениям
+бота можно было понять, что ответ показан пользователю целиком.
+
+Запуск отдельно (например, чтобы направить на нее настоящего бота через DEEPSEEK_BASE_URL):
+    python -m benchmarks.stub_openai --port 8300 --first-token-latency 0.5
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from dataclasses import asdict, dataclass
+
+from aiohttp import web
+
+REPLY_PREFIX = "[stub]"
+REPLY_SUFFIX = "[/stub]"
+
+WORDS = ("понимаю", "это", "действительно", "непросто", "давай", "попробуем", "разобраться", "что",
+         "сейчас", "тревожит", "тебя", "больше", "всего", "может", "быть", "стоит", "сделать", "паузу")
+
+
+@dataclass
+class StubOptions:
+    # Задержка до первого токена (или до ответа без потока) и ее случайный разброс, в секундах.
+    first_token_latency: float = 0.3
+    jitter: float = 0.1
+    # Сколько фрагментов в потоковом ответе и пауза между ними.
+    chunks: int = 40
+    chunk_interval: float = 0.02
+    # Доли запросов, на которые отвечаем ошибкой 500 и 429 (Too Many Requests).
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    # Значение заголовка Retry-After для ответов 429, в секундах.
+    retry_after: float = 1.0
+    seed: int | None = None
+
+
+class StubOpenAI:
+    def __init__(self, options: StubOptions):
+        self.options = options
+        self.rng = random.Random(options.seed)
+        self.stats = {"requests": 0, "streams": 0, "completed": 0, "errors": 0, "rate_limited": 0,
+                      "disconnected": 0, "active": 0, "max_active": 0}
+
+    def _reply_words(self) -> list[str]:
+        return [REPLY_PREFIX, *(self.rng.choice(WORDS) for _ in range(max(1, self.options.chunks - 2))),
+                REPLY_SUFFIX]
+
+    def _latency(self) -> float:
+        return max(0.0, self.options.first_token_latency + self.rng.uniform(-1, 1) * self.options.jitter)
+
+    @staticmethod
+    def _chunk(completion_id: str, model: str, delta: dict, finish_reason: str | None = None) -> bytes:
+        data = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+        return f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode()
+
+    async def handle_completion(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        model = body.get("model", "stub")
+        self.stats["requests"] += 1
+
+        roll = self.rng.random()
+        if roll < self.options.rate_limit_rate:
+            self.stats["rate_limited"] += 1
+            return web.json_response({"error": {"message": "Rate limit exceeded", "type": "rate_limit_error"}},
+                                     status=429, headers={"Retry-After": str(self.options.retry_after)})
+        if roll < self.options.rate_limit_rate + self.options.error_rate:
+            self.stats["errors"] += 1
+            return web.json_response({"error": {"message": "Injected error", "type": "server_error"}}, status=500)
+
+        self.stats["active"] += 1
+        self.stats["max_active"] = max(self.stats["max_active"], self.stats["active"])
+        completion_id = f"chatcmpl-stub-{self.stats['requests']}"
+        words = self._reply_words()
+        try:
+            await asyncio.sleep(self._latency())
+            if not body.get("stream"):
+                await asyncio.sleep(self.options.chunk_interval * len(words))
+                self.stats["completed"] += 1
+                return web.json_response({
+                    "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": model,
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": " ".join(words)}}],
+                    "usage": {"prompt_tokens": 0, "completion_tokens": len(words), "total_tokens": len(words)},
+                })
+
+            self.stats["streams"] += 1
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+            await response.prepare(request)
+            await response.write(self._chunk(completion_id, model, {"role": "assistant", "content": ""}))
+            for index, word in enumerate(words):
+                if index:
+                    await asyncio.sleep(self.options.chunk_interval)
+                await response.write(self._chunk(completion_id, model,
+                                                 {"content": word if index == 0 else " " + word}))
+            await response.write(self._chunk(completion_id, model, {}, finish_reason="stop"))
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+            self.stats["completed"] += 1
+            return response
+        except (ConnectionResetError, asyncio.CancelledError):
+            # Клиент закрыл поток (например, проиграл хеджированный запрос или отменен ответ).
+            self.stats["disconnected"] += 1
+            raise
+        finally:
+            self.stats["active"] -= 1
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({**self.stats, "options": asdict(self.options)})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle_completion)
+        app.router.add_get("/stats", self.handle_stats)
+        return app
+
+
+async def start_stub(options: StubOptions, host: str = "127.0.0.1", port: int = 0) -> tuple[web.AppRunner, int]:
+    """
+    Запускает заглушку в текущем цикле событий. Возвращает runner и фактический порт.
+    """
+    runner = web.AppRunner(StubOpenAI(options).app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner, runner.addresses[0][1]
+
+
+def serve(options: StubOptions, host: str = "127.0.0.1", port: int = 0):
+    """
+    Запускает заглушку и работает до остановки процесса.
+    Первой строкой в stdout печатает адрес API (порт 0 - любой свободный).
+    """
+    async def run():
+        runner, actual_port = await start_stub(options, host, port)
+        print(f"http://{host}:{actual_port}/v1", flush=True)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+def add_stub_arguments(parser: argparse.ArgumentParser):
+    defaults = StubOptions()
+    parser.add_argument("--first-token-latency", type=float, default=defaults.first_token_latency,
+                        help="задержка до первого токена, с")
+    parser.add_argument("--jitter", type=float, default=defaults.jitter, help="разброс задержки, с")
+    parser.add_argument("--chunks", type=int, default=defaults.chunks, help="фрагментов в ответе")
+    parser.add_argument("--chunk-interval", type=float, default=defaults.chunk_interval,
+                        help="пауза между фрагментами, с")
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate, help="доля ответов 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=defaults.rate_limit_rate, help="доля ответов 429")
+    parser.add_argument("--retry-after", type=float, default=defaults.retry_after,
+                        help="Retry-After в ответах 429, с")
+
+
+def stub_options_from_args(args) -> StubOptions:
+    return StubOptions(first_token_latency=args.first_token_latency, jitter=args.jitter, chunks=args.chunks,
+                       chunk_interval=args.chunk_interval, error_rate=args.error_rate,
+                       rate_limit_rate=args.rate_limit_rate, retry_after=args.retry_after, seed=args.seed)
+
+
+def stub_command(options: StubOptions, port: int = 0) -> list[str]:
+    """
+    Команда запуска заглушки с этими настройками в отдельном процессе.
+    """
+    command = [sys.executable, "-m", "benchmarks.stub_openai", "--port", str(port)]
+    for name, value in asdict(options).items():
+        if value is not None:
+            command += [f"--{name.replace('_', '-')}", str(value)]
+    return command
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Заглушка OpenAI-совместимого API для нагрузочных тестов")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8300)
+    parser.add_argument("--seed", type=int, default=None)
+    add_stub_arguments(parser)
+    arguments = parser.parse_args()
+    serve(stub_options_from_args(arguments), arguments.host, arguments.port)
@@ -0,0 +1,273 @@
+import asyncio
+import os
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+from ai_scheduler import TokenBucket
+from db import (count_users_async, create_broadcast_async, get_broadcast_recipients_async,
+                get_running_broadcasts_async, save_broadcast_progress_async)
+from log_config import get_logger
+from metrics import BROADCAST_MESSAGES
+from send_limiter import bulk_sends
+
+log = get_logger(__name__)
+
+# Сообщений рассылки в секунду. Рассылка делит общий лимит массовых отправок (BULK_SEND_RATE)
+# с уведомлениями о подписке и не может его превысить.
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+# Сколько сообщений рассылки отправляется одновременно (скрывает задержку запроса к Bot API).
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))
+
+# Получателей на странице. Курсор сдвигается, когда вся страница обработана.
+BROADCAST_PAGE_SIZE = 200
+# Статусы получателей записываются в БД пачками по столько строк (и в конце каждой страницы).
+BROADCAST_FLUSH_ROWS = 50
+# Как часто обновлять сообщение с ходом рассылки у администратора, секунд.
+BROADCAST_PROGRESS_INTERVAL = 15
+# Попыток отправки одному получателю при сетевых ошибках.
+BROADCAST_MAX_ATTEMPTS = 3
+# Пауза перед повторным чтением страницы после ошибки БД, секунд.
+BROADCAST_DB_RETRY_DELAY = 5
+
+
+class Broadcast:
+    """
+    Одна рассылка: проходит таблицу users по возрастанию id страницами (keyset) и отправляет
+    текст через ограниченное число параллельных отправителей в пределах общего лимита bulk_sends.
+    RetryAfter от Telegram приостанавливает все массовые отправки на указанное время.
+
+    Статус каждого получателя записывается в broadcast_recipients, курсор - после обработки страницы.
+    Прерванная рассылка продолжается с курсора и пропускает получателей, которым уже отправлено.
+    """
+
+    def __init__(self, bot: Bot, broadcast_id: int, text: str, report_chat_id: int, cursor: int = 0,
+                 rate: float = BROADCAST_RATE, concurrency: int = BROADCAST_CONCURRENCY):
+        self.bot = bot
+        self.broadcast_id = broadcast_id
+        self.text = text
+        self.report_chat_id = report_chat_id
+        self.cursor = cursor
+        self.concurrency = max(concurrency, 1)
+        self.counts = {"sent": 0, "blocked": 0, "failed": 0}
+        self.total: int | None = None
+        self.started = time.monotonic()
+        self.cancel_requested = False
+        self._bucket = TokenBucket(rate, max(rate, 1.0))
+        self._results: list[tuple[int, str]] = []
+        self._progress_message_id: int | None = None
+
+    @property
+    def processed(self) -> int:
+        return sum(self.counts.values())
+
+    @property
+    def throughput(self) -> float:
+        return self.processed / max(time.monotonic() - self.started, 1e-9)
+
+    async def _send(self, user_id: int) -> str:
+        attempt = 0
+        while True:
+            await bulk_sends.acquire(self._bucket)
+            try:
+                await self.bot.send_message(user_id, self.text)
+                return "sent"
+            except TelegramRetryAfter as e:
+                # Лимит общий для бота: останавливаем все массовые отправки, это сообщение повторяем.
+                bulk_sends.pause(e.retry_after)
+                log.warning("Telegram ограничил рассылку", broadcast_id=self.broadcast_id, retry_after=e.retry_after)
+            except TelegramForbiddenError:
+                return "blocked"
+            except TelegramBadRequest as e:
+                log.info("Сообщение рассылки не доставлено", broadcast_id=self.broadcast_id, user_id=user_id, error=e)
+                return "failed"
+            except TelegramAPIError as e:
+                attempt += 1
+                if attempt >= BROADCAST_MAX_ATTEMPTS:
+                    log.warning("Сообщение рассылки не отправлено", broadcast_id=self.broadcast_id,
+                                user_id=user_id, error=e)
+                    return "failed"
+                await asyncio.sleep(2 ** attempt)
+
+    async def _flush(self, cursor: int | None = None, status: str | None = None) -> bool:
+        """
+        Записывает накопленные статусы получателей (и курсор со статусом, если переданы).
+        Возвращает False, если запись не удалась: статусы остаются для следующей записи.
+        """
+        results, self._results = self._results, []
+        if not results and cursor is None and status is None:
+            return True
+        # Запись доводится до конца и при отмене задачи: иначе после перезапуска эти получатели
+        # получили бы сообщение повторно.
+        saved = await asyncio.shield(save_broadcast_progress_async(self.broadcast_id, results, cursor, status))
+        if not saved:
+            self._results = results + self._results
+        return saved
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            user_id = await queue.get()
+            try:
+                try:
+                    outcome = await self._send(user_id)
+                except Exception:
+                    log.exception("Ошибка при отправке сообщения рассылки", broadcast_id=self.broadcast_id,
+                                  user_id=user_id)
+                    outcome = "failed"
+                self.counts[outcome] += 1
+                BROADCAST_MESSAGES.inc(outcome)
+                self._results.append((user_id, outcome))
+                if len(self._results) >= BROADCAST_FLUSH_ROWS:
+                    await self._flush()
+            except Exception:
+                # Отправитель не должен завершаться: иначе queue.join() ждал бы его получателей вечно.
+                log.exception("Ошибка в отправителе рассылки", broadcast_id=self.broadcast_id)
+            finally:
+                queue.task_done()
+
+    def progress_text(self, finished: str | None = None) -> str:
+        total = f" из ~{self.total}" if self.total else ""
+        header = {
+            None: f"📣 Рассылка #{self.broadcast_id} идет",
+            "done": f"✅ Рассылка #{self.broadcast_id} завершена",
+            "cancelled": f"⛔ Рассылка #{self.broadcast_id} остановлена",
+        }[finished]
+        return (f"{header}\n"
+                f"Обработано в этом запуске: {self.processed}{total}\n"
+                f"Доставлено: {self.counts['sent']}, заблокировали бота: {self.counts['blocked']}, "
+                f"ошибок: {self.counts['failed']}\n"
+                f"Скорость: {self.throughput:.1f} сообщ./с")
+
+    async def _report(self, finished: str | None = None):
+        text = self.progress_text(finished)
+        try:
+            if self._progress_message_id is None:
+                self._progress_message_id = (await self.bot.send_message(self.report_chat_id, text)).message_id
+            else:
+                await self.bot.edit_message_text(text, chat_id=self.report_chat_id,
+                                                 message_id=self._progress_message_id)
+        except TelegramAPIError as e:
+            log.debug("Не удалось обновить ход рассылки", broadcast_id=self.broadcast_id, error=e)
+
+    async def _report_loop(self):
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            await self._report()
+            log.info("Ход рассылки", broadcast_id=self.broadcast_id, processed=self.processed,
+                     rate=round(self.throughput, 1), **self.counts)
+
+    async def run(self):
+        self.total = await count_users_async()
+        await self._report()
+        queue: asyncio.Queue[int] = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.concurrency)]
+        reporter = asyncio.create_task(self._report_loop())
+        status = None
+        try:
+            while True:
+                page = await get_broadcast_recipients_async(self.broadcast_id, self.cursor, BROADCAST_PAGE_SIZE)
+                if page is None:
+                    await asyncio.sleep(BROADCAST_DB_RETRY_DELAY)
+                    continue
+                if not page:
+                    break
+                for user_id in page:
+                    await queue.put(user_id)
+                await queue.join()
+                # Курсор сохраняется вместе со статусами страницы и сдвигается только после записи.
+                # Следующую страницу не читаем, пока запись не удалась: получатели без записанного
+                # статуса попали бы в нее снова и получили сообщение второй раз.
+                while not await self._flush(cursor=page[-1]):
+                    await asyncio.sleep(BROADCAST_DB_RETRY_DELAY)
+                self.cursor = page[-1]
+            status = "done"
+        except asyncio.CancelledError:
+            # Остановка бота оставляет рассылку в статусе running, и она продолжится после запуска.
+            if self.cancel_requested:
+                status = "cancelled"
+            raise
+        finally:
+            reporter.cancel()
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(reporter, *workers, return_exceptions=True)
+            for attempt in range(BROADCAST_MAX_ATTEMPTS):
+                if await self._flush(status=status):
+                    break
+                if attempt + 1 < BROADCAST_MAX_ATTEMPTS:
+                    await asyncio.sleep(1)
+            else:
+                log.error("Прогресс рассылки не сохранен", broadcast_id=self.broadcast_id,
+                          unsaved=len(self._results))
+            if status is not None:
+                await self._report(status)
+            log.info("Рассылка остановлена" if status is None else "Рассылка завершена",
+                     broadcast_id=self.broadcast_id, status=status, processed=self.processed,
+                     rate=round(self.throughput, 1), **self.counts)
+
+
+# Рассылка, которая выполняется в этом процессе, и ее задача.
+_current: tuple[Broadcast, asyncio.Task] | None = None
+
+
+def _launch(broadcast: Broadcast):
+    global _current
+    task = asyncio.create_task(broadcast.run())
+    _current = (broadcast, task)
+
+    def on_done(_):
+        global _current
+        if _current is not None and _current[1] is task:
+            _current = None
+
+    task.add_done_callback(on_done)
+
+
+async def start_broadcast(bot: Bot, text: str, report_chat_id: int) -> int | None:
+    """
+    Создает и запускает рассылку. Возвращает ее id или None, если другая рассылка еще не закончена.
+    """
+    broadcast_id = await create_broadcast_async(text, report_chat_id)
+    if broadcast_id is None:
+        return None
+    _launch(Broadcast(bot, broadcast_id, text, report_chat_id))
+    return broadcast_id
+
+
+def current_broadcast() -> Broadcast | None:
+    return _current[0] if _current is not None else None
+
+
+def cancel_broadcast() -> bool:
+    """
+    Останавливает рассылку этого процесса и помечает ее отмененной.
+    """
+    if _current is None:
+        return False
+    broadcast, task = _current
+    broadcast.cancel_requested = True
+    task.cancel()
+    return True
+
+
+async def resume_broadcasts(bot: Bot):
+    """
+    Продолжает рассылки, прерванные остановкой бота, с сохраненного курсора.
+    """
+    for broadcast_id, text, created_by, _, _, _, cursor, _, _, _ in await get_running_broadcasts_async():
+        if _current is not None:
+            break
+        log.info("Продолжаем прерванную рассылку", broadcast_id=broadcast_id, cursor=cursor)
+        _launch(Broadcast(bot, broadcast_id, text, created_by, cursor=cursor))
+
+
+async def stop_broadcasts():
+    """
+    Прерывает рассылку при остановке бота, сохраняя ее прогресс.
+    """
+    if _current is None:
+        return
+    _, task = _current
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
@@ -0,0 +1,218 @@
+import asyncio
+import json
+import sqlite3
+import time
+import zlib
+
+from log_config import get_logger
+
+log = get_logger(__name__)
+
+# Архив старых сообщений диалогов - отдельный файл SQLite, который подключается к соединениям
+# пула через ATTACH под этим именем. Основная база (и ее резервные копии) остается небольшой.
+ARCHIVE_SCHEMA = "archive"
+
+# Горячее окно не может быть меньше числа реплик, которое нужно для контекста модели и сводки.
+MIN_HOT_MESSAGES = 50
+
+ARCHIVE_STATEMENTS = (
+    f'''
+    CREATE TABLE IF NOT EXISTS {ARCHIVE_SCHEMA}.dialogue_archive (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        first_id INTEGER NOT NULL, -- id первого и последнего сообщения dialogues в порции
+        last_id INTEGER NOT NULL,
+        first_ts INTEGER,
+        last_ts INTEGER,
+        message_count INTEGER NOT NULL,
+        raw_bytes INTEGER NOT NULL, -- размер JSON до сжатия
+        payload BLOB NOT NULL -- zlib(JSON [[id, message_text, timestamp, ts, sender], ...])
+    )
+    ''',
+    f"CREATE UNIQUE INDEX IF NOT EXISTS {ARCHIVE_SCHEMA}.idx_dialogue_archive_user_first "
+    f"ON dialogue_archive (user_id, first_id)",
+)
+
+
+def attach_archive(conn: sqlite3.Connection, path: str):
+    """
+    Подключает файл архива к соединению (если еще не подключен) и создает в нем таблицу.
+    """
+    if any(row[1] == ARCHIVE_SCHEMA for row in conn.execute("PRAGMA database_list")):
+        return
+    conn.execute(f"ATTACH DATABASE ? AS {ARCHIVE_SCHEMA}", (path,))
+    conn.execute(f"PRAGMA {ARCHIVE_SCHEMA}.journal_mode=WAL")
+    for statement in ARCHIVE_STATEMENTS:
+        conn.execute(statement)
+    conn.commit()
+
+
+def archive_boundary(conn: sqlite3.Connection, user_id: int, hot_messages: int, cutoff_ts: int | None) -> int:
+    """
+    Возвращает id последнего сообщения пользователя, которое можно перенести в архив (0 - нечего).
+    В таблице остаются последние hot_messages сообщений и все сообщения не старше cutoff_ts.
+    Переносится всегда начало истории, поэтому архив и таблица не пересекаются по id.
+    """
+    row = conn.execute("""
+        SELECT id FROM dialogues WHERE user_id = ?
+        ORDER BY id DESC LIMIT 1 OFFSET ?
+    """, (user_id, hot_messages)).fetchone()
+    if row is None:
+        return 0
+    boundary = row[0]
+    if cutoff_ts is not None:
+        oldest = conn.execute("SELECT MAX(id) FROM dialogues WHERE user_id = ? AND id <= ? AND ts < ?",
+                              (user_id, boundary, cutoff_ts)).fetchone()[0]
+        boundary = min(boundary, oldest or 0)
+    return boundary
+
+
+def archive_chunk(conn: sqlite3.Connection, user_id: int, boundary: int, chunk_rows: int) -> tuple[int, int, int]:
+    """
+    Переносит до chunk_rows самых старых сообщений пользователя с id <= boundary в одну сжатую порцию архива.
+    Вставка в архив и удаление из dialogues выполняются в одной транзакции.
+    Возвращает (сообщений, байт до сжатия, байт после сжатия).
+    """
+    rows = conn.execute("""
+        SELECT id, message_text, timestamp, ts, sender
+        FROM dialogues
+        WHERE user_id = ? AND id <= ?
+        ORDER BY id
+        LIMIT ?
+    """, (user_id, boundary, chunk_rows)).fetchall()
+    if not rows:
+        return 0, 0, 0
+
+    raw = json.dumps(rows, ensure_ascii=False, separators=(",", ":")).encode()
+    payload = zlib.compress(raw, 6)
+    try:
+        # В WAL-режиме при сбое посреди коммита порция может оказаться и в архиве, и в таблице.
+        # Чтение истории убирает такие повторы по id, а повторная архивация заменяет порцию.
+        conn.execute(f"""
+            INSERT OR REPLACE INTO {ARCHIVE_SCHEMA}.dialogue_archive
+                (user_id, first_id, last_id, first_ts, last_ts, message_count, raw_bytes, payload)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (user_id, rows[0][0], rows[-1][0], rows[0][3], rows[-1][3], len(rows), len(raw), payload))
+        conn.execute("DELETE FROM dialogues WHERE user_id = ? AND id >= ? AND id <= ?",
+                     (user_id, rows[0][0], rows[-1][0]))
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    return len(rows), len(raw), len(payload)
+
+
+def _read_archived(conn: sqlite3.Connection, user_id: int, after_id: int, limit: int) -> list[tuple]:
+    # Порции распаковываются по одной, пока не наберется limit сообщений.
+    cursor = conn.execute(f"""
+        SELECT payload FROM {ARCHIVE_SCHEMA}.dialogue_archive
+        WHERE user_id = ? AND last_id > ?
+        ORDER BY first_id
+    """, (user_id, after_id))
+    rows = []
+    last_id = after_id
+    try:
+        for (payload,) in cursor:
+            for message_id, message_text, timestamp, ts, sender in json.loads(zlib.decompress(payload)):
+                if message_id > last_id:
+                    rows.append((message_id, message_text, timestamp, sender))
+                    last_id = message_id
+                    if len(rows) >= limit:
+                        return rows
+        return rows
+    finally:
+        cursor.close()
+
+
+def read_history_page(conn: sqlite3.Connection, user_id: int, after_id: int, limit: int) -> list[tuple]:
+    """
+    Возвращает до limit сообщений пользователя с id > after_id из архива и таблицы dialogues
+    в хронологическом порядке: список кортежей (id, message_text, timestamp, sender).
+    Для следующей страницы передается id последнего сообщения.
+    """
+    conn.execute("BEGIN")
+    try:
+        # Сначала читаем таблицу: снимок архива берется позже и содержит все, что успели перенести
+        # после снимка таблицы, поэтому сообщения, перенесенные во время чтения, не теряются.
+        hot = conn.execute("""
+            SELECT id, message_text, timestamp, sender
+            FROM dialogues
+            WHERE user_id = ? AND id > ?
+            ORDER BY id
+            LIMIT ?
+        """, (user_id, after_id, limit)).fetchall()
+        archived = _read_archived(conn, user_id, after_id, limit)
+    finally:
+        conn.rollback()
+    if not archived:
+        return hot
+    merged = {row[0]: row for row in hot}
+    merged.update((row[0], row) for row in archived)
+    return [merged[message_id] for message_id in sorted(merged)[:limit]]
+
+
+def archive_stats(conn: sqlite3.Connection) -> dict:
+    row = conn.execute(f"""
+        SELECT COUNT(*), COUNT(DISTINCT user_id), COALESCE(SUM(message_count), 0),
+               COALESCE(SUM(raw_bytes), 0), COALESCE(SUM(LENGTH(payload)), 0)
+        FROM {ARCHIVE_SCHEMA}.dialogue_archive
+    """).fetchone()
+    return {"chunks": row[0], "users": row[1], "messages": row[2], "raw_bytes": row[3], "compressed_bytes": row[4]}
+
+
+def _users_page(conn: sqlite3.Connection, after_user_id: int, limit: int) -> list[int]:
+    return [row[0] for row in conn.execute("SELECT id FROM users WHERE id > ? ORDER BY id LIMIT ?",
+                                           (after_user_id, limit))]
+
+
+async def archive_old_dialogues(pool, archive_path: str, hot_messages: int, hot_days: int,
+                                chunk_rows: int = 500, users_batch: int = 500, pause: float = 0.05,
+                                on_archived=None) -> dict:
+    """
+    Один проход архивации: перебирает пользователей по возрастанию id и переносит в архив
+    сообщения за пределами горячего окна. Работает небольшими транзакциями с паузами,
+    чтобы не мешать обработке сообщений. on_archived(число сообщений) вызывается после каждой порции.
+    Возвращает итоги прохода.
+    """
+    hot_messages = max(hot_messages, MIN_HOT_MESSAGES)
+    cutoff_ts = int(time.time()) - hot_days * 86400 if hot_days > 0 else None
+    totals = {"users": 0, "messages": 0, "raw_bytes": 0, "compressed_bytes": 0}
+
+    def users_after(user_id: int) -> list[int]:
+        return _users_page(pool.connection(), user_id, users_batch)
+
+    def boundary_for(user_id: int) -> int:
+        conn = pool.connection()
+        attach_archive(conn, archive_path)
+        return archive_boundary(conn, user_id, hot_messages, cutoff_ts)
+
+    def move_chunk(user_id: int, boundary: int) -> tuple[int, int, int]:
+        conn = pool.connection()
+        attach_archive(conn, archive_path)
+        return archive_chunk(conn, user_id, boundary, chunk_rows)
+
+    after_user_id = 0
+    while True:
+        user_ids = await pool.run(users_after, after_user_id)
+        if not user_ids:
+            break
+        after_user_id = user_ids[-1]
+        for user_id in user_ids:
+            boundary = await pool.run(boundary_for, user_id)
+            if not boundary:
+                continue
+            totals["users"] += 1
+            while True:
+                moved, raw_bytes, compressed_bytes = await pool.run(move_chunk, user_id, boundary)
+                if not moved:
+                    break
+                totals["messages"] += moved
+                totals["raw_bytes"] += raw_bytes
+                totals["compressed_bytes"] += compressed_bytes
+                if on_archived is not None:
+                    on_archived(moved)
+                await asyncio.sleep(pause)
+
+    if totals["messages"]:
+        log.info("Старые сообщения перенесены в архив", **totals)
+    return totals
@@ -0,0 +1,102 @@
+import threading
+from collections import OrderedDict, deque
+
+
+def to_chat_message(message_text: str, sender: str) -> dict:
+    # 'user' из нашей БД соответствует 'user' для API, 'bot' - 'assistant'.
+    role = 'user' if sender == 'user' else 'assistant'
+    return {"role": role, "content": message_text}
+
+
+class DialogueContextCache:
+    """
+    Кэш последних реплик диалога по пользователям, уже в формате сообщений OpenAI.
+
+    Для каждого пользователя хранится кольцевой буфер из max_turns последних реплик.
+    Буфер заполняется из БД при первом обращении и дополняется по мере записи новых
+    сообщений. Общий объем текста ограничен max_chars: при превышении вытесняются
+    пользователи, к которым дольше всего не обращались (LRU).
+    """
+
+    def __init__(self, max_turns: int = 20, max_chars: int = 20_000_000):
+        self.max_turns = max_turns
+        self.max_chars = max_chars
+        self.hits = 0
+        self.misses = 0
+
+        self._buffers: OrderedDict[int, deque] = OrderedDict()
+        self._total_chars = 0
+        self._lock = threading.Lock()
+        # Счетчики реплик, пришедших во время загрузки истории пользователя из БД.
+        self._loading: dict[int, int] = {}
+
+    def get(self, user_id: int, limit: int) -> list[dict] | None:
+        """
+        Возвращает последние limit реплик пользователя или None, если его нет в кэше.
+        """
+        with self._lock:
+            buffer = self._buffers.get(user_id)
+            if buffer is None:
+                self.misses += 1
+                return None
+            self._buffers.move_to_end(user_id)
+            self.hits += 1
+            if limit >= len(buffer):
+                return list(buffer)
+            return list(buffer)[-limit:]
+
+    def begin_load(self, user_id: int):
+        """
+        Отмечает начало загрузки истории пользователя из БД.
+        """
+        with self._lock:
+            self._loading.setdefault(user_id, 0)
+
+    def finish_load(self, user_id: int, messages: list[dict]) -> bool:
+        """
+        Сохраняет загруженную из БД историю. Если во время загрузки у пользователя
+        появились новые реплики, снимок может быть неполным, и он не сохраняется.
+        Возвращает True, если история попала в кэш.
+        """
+        with self._lock:
+            appended_during_load = self._loading.pop(user_id, 0)
+            if appended_during_load or user_id in self._buffers:
+                return False
+            buffer = deque(messages[-self.max_turns:], maxlen=self.max_turns)
+            self._buffers[user_id] = buffer
+            self._total_chars += sum(len(message["content"]) for message in buffer)
+            self._evict()
+            return True
+
+    def append(self, user_id: int, message: dict):
+        """
+        Добавляет реплику в буфер пользователя, если его история уже в кэше.
+        """
+        with self._lock:
+            if user_id in self._loading:
+                self._loading[user_id] += 1
+            buffer = self._buffers.get(user_id)
+            if buffer is None:
+                return
+            if len(buffer) == buffer.maxlen:
+                self._total_chars -= len(buffer[0]["content"])
+            buffer.append(message)
+            self._total_chars += len(message["content"])
+            self._buffers.move_to_end(user_id)
+            self._evict()
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            buffer = self._buffers.pop(user_id, None)
+            if buffer is not None:
+                self._total_chars -= sum(len(message["content"]) for message in buffer)
+
+    def _evict(self):
+        while self._total_chars > self.max_chars and self._buffers:
+            _, buffer = self._buffers.popitem(last=False)
+            self._total_chars -= sum(len(message["content"]) for message in buffer)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "users": len(self._buffers), "chars": self._total_chars}
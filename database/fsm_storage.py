@@ -0,0 +1,135 @@
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Mapping
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+
+def storage_key_to_str(key: StorageKey) -> str:
+    return ":".join(str(part) for part in (key.bot_id, key.chat_id, key.user_id, key.thread_id,
+                                           key.business_connection_id, key.destiny))
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище состояний FSM в таблице fsm_states той же базы SQLite.
+
+    Состояние видно всем процессам бота и переживает перезапуск. Запросы выполняются
+    через общий пул соединений, в потоках БД.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def _read(self, key: str) -> tuple | None:
+        return self.pool.connection().execute(
+            "SELECT state, data FROM fsm_states WHERE storage_key = ?", (key,)
+        ).fetchone()
+
+    def _write(self, key: str, column: str, value: str | None):
+        conn = self.pool.connection()
+        try:
+            # Столбец выбирается только из двух фиксированных значений ниже.
+            conn.execute(f"""
+                INSERT INTO fsm_states (storage_key, {column}, updated_ts) VALUES (?, ?, ?)
+                ON CONFLICT(storage_key) DO UPDATE SET {column} = excluded.{column}, updated_ts = excluded.updated_ts
+            """, (key, value, int(datetime.now().timestamp())))
+            # Пустые записи не храним.
+            conn.execute("DELETE FROM fsm_states WHERE storage_key = ? AND state IS NULL AND data IS NULL", (key,))
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        await self.pool.run(self._write, storage_key_to_str(key), "state", value)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        row = await self.pool.run(self._read, storage_key_to_str(key))
+        return row[0] if row else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        value = json.dumps(dict(data), ensure_ascii=False) if data else None
+        await self.pool.run(self._write, storage_key_to_str(key), "data", value)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        row = await self.pool.run(self._read, storage_key_to_str(key))
+        return json.loads(row[1]) if row and row[1] else {}
+
+    async def close(self) -> None:
+        # Соединения принадлежат общему пулу БД и закрываются вместе с ним.
+        pass
+
+
+class _MemoryRecord:
+    __slots__ = ("state", "data", "expires_at")
+
+    def __init__(self, expires_at: float):
+        self.state: str | None = None
+        self.data: dict[str, Any] = {}
+        self.expires_at = expires_at
+
+
+class BoundedMemoryStorage(BaseStorage):
+    """
+    Хранилище состояний FSM в памяти процесса, ограниченное по размеру и времени жизни.
+
+    В отличие от стандартного MemoryStorage, записи без обращений дольше ttl секунд
+    удаляются, а при превышении max_size вытесняются самые давно использованные,
+    поэтому потребление памяти не растет с числом пользователей. Подходит для
+    запуска в одном процессе.
+    """
+
+    def __init__(self, max_size: int = 100_000, ttl: float = 86400.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._records: OrderedDict[StorageKey, _MemoryRecord] = OrderedDict()
+
+    def _get(self, key: StorageKey) -> _MemoryRecord | None:
+        record = self._records.get(key)
+        if record is None:
+            return None
+        if record.expires_at <= time.monotonic():
+            del self._records[key]
+            return None
+        return record
+
+    def _touch(self, key: StorageKey) -> _MemoryRecord:
+        record = self._get(key)
+        if record is None:
+            record = self._records[key] = _MemoryRecord(0.0)
+        record.expires_at = time.monotonic() + self.ttl
+        self._records.move_to_end(key)
+        while len(self._records) > self.max_size:
+            self._records.popitem(last=False)
+        return record
+
+    def _drop_if_empty(self, key: StorageKey, record: _MemoryRecord):
+        if record.state is None and not record.data:
+            self._records.pop(key, None)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = self._touch(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._drop_if_empty(key, record)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        record = self._get(key)
+        return record.state if record else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        record = self._touch(key)
+        record.data = dict(data)
+        self._drop_if_empty(key, record)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        record = self._get(key)
+        return dict(record.data) if record else {}
+
+    async def close(self) -> None:
+        self._records.clear()
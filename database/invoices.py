@@ -0,0 +1,61 @@
+from collections import OrderedDict
+from typing import NamedTuple
+
+
+class PendingInvoice(NamedTuple):
+    payload: str
+    user_id: int
+    amount: int # В минимальных единицах валюты
+    currency: str
+    days: int
+    expires_ts: int
+    chat_id: int | None = None
+    message_id: int | None = None
+
+
+class InvoiceRegistry:
+    """
+    Неоплаченные счета, выставленные этим процессом: поиск по payload и по пользователю за O(1).
+
+    Срок жизни у всех счетов одинаковый, поэтому порядок добавления совпадает с порядком
+    истечения и устаревшие записи вытесняются с начала очереди. Источник истины - таблица invoices:
+    при промахе (счет выставил другой процесс или бот перезапускался) запись читается из БД.
+    Используется только из цикла событий.
+    """
+
+    def __init__(self, max_size: int = 100000):
+        self.max_size = max_size
+        self._by_payload: OrderedDict[str, PendingInvoice] = OrderedDict()
+        # Последний выставленный счет пользователя - его переиспользуют при повторном запросе.
+        self._by_user: dict[int, str] = {}
+
+    def __len__(self) -> int:
+        return len(self._by_payload)
+
+    def _evict(self, now_ts: float):
+        while self._by_payload:
+            payload, invoice = next(iter(self._by_payload.items()))
+            if invoice.expires_ts > now_ts and len(self._by_payload) <= self.max_size:
+                break
+            self.remove(payload)
+
+    def put(self, invoice: PendingInvoice, now_ts: float):
+        self._by_payload[invoice.payload] = invoice
+        self._by_user[invoice.user_id] = invoice.payload
+        self._evict(now_ts)
+
+    def get(self, payload: str, now_ts: float) -> PendingInvoice | None:
+        invoice = self._by_payload.get(payload)
+        if invoice is not None and invoice.expires_ts <= now_ts:
+            self.remove(payload)
+            return None
+        return invoice
+
+    def for_user(self, user_id: int, now_ts: float) -> PendingInvoice | None:
+        payload = self._by_user.get(user_id)
+        return self.get(payload, now_ts) if payload is not None else None
+
+    def remove(self, payload: str):
+        invoice = self._by_payload.pop(payload, None)
+        if invoice is not None and self._by_user.get(invoice.user_id) == payload:
+            del self._by_user[invoice.user_id]
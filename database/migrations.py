@@ -0,0 +1,364 @@
+import asyncio
+import sqlite3
+
+from log_config import get_logger
+
+log = get_logger(__name__)
+
+def _day_expression(prefix: str) -> str:
+    # Локальная дата строки: по ts, а для строк, у которых ts еще не заполнен, - по тексту timestamp.
+    return f"COALESCE(date({prefix}ts, 'unixepoch', 'localtime'), substr({prefix}timestamp, 1, 10))"
+
+
+# Версия схемы хранится в PRAGMA user_version. Каждая миграция - это номер версии,
+# короткое описание и список SQL-выражений, которые выполняются в одной транзакции.
+# Новые миграции добавляются только в конец списка, уже выпущенные не меняются.
+MIGRATIONS: list[tuple[int, str, list[str]]] = [
+    (1, "Базовая схема: users, dialogues, payments", [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY, -- Telegram User ID
+            full_name TEXT,
+            username TEXT,
+            join_date TEXT, -- Храним дату как текст в формате ISO8601
+            subscription_expiry_date TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS dialogues (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            message_text TEXT,
+            timestamp TEXT, -- Храним дату как текст в формате ISO8601
+            sender TEXT, -- 'user' или 'bot'
+            FOREIGN KEY (user_id) REFERENCES users(id) -- Связываем с таблицей users
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            amount INTEGER, -- Сумма в минимальных единицах
+            currency TEXT,
+            timestamp TEXT, -- Храним дату как текст в формате ISO8601
+            status TEXT,
+            telegram_charge_id TEXT,
+            provider_charge_id TEXT,
+            invoice_payload TEXT,
+            FOREIGN KEY (user_id) REFERENCES users(id) -- Связываем с таблицей users
+        )
+        ''',
+    ]),
+    (2, "Индексы для истории диалога и поиска платежа по telegram_charge_id", [
+        # id растет монотонно, поэтому (user_id, id) дает и фильтр по пользователю, и порядок по времени.
+        "CREATE INDEX IF NOT EXISTS idx_dialogues_user_id_id ON dialogues (user_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_telegram_charge_id ON payments (telegram_charge_id)",
+    ]),
+    (3, "Целочисленные метки времени (Unix epoch) для dialogues и payments", [
+        # Старые строки заполняются фоновым backfill_epoch_timestamps, а не здесь,
+        # чтобы миграция не держала блокировку на большой таблице.
+        "ALTER TABLE dialogues ADD COLUMN ts INTEGER",
+        "ALTER TABLE payments ADD COLUMN ts INTEGER",
+    ]),
+    (4, "Сводки старой части диалога для сборки контекста", [
+        '''
+        CREATE TABLE IF NOT EXISTS dialogue_summaries (
+            user_id INTEGER PRIMARY KEY,
+            summary TEXT,
+            last_dialogue_id INTEGER, -- id последнего сообщения dialogues, учтенного в сводке
+            updated_ts INTEGER,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+        ''',
+    ]),
+    (5, "Состояния FSM, общие для всех процессов бота", [
+        '''
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            storage_key TEXT PRIMARY KEY, -- bot_id:chat_id:user_id:thread_id:business_connection_id:destiny
+            state TEXT,
+            data TEXT, -- JSON
+            updated_ts INTEGER
+        )
+        ''',
+    ]),
+    (6, "Индекс платежей по пользователю для приоритета оплативших подписку", [
+        "CREATE INDEX IF NOT EXISTS idx_payments_user_id ON payments (user_id)",
+    ]),
+    (7, "Агрегаты для отчетов администратора, обновляемые триггерами", [
+        # День - дата в локальном времени, как и текстовые timestamp. Отчет за N дней читает N строк.
+        '''
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT PRIMARY KEY, -- YYYY-MM-DD
+            new_users INTEGER NOT NULL DEFAULT 0,
+            active_users INTEGER NOT NULL DEFAULT 0, -- написали боту хотя бы одно сообщение за день
+            messages INTEGER NOT NULL DEFAULT 0, -- все реплики, пользователя и бота
+            user_messages INTEGER NOT NULL DEFAULT 0,
+            paying_users INTEGER NOT NULL DEFAULT 0, -- впервые оплатили подписку в этот день
+            converted_users INTEGER NOT NULL DEFAULT 0 -- из пришедших в этот день когда-либо оплатили
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS daily_active_users (
+            day TEXT,
+            user_id INTEGER,
+            PRIMARY KEY (day, user_id)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS daily_revenue (
+            day TEXT,
+            currency TEXT,
+            amount INTEGER NOT NULL DEFAULT 0, -- в минимальных единицах валюты
+            payments INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, currency)
+        ) WITHOUT ROWID
+        ''',
+        # Однократное заполнение по уже накопленным данным, до создания триггеров.
+        '''
+        INSERT INTO daily_stats (day, new_users)
+        SELECT substr(join_date, 1, 10), COUNT(*) FROM users WHERE join_date IS NOT NULL GROUP BY 1
+        ''',
+        f'''
+        INSERT INTO daily_stats (day, messages, user_messages)
+        SELECT {_day_expression("")}, COUNT(*), SUM(sender = 'user') FROM dialogues WHERE true GROUP BY 1
+        ON CONFLICT(day) DO UPDATE SET messages = excluded.messages, user_messages = excluded.user_messages
+        ''',
+        f'''
+        INSERT OR IGNORE INTO daily_active_users (day, user_id)
+        SELECT DISTINCT {_day_expression("")}, user_id FROM dialogues WHERE sender = 'user'
+        ''',
+        '''
+        UPDATE daily_stats
+        SET active_users = (SELECT COUNT(*) FROM daily_active_users WHERE daily_active_users.day = daily_stats.day)
+        ''',
+        f'''
+        INSERT INTO daily_revenue (day, currency, amount, payments)
+        SELECT {_day_expression("")}, currency, SUM(amount), COUNT(*) FROM payments
+        WHERE status = 'successful' GROUP BY 1, 2
+        ''',
+        f'''
+        WITH first_payments AS (
+            SELECT payments.user_id, {_day_expression("payments.")} AS day
+            FROM payments
+            JOIN (SELECT MIN(id) AS id FROM payments WHERE status = 'successful' GROUP BY user_id) AS first
+                ON first.id = payments.id
+        )
+        INSERT INTO daily_stats (day, paying_users)
+        SELECT day, COUNT(*) FROM first_payments WHERE true GROUP BY day
+        ON CONFLICT(day) DO UPDATE SET paying_users = excluded.paying_users
+        ''',
+        '''
+        WITH payers AS (SELECT DISTINCT user_id FROM payments WHERE status = 'successful')
+        INSERT INTO daily_stats (day, converted_users)
+        SELECT substr(users.join_date, 1, 10), COUNT(*)
+        FROM payers JOIN users ON users.id = payers.user_id
+        WHERE users.join_date IS NOT NULL GROUP BY 1
+        ON CONFLICT(day) DO UPDATE SET converted_users = excluded.converted_users
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_users_daily_stats AFTER INSERT ON users
+        WHEN NEW.join_date IS NOT NULL
+        BEGIN
+            INSERT INTO daily_stats (day, new_users) VALUES (substr(NEW.join_date, 1, 10), 1)
+            ON CONFLICT(day) DO UPDATE SET new_users = new_users + 1;
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_dialogues_daily_stats AFTER INSERT ON dialogues
+        BEGIN
+            INSERT INTO daily_stats (day, messages, user_messages)
+            VALUES ({_day_expression("NEW.")}, 1, NEW.sender = 'user')
+            ON CONFLICT(day) DO UPDATE SET messages = messages + 1,
+                                           user_messages = user_messages + excluded.user_messages;
+            INSERT OR IGNORE INTO daily_active_users (day, user_id)
+            SELECT {_day_expression("NEW.")}, NEW.user_id WHERE NEW.sender = 'user';
+        END
+        ''',
+        # INSERT OR IGNORE не вызывает триггер, если пользователь уже писал сегодня.
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_daily_active_users AFTER INSERT ON daily_active_users
+        BEGIN
+            UPDATE daily_stats SET active_users = active_users + 1 WHERE day = NEW.day;
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_payments_daily_stats AFTER INSERT ON payments
+        WHEN NEW.status = 'successful'
+        BEGIN
+            INSERT INTO daily_revenue (day, currency, amount, payments)
+            VALUES ({_day_expression("NEW.")}, NEW.currency, NEW.amount, 1)
+            ON CONFLICT(day, currency) DO UPDATE SET amount = amount + excluded.amount, payments = payments + 1;
+            -- Первая успешная оплата пользователя: новый платящий в день оплаты
+            -- и конверсия в день регистрации (поиск идет по idx_payments_user_id).
+            INSERT INTO daily_stats (day, paying_users)
+            SELECT {_day_expression("NEW.")}, 1
+            WHERE NOT EXISTS (SELECT 1 FROM payments
+                              WHERE user_id = NEW.user_id AND status = 'successful' AND id <> NEW.id)
+            ON CONFLICT(day) DO UPDATE SET paying_users = paying_users + 1;
+            INSERT INTO daily_stats (day, converted_users)
+            SELECT substr(join_date, 1, 10), 1 FROM users
+            WHERE id = NEW.user_id AND join_date IS NOT NULL
+              AND NOT EXISTS (SELECT 1 FROM payments
+                              WHERE user_id = NEW.user_id AND status = 'successful' AND id <> NEW.id)
+            ON CONFLICT(day) DO UPDATE SET converted_users = converted_users + 1;
+        END
+        ''',
+    ]),
+    (8, "Напоминания об окончании подписки", [
+        # Даты в ISO8601 одного формата, поэтому строки сравниваются так же, как даты,
+        # и планировщик читает ближайшие истечения диапазоном по индексу.
+        "CREATE INDEX IF NOT EXISTS idx_users_subscription_expiry ON users (subscription_expiry_date, id)",
+        # Отправленные уведомления. Ключ включает дату истечения: после продления
+        # для новой даты напоминания отправляются заново.
+        '''
+        CREATE TABLE IF NOT EXISTS subscription_notices (
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL, -- 'reminder' или 'expired'
+            expiry_date TEXT NOT NULL,
+            sent_ts INTEGER NOT NULL,
+            PRIMARY KEY (user_id, kind, expiry_date)
+        ) WITHOUT ROWID
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_subscription_notices_sent_ts ON subscription_notices (sent_ts)",
+    ]),
+    (9, "Рассылки администратора с сохранением прогресса", [
+        '''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            created_by INTEGER NOT NULL, -- чат администратора, куда идут отчеты о ходе рассылки
+            created_ts INTEGER NOT NULL,
+            finished_ts INTEGER,
+            status TEXT NOT NULL, -- 'running', 'done' или 'cancelled'
+            cursor INTEGER NOT NULL DEFAULT 0, -- id пользователя, до которого (включительно) рассылка пройдена
+            sent INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            broadcast_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL, -- 'sent', 'blocked' или 'failed'
+            sent_ts INTEGER NOT NULL,
+            PRIMARY KEY (broadcast_id, user_id)
+        ) WITHOUT ROWID
+        ''',
+    ]),
+    (10, "Реестр выставленных счетов для проверки pre-checkout", [
+        '''
+        CREATE TABLE IF NOT EXISTS invoices (
+            payload TEXT PRIMARY KEY, -- invoice_payload, который Telegram возвращает в pre-checkout и платеже
+            user_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL, -- Сумма в минимальных единицах
+            currency TEXT NOT NULL,
+            days INTEGER NOT NULL,
+            created_ts INTEGER NOT NULL,
+            expires_ts INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending', -- 'pending' или 'paid'
+            chat_id INTEGER, -- сообщение со счетом, чтобы при повторном запросе сослаться на него
+            message_id INTEGER
+        ) WITHOUT ROWID
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_invoices_user_status ON invoices (user_id, status, expires_ts)",
+        "CREATE INDEX IF NOT EXISTS idx_invoices_status_expires ON invoices (status, expires_ts)",
+    ]),
+    (11, "Частичные индексы строк с незаполненным ts для backfill_epoch_timestamps", [
+        # Новые строки пишутся сразу с ts, поэтому после backfill индексы пусты, и проверка
+        # при каждом запуске бота читает пустой индекс вместо всей таблицы.
+        "CREATE INDEX IF NOT EXISTS idx_dialogues_ts_null ON dialogues (id) WHERE ts IS NULL",
+        "CREATE INDEX IF NOT EXISTS idx_payments_ts_null ON payments (id) WHERE ts IS NULL",
+    ]),
+]
+
+# Таблицы, в которых колонку ts нужно заполнить по текстовой колонке timestamp.
+EPOCH_BACKFILL_TABLES = ("dialogues", "payments")
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def apply_migrations(conn: sqlite3.Connection) -> int:
+    """
+    Применяет к базе все миграции, которые новее ее текущей версии.
+    Каждая миграция выполняется в отдельной транзакции вместе с обновлением user_version.
+    Возвращает итоговую версию схемы.
+    """
+    current_version = get_schema_version(conn)
+
+    for version, description, statements in MIGRATIONS:
+        if version <= current_version:
+            continue
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            # Несколько процессов бота могут стартовать одновременно: после взятия
+            # блокировки перечитываем версию, вдруг миграцию уже применил другой процесс.
+            current_version = get_schema_version(conn)
+            if version <= current_version:
+                conn.rollback()
+                continue
+            for statement in statements:
+                conn.execute(statement)
+            # PRAGMA не поддерживает параметры, версия - целое число из списка выше.
+            conn.execute(f"PRAGMA user_version = {int(version)}")
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        current_version = version
+        log.info("Применена миграция БД", version=version, description=description)
+
+    return current_version
+
+
+def backfill_epoch_batch(conn: sqlite3.Connection, table: str, after_id: int, batch_size: int) -> int:
+    """
+    Заполняет колонку ts у строк с id в диапазоне (after_id, after_id + batch_size].
+    Диапазон по первичному ключу не требует повторного сканирования уже обработанных строк.
+    Текстовые даты записаны в локальном времени, модификатор 'utc' переводит их в UTC.
+    Возвращает количество обновленных строк.
+    """
+    if table not in EPOCH_BACKFILL_TABLES:
+        raise ValueError(f"Неизвестная таблица для заполнения ts: {table}")
+    try:
+        cursor = conn.execute(f"""
+            UPDATE {table}
+            SET ts = COALESCE(CAST(strftime('%s', timestamp, 'utc') AS INTEGER), 0)
+            WHERE id > ? AND id <= ? AND ts IS NULL
+        """, (after_id, after_id + batch_size))
+        conn.commit()
+        return cursor.rowcount
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+
+
+def _backfill_range(pool, table: str) -> tuple[int, int]:
+    # Границы id строк, у которых ts еще не заполнен. Новые строки пишутся уже с ts.
+    # Условие совпадает с частичным индексом из миграции 11, поэтому таблица не сканируется.
+    row = pool.connection().execute(f"SELECT MIN(id), MAX(id) FROM {table} WHERE ts IS NULL").fetchone()
+    return (row[0] or 0, row[1] or 0)
+
+
+def _backfill_with_pool(pool, table: str, after_id: int, batch_size: int) -> int:
+    return backfill_epoch_batch(pool.connection(), table, after_id, batch_size)
+
+
+async def backfill_epoch_timestamps(pool, batch_size: int = 1000, pause: float = 0.05):
+    """
+    Онлайн-заполнение колонки ts для строк, созданных до миграции 3.
+    Работает небольшими порциями с паузами, чтобы не мешать обработке сообщений.
+    """
+    for table in EPOCH_BACKFILL_TABLES:
+        min_id, max_id = await pool.run(_backfill_range, pool, table)
+        if not max_id:
+            continue
+        total = 0
+        after_id = min_id - 1
+        while after_id < max_id:
+            total += await pool.run(_backfill_with_pool, pool, table, after_id, batch_size)
+            after_id += batch_size
+            await asyncio.sleep(pause)
+        log.info("Заполнены метки времени ts", table=table, rows=total)
@@ -0,0 +1,34 @@
+# Общий асинхронный клиент хранилища с протоколом Redis (Redis, KeyDB, Valkey и т.п.).
+# Пакет redis нужен только если хранилище действительно используется.
+# Адрес вида fakeredis:// включает локальную подделку из пакета fakeredis - для проверки без сервера.
+
+_redis = None
+
+
+def get_redis(url: str):
+    """
+    Возвращает общий клиент для url, создавая его при первом обращении.
+    Соединение устанавливается лениво, при первой команде.
+    """
+    global _redis
+    if _redis is None:
+        if url.startswith("fakeredis://"):
+            try:
+                from fakeredis import FakeAsyncRedis
+            except ImportError:
+                raise RuntimeError("Для REDIS_URL=fakeredis:// нужен пакет fakeredis (pip install fakeredis).")
+            _redis = FakeAsyncRedis()
+        else:
+            try:
+                from redis.asyncio import Redis
+            except ImportError:
+                raise RuntimeError("Для работы с Redis нужен пакет redis (pip install redis).")
+            _redis = Redis.from_url(url)
+    return _redis
+
+
+async def close_redis():
+    global _redis
+    if _redis is not None:
+        await _redis.aclose()
+        _redis = None
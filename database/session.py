@@ -0,0 +1,41 @@
+from typing import Any, Callable
+
+from database.pool import ConnectionPool
+
+
+class DBSession:
+    """
+    Единица работы с БД на одно обновление Telegram.
+
+    Соединения уже живут в пуле, поэтому сессия не держит отдельное соединение и транзакцию
+    на все обновление (иначе блокировка записи держалась бы, пока модель готовит ответ). Вместо этого:
+    - cache - данные, прочитанные за время обновления (например, строка пользователя):
+      повторные обращения обработчиков не идут ни в кэш пользователей, ни в БД;
+    - atomic - несколько изменений, которые должны сохраниться вместе, в одной транзакции.
+    """
+
+    __slots__ = ("pool", "cache")
+
+    def __init__(self, pool: ConnectionPool):
+        self.pool = pool
+        self.cache: dict[Any, Any] = {}
+
+    async def atomic(self, func: Callable, *args):
+        """
+        Выполняет func(conn, *args) в потоке пула внутри BEGIN IMMEDIATE: изменения фиксируются
+        вместе, а при исключении откатываются. Ошибки sqlite3 пробрасываются.
+        """
+        def run_in_transaction():
+            conn = self.pool.connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(conn, *args)
+                conn.commit()
+                return result
+            except BaseException:
+                conn.rollback()
+                raise
+
+        # Метрики БД группируются по имени функции.
+        run_in_transaction.__name__ = getattr(func, "__name__", "atomic")
+        return await self.pool.run(run_in_transaction)
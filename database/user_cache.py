@@ -0,0 +1,142 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import NamedTuple
+
+from log_config import get_logger
+
+log = get_logger(__name__)
+
+
+class CachedUser(NamedTuple):
+    # Строка users как ее возвращает get_user: (id, full_name, username, join_date, subscription_expiry_date)
+    row: tuple
+    # Уже разобранная дата окончания подписки (None, если ее нет или формат некорректный).
+    expiry: datetime | None
+    # Момент (time.monotonic), после которого запись считается устаревшей.
+    expires_at: float
+
+
+def parse_expiry(expiry_date_str: str | None) -> datetime | None:
+    if not expiry_date_str:
+        return None
+    try:
+        return datetime.fromisoformat(expiry_date_str)
+    except (ValueError, TypeError):
+        return None
+
+
+class UserCache:
+    """
+    Ограниченный LRU-кэш строк users с временем жизни записей (TTL).
+
+    Хранит строку пользователя вместе с разобранной датой окончания подписки,
+    чтобы проверка подписки на каждом сообщении не ходила в БД.
+    Потокобезопасен: используется и из цикла событий, и из потоков БД.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 300.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._entries: OrderedDict[int, CachedUser] = OrderedDict()
+        self._lock = threading.Lock()
+        # Увеличивается при каждой инвалидации. Загрузка из БД, начатая до инвалидации,
+        # не должна положить в кэш устаревшую строку.
+        self._generation = 0
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self, user_id: int) -> CachedUser | None:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry.expires_at <= time.monotonic():
+                if entry is not None:
+                    del self._entries[user_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry
+
+    def put(self, user_id: int, row: tuple, generation: int | None = None) -> CachedUser:
+        """
+        Кладет строку пользователя в кэш. Если передан generation и с тех пор была
+        инвалидация, запись не сохраняется (но все равно возвращается вызывающему).
+        """
+        entry = CachedUser(row, parse_expiry(row[4]), time.monotonic() + self.ttl)
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return entry
+            self._entries[user_id] = entry
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+class SharedUserCache:
+    """
+    Кэш строк users во внешнем хранилище с протоколом Redis, общий для всех процессов бота.
+
+    В отличие от UserCache, инвалидация здесь видна сразу всем процессам,
+    поэтому оплата, обработанная одним воркером, сразу учитывается остальными.
+    """
+
+    def __init__(self, redis, ttl: float = 300.0, prefix: str = "psysup:user:"):
+        self.redis = redis
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+
+    # Недоступность хранилища не должна ломать обработку сообщений:
+    # при ошибке считаем, что в кэше ничего нет, и идем в БД.
+
+    async def get(self, user_id: int) -> CachedUser | None:
+        try:
+            raw = await self.redis.get(f"{self.prefix}{user_id}")
+        except Exception as e:
+            log.warning("Ошибка чтения общего кэша пользователей", error=e)
+            raw = None
+        if raw is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        row = tuple(json.loads(raw))
+        return CachedUser(row, parse_expiry(row[4]), time.monotonic() + self.ttl)
+
+    async def put(self, user_id: int, row: tuple):
+        try:
+            await self.redis.set(f"{self.prefix}{user_id}", json.dumps(row, ensure_ascii=False), ex=int(self.ttl))
+        except Exception as e:
+            log.warning("Ошибка записи в общий кэш пользователей", error=e)
+
+    async def invalidate(self, user_id: int):
+        try:
+            await self.redis.delete(f"{self.prefix}{user_id}")
+        except Exception as e:
+            log.warning("Ошибка инвалидации общего кэша пользователей", error=e)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
@@ -0,0 +1,135 @@
+import asyncio
+import sqlite3
+import threading
+from datetime import datetime
+
+from log_config import get_logger
+
+log = get_logger(__name__)
+
+# Строка буфера: (user_id, message_text, timestamp ISO, ts epoch, sender)
+BufferedRow = tuple[int, str, str, int, str]
+
+
+class DialogueWriteBuffer:
+    """
+    Буфер отложенной записи сообщений диалога (write-behind).
+
+    Сообщения копятся в памяти и записываются в dialogues одной транзакцией
+    раз в flush_interval секунд или как только накопится max_rows строк.
+    Пока строки не закоммичены, они видны читателям через recent_with_pending,
+    поэтому пользователь всегда видит свои только что отправленные сообщения.
+    """
+
+    def __init__(self, pool, flush_interval: float = 0.05, max_rows: int = 100):
+        self.pool = pool
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+
+        # Новые строки, еще не переданные на запись.
+        self._pending: list[BufferedRow] = []
+        # Строки, которые прямо сейчас пишутся в БД.
+        self._flushing: list[BufferedRow] = []
+        # _pending_lock защищает оба списка и держится очень коротко.
+        # _commit_lock делает "запись + очистку _flushing" атомарной для читателей.
+        self._pending_lock = threading.Lock()
+        self._commit_lock = threading.Lock()
+
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def add(self, user_id: int, message_text: str, sender: str):
+        """
+        Ставит сообщение в очередь на запись. Не блокирует и не ждет коммита.
+        """
+        now = datetime.now()
+        with self._pending_lock:
+            self._pending.append((user_id, message_text, now.isoformat(), int(now.timestamp()), sender))
+            pending_count = len(self._pending)
+        if pending_count >= self.max_rows and self._wakeup is not None:
+            self._wakeup.set()
+
+    def recent_with_pending(self, user_id: int, limit: int, read_db) -> list[tuple]:
+        """
+        Возвращает последние limit сообщений пользователя с учетом еще не записанных строк.
+        read_db() должна вернуть историю из БД в хронологическом порядке.
+        Вызывается из потока БД.
+        """
+        with self._commit_lock:
+            rows = read_db()
+            with self._pending_lock:
+                buffered = [(text, timestamp, sender)
+                            for row_user_id, text, timestamp, ts, sender in self._flushing + self._pending
+                            if row_user_id == user_id]
+        if not buffered:
+            return rows
+        return (rows + buffered)[-limit:]
+
+    def _write_batch(self) -> int:
+        # Выполняется в потоке БД: переносим накопленные строки в _flushing и пишем их одной транзакцией.
+        with self._commit_lock:
+            with self._pending_lock:
+                self._flushing, self._pending = self._pending, []
+                batch = self._flushing
+            if not batch:
+                return 0
+
+            conn = self.pool.connection()
+            try:
+                conn.executemany(
+                    "INSERT INTO dialogues (user_id, message_text, timestamp, ts, sender) VALUES (?, ?, ?, ?, ?)",
+                    batch,
+                )
+                conn.commit()
+            except sqlite3.Error as e:
+                conn.rollback()
+                # Возвращаем строки в начало очереди, чтобы повторить запись при следующем сбросе.
+                with self._pending_lock:
+                    self._pending = batch + self._pending
+                    self._flushing = []
+                log.error("Ошибка при групповой записи сообщений диалога", rows=len(batch), error=e)
+                return 0
+
+            with self._pending_lock:
+                self._flushing = []
+            return len(batch)
+
+    async def flush(self) -> int:
+        """
+        Немедленно записывает все накопленные сообщения. Возвращает количество записанных строк.
+        """
+        return await self.pool.run(self._write_batch)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        """
+        Запускает фоновый сброс буфера в текущем цикле событий.
+        """
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        Останавливает фоновый сброс и записывает все, что осталось в буфере.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            self._wakeup = None
+        written = await self.flush()
+        if written:
+            log.info("При остановке записаны сообщения диалога из буфера", rows=written)
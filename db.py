@@ -1,65 +1,132 @@
+import asyncio
+import os
+import secrets
 import sqlite3
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from typing import Callable
 
-DATABASE_NAME = 'psych_support_bot.db'
+from aiogram.fsm.storage.base import BaseStorage
+
+from database.archive import archive_old_dialogues, archive_stats, attach_archive, read_history_page
+from database.dialogue_cache import DialogueContextCache, to_chat_message
+from database.fsm_storage import BoundedMemoryStorage, SQLiteStorage
+from database.invoices import InvoiceRegistry, PendingInvoice
+from database.migrations import apply_migrations, backfill_epoch_timestamps
+from database.pool import ConnectionPool
+from database.redis_client import close_redis, get_redis
+from database.session import DBSession
+from database.user_cache import CachedUser, SharedUserCache, UserCache
+from database.write_buffer import DialogueWriteBuffer
+from log_config import get_logger
+from metrics import CACHE_HITS, CACHE_MISSES, DB_LATENCY, DB_QUEUE_WAIT, DIALOGUE_ARCHIVED, register_collector
+
+log = get_logger(__name__)
+
+DATABASE_NAME = os.getenv("DATABASE_NAME", 'psych_support_bot.db')
 FREE_TRIAL_DAYS = 2
 SUBSCRIPTION_DAYS_PER_PAYMENT = 30
 
+# Количество потоков (и соединений), в которых выполняются запросы из асинхронных хэндлеров.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+
+# Общий пул долгоживущих соединений. Соединения открываются лениво, при первом запросе.
+def _observe_db(operation: str, queue_wait: float, duration: float):
+    DB_QUEUE_WAIT.observe(queue_wait)
+    DB_LATENCY.observe(duration, operation)
+
+_pool = ConnectionPool(DATABASE_NAME, size=DB_POOL_SIZE, observer=_observe_db)
+
+# Кэш строк users с разобранной датой окончания подписки.
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+
+_user_cache = UserCache(max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+# Кто из пользователей хоть раз оплатил подписку (нужно для приоритета в очереди к модели).
+# Оплата не отменяется, поэтому "да" хранится до вытеснения, а "нет" - USER_CACHE_TTL секунд.
+_paid_users: OrderedDict[int, tuple[bool, float]] = OrderedDict()
+
+# --- Хранилище состояний FSM и общий кэш ---
+# FSM_STORAGE: memory - в памяти процесса (с ограничением размера и временем жизни),
+# sqlite - в этой же базе, redis - во внешнем хранилище по REDIS_URL.
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory")
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", "86400"))
+FSM_MEMORY_MAX_KEYS = int(os.getenv("FSM_MEMORY_MAX_KEYS", "100000"))
+# Адрес хранилища с протоколом Redis. fakeredis:// - локальная подделка для проверки без сервера.
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# USER_CACHE_BACKEND: memory - кэш пользователей в процессе, redis - общий для всех процессов.
+USER_CACHE_BACKEND = os.getenv("USER_CACHE_BACKEND", "memory")
+
+_shared_user_cache = (SharedUserCache(get_redis(REDIS_URL), ttl=USER_CACHE_TTL)
+                      if USER_CACHE_BACKEND == "redis" else None)
+
+# Кэш последних реплик диалога в формате сообщений OpenAI: DIALOGUE_CACHE_TURNS реплик
+# на пользователя, не больше DIALOGUE_CACHE_MAX_CHARS символов текста суммарно.
+DIALOGUE_CACHE_TURNS = int(os.getenv("DIALOGUE_CACHE_TURNS", "20"))
+DIALOGUE_CACHE_MAX_CHARS = int(os.getenv("DIALOGUE_CACHE_MAX_CHARS", "20000000"))
+# Кэш истории живет в памяти одного процесса. Когда сообщения одного пользователя
+# могут обрабатывать разные процессы (webhook с несколькими воркерами), его выключают.
+DIALOGUE_CACHE_ENABLED = os.getenv("DIALOGUE_CACHE_ENABLED", "1") == "1"
+
+_dialogue_cache = DialogueContextCache(max_turns=DIALOGUE_CACHE_TURNS, max_chars=DIALOGUE_CACHE_MAX_CHARS)
+
+# Групповая запись сообщений диалога: сброс раз в DIALOGUE_FLUSH_INTERVAL_MS мс
+# или при накоплении DIALOGUE_FLUSH_MAX_ROWS строк.
+DIALOGUE_FLUSH_INTERVAL_MS = int(os.getenv("DIALOGUE_FLUSH_INTERVAL_MS", "50"))
+DIALOGUE_FLUSH_MAX_ROWS = int(os.getenv("DIALOGUE_FLUSH_MAX_ROWS", "100"))
+
+_dialogue_buffer = DialogueWriteBuffer(_pool,
+                                       flush_interval=DIALOGUE_FLUSH_INTERVAL_MS / 1000,
+                                       max_rows=DIALOGUE_FLUSH_MAX_ROWS)
+
+# --- Архив истории диалогов ---
+# Горячее окно: у каждого пользователя в dialogues остаются последние DIALOGUE_HOT_MESSAGES сообщений
+# и все сообщения за последние DIALOGUE_HOT_DAYS дней (0 - без ограничения по времени). Более старые
+# раз в DIALOGUE_ARCHIVE_INTERVAL секунд переносятся сжатыми порциями в отдельный файл архива.
+# DIALOGUE_HOT_MESSAGES=0 выключает архивацию.
+DIALOGUE_HOT_MESSAGES = int(os.getenv("DIALOGUE_HOT_MESSAGES", "200"))
+DIALOGUE_HOT_DAYS = int(os.getenv("DIALOGUE_HOT_DAYS", "30"))
+DIALOGUE_ARCHIVE_DATABASE = os.getenv("DIALOGUE_ARCHIVE_DATABASE",
+                                      f"{os.path.splitext(DATABASE_NAME)[0]}_archive.db")
+DIALOGUE_ARCHIVE_INTERVAL = float(os.getenv("DIALOGUE_ARCHIVE_INTERVAL", "3600"))
+# Сообщений в одной сжатой порции архива.
+DIALOGUE_ARCHIVE_CHUNK_ROWS = 500
+
+# --- Реестр счетов ---
+# Выставленный счет можно оплатить в течение INVOICE_TTL секунд. Пока он действует, повторный запрос
+# оплаты ссылается на него, а pre-checkout сверяет пользователя, сумму и валюту с записью реестра.
+INVOICE_TTL = int(os.getenv("INVOICE_TTL", str(24 * 3600)))
+# Неоплаченные счета, истекшие больше суток назад, удаляются из таблицы не чаще раза в час.
+INVOICE_PRUNE_INTERVAL = 3600
+
+# Реестр неоплаченных счетов в памяти - источник правды, только когда бот работает в одном процессе:
+# тогда все оплаты записывает этот процесс и сразу убирает счет из реестра. С несколькими
+# воркерами счет мог оплатить другой процесс, поэтому main выключает реестр и счета читаются из БД.
+INVOICE_REGISTRY_ENABLED = os.getenv("INVOICE_REGISTRY_ENABLED", "1") == "1"
+
+_invoices = InvoiceRegistry() if INVOICE_REGISTRY_ENABLED else None
+_invoices_pruned_at = 0.0
+
+# Подписчики на изменение даты окончания подписки в этом процессе: callback(user_id, новая дата).
+# Через них планировщик напоминаний переставляет таймеры без чтения БД.
+_subscription_listeners: list[Callable[[int, datetime], None]] = []
+
 def init_db():
     """
-    Инициализирует базу данных: создает файл и таблицы, если они не существуют.
+    Инициализирует базу данных: создает файл и приводит схему к последней версии миграций.
     """
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
+    conn = _pool.connection()
+    version = apply_migrations(conn)
+    log.info("База данных инициализирована", schema_version=version)
 
-    # Создаем таблицу users
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY, -- Telegram User ID
-            full_name TEXT,
-            username TEXT,
-            join_date TEXT, -- Храним дату как текст в формате ISO8601
-            subscription_expiry_date TEXT
-        )
-    ''')
-
-    # Создаем таблицу dialogues
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS dialogues (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            message_text TEXT,
-            timestamp TEXT, -- Храним дату как текст в формате ISO8601
-            sender TEXT, -- 'user' или 'bot'
-            FOREIGN KEY (user_id) REFERENCES users(id) -- Связываем с таблицей users
-        )
-    ''')
-
-    # Создаем таблицу payments
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS payments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            amount INTEGER, -- Сумма в минимальных единицах
-            currency TEXT,
-            timestamp TEXT, -- Храним дату как текст в формате ISO8601
-            status TEXT,
-            telegram_charge_id TEXT,
-            provider_charge_id TEXT,
-            invoice_payload TEXT,
-            FOREIGN KEY (user_id) REFERENCES users(id) -- Связываем с таблицей users
-        )
-    ''')
-
-    conn.commit()
-    conn.close()
-    print("База данных инициализирована.")
-
-def add_user(user_id: int, full_name: str, username: str | None):
+def add_user(user_id: int, full_name: str, username: str | None) -> datetime | None:
     """
     Добавляет нового пользователя в базу данных, если его там нет.
+    Возвращает дату окончания пробного периода нового пользователя или None.
     """
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = _pool.connection()
     cursor = conn.cursor()
     try:
         cursor.execute("SELECT id FROM users WHERE id = ?", (user_id,))
@@ -73,126 +140,182 @@ def add_user(user_id: int, full_name: str, username: str | None):
             cursor.execute("INSERT INTO users (id, full_name, username, join_date, subscription_expiry_date) VALUES (?, ?, ?, ?, ?)",
                            (user_id, full_name, username, now_iso, expiry_date_iso))
             conn.commit()
-            print(f"Добавлен новый пользователь: {user_id}")
+            _user_cache.invalidate(user_id)
+            log.info("Добавлен новый пользователь", user_id=user_id)
+            return expiry_date
         else:
-            print(f"Пользователь {user_id} уже существует.")
+            log.debug("Пользователь уже существует", user_id=user_id)
 
     except sqlite3.Error as e:
-        print(f"Ошибка при добавлении пользователя: {e}")
+        conn.rollback()
+        log.error("Ошибка при добавлении пользователя", user_id=user_id, error=e)
     finally:
-        conn.close()
+        cursor.close()
 
-def get_user(user_id: int):
-    """
-    Получает данные пользователя по его ID.
-    Возвращает кортеж с данными или None, если пользователь не найден.
-    """
-    conn = sqlite3.connect(DATABASE_NAME)
+def _fetch_user(user_id: int) -> CachedUser | None:
+    # Читает строку пользователя из БД и кладет ее в кэш. Ошибки sqlite3 пробрасываются вызывающему.
+    generation = _user_cache.generation
+    conn = _pool.connection()
     cursor = conn.cursor()
     try:
         cursor.execute("SELECT id, full_name, username, join_date, subscription_expiry_date FROM users WHERE id = ?", (user_id,))
         user_data = cursor.fetchone()
-        return user_data
+    finally:
+        cursor.close()
+    if user_data is None:
+        return None
+    return _user_cache.put(user_id, user_data, generation)
+
+def _get_user_uncached(user_id: int):
+    try:
+        entry = _fetch_user(user_id)
+        return entry.row if entry is not None else None
     except sqlite3.Error as e:
-        print(f"Ошибка при получении пользователя: {e}")
+        log.error("Ошибка при получении пользователя", user_id=user_id, error=e)
         return None
-    finally:
-        conn.close()
+
+def get_user(user_id: int):
+    """
+    Получает данные пользователя по его ID (сначала из кэша, затем из БД).
+    Возвращает кортеж с данными или None, если пользователь не найден.
+    """
+    entry = _user_cache.get(user_id)
+    if entry is not None:
+        return entry.row
+    return _get_user_uncached(user_id)
 
 def update_user_name(user_id: int, new_name: str):
     """
     Обновляет full_name пользователя в базе данных.
     """
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = _pool.connection()
     cursor = conn.cursor()
     try:
         cursor.execute("UPDATE users SET full_name = ? WHERE id = ?", (new_name, user_id))
         conn.commit()
-        print(f"Имя пользователя {user_id} обновлено на '{new_name}'.")
+        _user_cache.invalidate(user_id)
+        log.debug("Имя пользователя обновлено", user_id=user_id)
         return True
     except sqlite3.Error as e:
-        print(f"Ошибка при обновлении имени пользователя: {e}")
+        conn.rollback()
+        log.error("Ошибка при обновлении имени пользователя", user_id=user_id, error=e)
         return False
     finally:
-        conn.close()
+        cursor.close()
 
-def get_recent_dialogue(user_id: int, limit: int = 20) -> list[tuple]:
-    """
-    Получает последние 'limit' сообщений диалога для пользователя из таблицы dialogues.
-    Возвращает список кортежей (message_text, timestamp, sender), отсортированных по времени.
-    """
-    conn = sqlite3.connect(DATABASE_NAME)
+def _read_recent_dialogue(user_id: int, limit: int) -> list[tuple]:
+    conn = _pool.connection()
     cursor = conn.cursor()
     try:
         cursor.execute("""
             SELECT message_text, timestamp, sender
             FROM dialogues
             WHERE user_id = ?
-            ORDER BY timestamp DESC -- Получаем сначала самые новые
+            ORDER BY id DESC -- Получаем сначала самые новые (идет по индексу idx_dialogues_user_id_id)
             LIMIT ? -- Ограничиваем количество
         """, (user_id, limit))
         dialogue_history = cursor.fetchall()
         dialogue_history.reverse() # Разворачиваем, чтобы получить в хронологическом порядке
         return dialogue_history
+    finally:
+        cursor.close()
+
+def get_recent_dialogue(user_id: int, limit: int = 20) -> list[tuple]:
+    """
+    Получает последние 'limit' сообщений диалога для пользователя из таблицы dialogues.
+    Учитывает сообщения, которые еще лежат в буфере отложенной записи.
+    Возвращает список кортежей (message_text, timestamp, sender), отсортированных по времени.
+    """
+    try:
+        return _dialogue_buffer.recent_with_pending(user_id, limit,
+                                                    lambda: _read_recent_dialogue(user_id, limit))
     except sqlite3.Error as e:
-        print(f"Ошибка при получении истории диалога для пользователя {user_id}: {e}")
+        log.error("Ошибка при получении истории диалога", user_id=user_id, error=e)
         return []
-    finally:
-        conn.close()
 
 def add_dialogue_message(user_id: int, message_text: str, sender: str):
     """
     Добавляет сообщение диалога в базу данных.
     """
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = _pool.connection()
     cursor = conn.cursor()
     try:
-        timestamp = datetime.now().isoformat()
-        cursor.execute("INSERT INTO dialogues (user_id, message_text, timestamp, sender) VALUES (?, ?, ?, ?)",
-                       (user_id, message_text, timestamp, sender))
+        now = datetime.now()
+        cursor.execute("INSERT INTO dialogues (user_id, message_text, timestamp, ts, sender) VALUES (?, ?, ?, ?, ?)",
+                       (user_id, message_text, now.isoformat(), int(now.timestamp()), sender))
         conn.commit()
-        print(f"Добавлено сообщение от {sender} для пользователя {user_id}")
+        _dialogue_cache.append(user_id, to_chat_message(message_text, sender))
+        log.debug("Добавлено сообщение диалога", user_id=user_id, sender=sender)
     except sqlite3.Error as e:
-        print(f"Ошибка при добавлении сообщения диалога: {e}")
+        conn.rollback()
+        log.error("Ошибка при добавлении сообщения диалога", user_id=user_id, error=e)
     finally:
-        conn.close()
+        cursor.close()
+
+def _is_expired(user_id: int, entry: CachedUser | None) -> bool:
+    if entry is None:
+        log.debug("is_subscription_expired: пользователь не найден", user_id=user_id)
+        return True
+
+    # Если subscription_expiry_date NULL, пустая строка или в некорректном формате, считаем, что истек
+    if entry.expiry is None:
+        log.debug("is_subscription_expired: пустой или некорректный subscription_expiry_date", user_id=user_id,
+                  value=entry.row[4])
+        return True
+
+    # Сравниваем текущее время с уже разобранной датой истечения
+    return datetime.now() >= entry.expiry # Подписка истекла, если текущее время >= времени истечения
+
+def _is_subscription_expired_uncached(user_id: int) -> bool:
+    try:
+        return _is_expired(user_id, _fetch_user(user_id))
+    except sqlite3.Error as e:
+        log.error("is_subscription_expired: ошибка БД", user_id=user_id, error=e)
+        return True # В случае ошибки БД тоже считаем, что истек
 
 def is_subscription_expired(user_id: int) -> bool:
     """
     Проверяет, истекла ли подписка пользователя (т.е., текущая дата >= subscription_expiry_date).
+    Дата истечения берется из кэша пользователей, в БД идем только при промахе.
     """
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    try:
-        cursor.execute("SELECT subscription_expiry_date FROM users WHERE id = ?", (user_id,))
-        result = cursor.fetchone()
-        if result is None:
-            print(f"DEBUG: is_subscription_expired: Пользователь {user_id} не найден.")
-            return True
+    entry = _user_cache.get(user_id)
+    # Если по кэшу подписка истекла, перепроверяем по БД: ее могли продлить в другом процессе.
+    if entry is not None and not _is_expired(user_id, entry):
+        return False
+    return _is_subscription_expired_uncached(user_id)
 
-        expiry_date_str = result[0]
+def _extend_subscription(conn: sqlite3.Connection, user_id: int, days_to_add: int) -> datetime | None:
+    # Продление внутри транзакции вызывающего; None - пользователь не найден.
+    result = conn.execute("SELECT subscription_expiry_date FROM users WHERE id = ?", (user_id,)).fetchone()
+    if result is None:
+        log.warning("extend_subscription: пользователь не найден", user_id=user_id)
+        return None
 
-        # Если subscription_expiry_date NULL или пустая строка, считаем, что истек
-        if not expiry_date_str:
-            print(f"DEBUG: is_subscription_expired: subscription_expiry_date для пользователя {user_id} = NULL/пусто.")
-            return True
+    current_expiry_date_str = result[0]
+    now = datetime.now()
+
+    # Определяем, с какой даты начинать продление
+    start_date_for_extension = now # По умолчанию начинаем с текущей даты
 
-        # Парсим дату истечения
+    if current_expiry_date_str:
         try:
-            expiry_date = datetime.fromisoformat(expiry_date_str)
+            current_expiry_date = datetime.fromisoformat(current_expiry_date_str)
+            # Если текущая дата истечения в будущем, продлеваем с нее
+            if current_expiry_date > now:
+                start_date_for_extension = current_expiry_date
         except (ValueError, TypeError):
-             print(f"DEBUG: is_subscription_expired: Некорректный формат subscription_expiry_date для пользователя {user_id}: {expiry_date_str}")
-             return True
+            log.warning("extend_subscription: некорректный формат текущей даты истечения", user_id=user_id,
+                        value=current_expiry_date_str)
+            # Если формат некорректен, начинаем продление с текущей даты (start_date_for_extension уже = now)
 
-        # Сравниваем текущее время с датой истечения
-        now = datetime.now()
-        return now >= expiry_date # Подписка истекла, если текущее время >= времени истечения
 
-    except sqlite3.Error as e:
-        print(f"DEBUG: is_subscription_expired: Ошибка БД для пользователя {user_id}: {e}")
-        return True # В случае ошибки БД тоже считаем, что истек
-    finally:
-        conn.close()
+    # Вычисляем новую дату истечения
+    new_expiry_date = start_date_for_extension + timedelta(days=days_to_add)
+    new_expiry_date_iso = new_expiry_date.isoformat()
+
+    # Обновляем дату истечения в БД
+    conn.execute("UPDATE users SET subscription_expiry_date = ? WHERE id = ?", (new_expiry_date_iso, user_id))
+    return new_expiry_date
 
 def extend_subscription(user_id: int, days_to_add: int) -> datetime | None:
     """
@@ -201,67 +324,846 @@ def extend_subscription(user_id: int, days_to_add: int) -> datetime | None:
     иначе - с текущей даты.
     Возвращает новую дату истечения (datetime) или None в случае ошибки.
     """
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
+    conn = _pool.connection()
     try:
-        cursor.execute("SELECT subscription_expiry_date FROM users WHERE id = ?", (user_id,))
-        result = cursor.fetchone()
-        if result is None:
-            print(f"DEBUG: extend_subscription: Пользователь {user_id} не найден.")
+        # Берем блокировку на запись сразу, чтобы параллельные продления не затерли друг друга.
+        conn.execute("BEGIN IMMEDIATE")
+        new_expiry_date = _extend_subscription(conn, user_id, days_to_add)
+        if new_expiry_date is None:
+            conn.rollback()
             return None
+        conn.commit()
+        _user_cache.invalidate(user_id)
+        log.info("Подписка пользователя продлена", user_id=user_id, expires=new_expiry_date.isoformat())
+        return new_expiry_date
 
-        current_expiry_date_str = result[0]
-        now = datetime.now()
+    except sqlite3.Error as e:
+        conn.rollback()
+        log.error("Ошибка БД при продлении подписки", user_id=user_id, error=e)
+        return None
 
-        # Определяем, с какой даты начинать продление
-        start_date_for_extension = now # По умолчанию начинаем с текущей даты
+def _insert_payment(conn: sqlite3.Connection, user_id: int, amount: int, currency: str, status: str,
+                    telegram_charge_id: str | None, provider_charge_id: str | None, invoice_payload: str | None):
+    now = datetime.now()
+    conn.execute("""
+        INSERT INTO payments (user_id, amount, currency, timestamp, ts, status,
+                             telegram_charge_id, provider_charge_id, invoice_payload)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (user_id, amount, currency, now.isoformat(), int(now.timestamp()), status,
+          telegram_charge_id, provider_charge_id, invoice_payload))
 
-        if current_expiry_date_str:
-            try:
-                current_expiry_date = datetime.fromisoformat(current_expiry_date_str)
-                # Если текущая дата истечения в будущем, продлеваем с нее
-                if current_expiry_date > now:
-                    start_date_for_extension = current_expiry_date
-            except (ValueError, TypeError):
-                print(f"DEBUG: extend_subscription: Некорректный формат текущей даты истечения для {user_id}: {current_expiry_date_str}")
-                # Если формат некорректен, начинаем продление с текущей даты (start_date_for_extension уже = now)
+def add_payment(user_id: int, amount: int, currency: str, status: str,
+                telegram_charge_id: str | None = None, provider_charge_id: str | None = None,
+                invoice_payload: str | None = None):
+    """
+    Добавляет запись о платеже в базу данных.
+    """
+    conn = _pool.connection()
+    try:
+        _insert_payment(conn, user_id, amount, currency, status,
+                        telegram_charge_id, provider_charge_id, invoice_payload)
+        conn.commit()
+        log.info("Добавлена запись о платеже", user_id=user_id, status=status)
+    except sqlite3.Error as e:
+        conn.rollback()
+        log.error("Ошибка при добавлении записи о платеже", user_id=user_id, error=e)
 
+def record_successful_payment(conn: sqlite3.Connection, user_id: int, amount: int, currency: str,
+                              telegram_charge_id: str, provider_charge_id: str | None,
+                              invoice_payload: str | None, days_to_add: int) -> tuple[datetime | None, bool]:
+    """
+    Сохраняет успешный платеж и продлевает подписку в транзакции вызывающего (DBSession.atomic).
+    Платеж с тем же telegram_charge_id учитывается один раз: повторное уведомление о нем
+    (например, повторная доставка обновления) подписку не продлевает.
+    Подписка продлевается на срок из счета, проверенного при pre-checkout; days_to_add
+    используется, только если счета с таким payload нет.
+    Возвращает (дата окончания подписки, был ли платеж записан сейчас).
+    """
+    if conn.execute("SELECT 1 FROM payments WHERE telegram_charge_id = ? AND status = 'successful' LIMIT 1",
+                    (telegram_charge_id,)).fetchone():
+        row = conn.execute("SELECT subscription_expiry_date FROM users WHERE id = ?", (user_id,)).fetchone()
+        try:
+            return (datetime.fromisoformat(row[0]) if row and row[0] else None), False
+        except ValueError:
+            return None, False
+
+    _insert_payment(conn, user_id, amount, currency, "successful",
+                    telegram_charge_id, provider_charge_id, invoice_payload)
+    invoice = conn.execute("SELECT days FROM invoices WHERE payload = ?", (invoice_payload,)).fetchone()
+    if invoice is not None:
+        days_to_add = invoice[0]
+        conn.execute("UPDATE invoices SET status = 'paid' WHERE payload = ?", (invoice_payload,))
+    return _extend_subscription(conn, user_id, days_to_add), True
+
+def has_successful_payment(user_id: int) -> bool:
+    """
+    Проверяет, есть ли у пользователя успешный платеж, то есть продлевалась ли
+    его подписка оплатой, а не только пробным периодом.
+    """
+    try:
+        row = _pool.connection().execute(
+            "SELECT 1 FROM payments WHERE user_id = ? AND status = 'successful' LIMIT 1", (user_id,)
+        ).fetchone()
+        return row is not None
+    except sqlite3.Error as e:
+        log.error("Ошибка при проверке платежей пользователя", user_id=user_id, error=e)
+        return False
 
-        # Вычисляем новую дату истечения
-        new_expiry_date = start_date_for_extension + timedelta(days=days_to_add)
-        new_expiry_date_iso = new_expiry_date.isoformat()
+def get_daily_stats(since_day: str) -> list[tuple]:
+    """
+    Возвращает дневные агрегаты начиная с since_day (YYYY-MM-DD) по возрастанию дня: кортежи
+    (day, new_users, active_users, messages, user_messages, paying_users, converted_users).
+    Агрегаты обновляются триггерами при вставке в users, dialogues и payments.
+    """
+    try:
+        return _pool.connection().execute("""
+            SELECT day, new_users, active_users, messages, user_messages, paying_users, converted_users
+            FROM daily_stats WHERE day >= ? ORDER BY day
+        """, (since_day,)).fetchall()
+    except sqlite3.Error as e:
+        log.error("Ошибка при получении дневной статистики", error=e)
+        return []
 
-        # Обновляем дату истечения в БД
-        cursor.execute("UPDATE users SET subscription_expiry_date = ? WHERE id = ?", (new_expiry_date_iso, user_id))
+def get_daily_revenue(since_day: str) -> list[tuple]:
+    """
+    Возвращает выручку по дням и валютам начиная с since_day: кортежи (day, currency, amount, payments),
+    amount - в минимальных единицах валюты.
+    """
+    try:
+        return _pool.connection().execute(
+            "SELECT day, currency, amount, payments FROM daily_revenue WHERE day >= ? ORDER BY day, currency",
+            (since_day,),
+        ).fetchall()
+    except sqlite3.Error as e:
+        log.error("Ошибка при получении выручки по дням", error=e)
+        return []
+
+def get_expiring_subscriptions(after: tuple[str, int], until: str, limit: int) -> list[tuple] | None:
+    """
+    Возвращает до limit пользователей, у которых подписка заканчивается после after
+    (пара (дата ISO8601, id) - ключ последней прочитанной строки) и не позже until,
+    по возрастанию даты: кортежи (user_id, subscription_expiry_date, отправлено ли напоминание,
+    отправлено ли уведомление об окончании), или None при ошибке БД.
+    Читается диапазон индекса, а не вся таблица users.
+    """
+    try:
+        return _pool.connection().execute("""
+            SELECT u.id, u.subscription_expiry_date,
+                   EXISTS (SELECT 1 FROM subscription_notices n WHERE n.user_id = u.id
+                           AND n.kind = 'reminder' AND n.expiry_date = u.subscription_expiry_date),
+                   EXISTS (SELECT 1 FROM subscription_notices n WHERE n.user_id = u.id
+                           AND n.kind = 'expired' AND n.expiry_date = u.subscription_expiry_date)
+            FROM users u
+            WHERE (u.subscription_expiry_date, u.id) > (?, ?) AND u.subscription_expiry_date <= ?
+            ORDER BY u.subscription_expiry_date, u.id
+            LIMIT ?
+        """, (after[0], after[1], until, limit)).fetchall()
+    except sqlite3.Error as e:
+        log.error("Ошибка при получении истекающих подписок", error=e)
+        return None
+
+def get_subscription_expiries(user_ids: list[int]) -> dict[int, str | None] | None:
+    """
+    Возвращает текущие даты окончания подписки пользователей {user_id: дата ISO8601}
+    или None при ошибке БД.
+    """
+    if not user_ids:
+        return {}
+    placeholders = ", ".join("?" * len(user_ids))
+    try:
+        return dict(_pool.connection().execute(
+            f"SELECT id, subscription_expiry_date FROM users WHERE id IN ({placeholders})", user_ids,
+        ).fetchall())
+    except sqlite3.Error as e:
+        log.error("Ошибка при получении дат окончания подписки", error=e)
+        return None
+
+def record_subscription_notices(notices: list[tuple[int, str, str]]) -> bool:
+    """
+    Отмечает отправленные уведомления об окончании подписки: кортежи (user_id, kind, expiry_date).
+    """
+    conn = _pool.connection()
+    sent_ts = int(time.time())
+    try:
+        conn.executemany(
+            "INSERT OR IGNORE INTO subscription_notices (user_id, kind, expiry_date, sent_ts) VALUES (?, ?, ?, ?)",
+            [(user_id, kind, expiry_date, sent_ts) for user_id, kind, expiry_date in notices],
+        )
         conn.commit()
-        print(f"DEBUG: Подписка пользователя {user_id} продлена. Новая дата истечения: {new_expiry_date_iso}.")
-        return new_expiry_date
+        return True
+    except sqlite3.Error as e:
+        conn.rollback()
+        log.error("Ошибка при сохранении отправленных уведомлений", count=len(notices), error=e)
+        return False
+
+def prune_subscription_notices(before_ts: int) -> int:
+    """
+    Удаляет отметки об уведомлениях, отправленных раньше before_ts. Возвращает число удаленных строк.
+    """
+    conn = _pool.connection()
+    try:
+        deleted = conn.execute("DELETE FROM subscription_notices WHERE sent_ts < ?", (before_ts,)).rowcount
+        conn.commit()
+        return deleted
+    except sqlite3.Error as e:
+        conn.rollback()
+        log.error("Ошибка при очистке отправленных уведомлений", error=e)
+        return 0
+
+# Колонки invoices в порядке полей PendingInvoice.
+_INVOICE_COLUMNS = "payload, user_id, amount, currency, days, expires_ts, chat_id, message_id"
+
+def save_invoice(invoice: PendingInvoice) -> bool:
+    conn = _pool.connection()
+    try:
+        conn.execute(f"""
+            INSERT INTO invoices ({_INVOICE_COLUMNS}, created_ts) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (*invoice, int(time.time())))
+        conn.commit()
+        return True
+    except sqlite3.Error as e:
+        conn.rollback()
+        log.error("Ошибка при сохранении счета", user_id=invoice.user_id, error=e)
+        return False
+
+def get_invoice(payload: str) -> tuple[PendingInvoice, str] | None:
+    """
+    Возвращает счет по payload и его статус ('pending' или 'paid'), или None,
+    если такого счета нет или его не удалось прочитать.
+    """
+    try:
+        row = _pool.connection().execute(
+            f"SELECT {_INVOICE_COLUMNS}, status FROM invoices WHERE payload = ?", (payload,)).fetchone()
+    except sqlite3.Error as e:
+        log.error("Ошибка при получении счета", error=e)
+        return None
+    return (PendingInvoice(*row[:-1]), row[-1]) if row else None
 
+def get_live_invoice(user_id: int, now_ts: int) -> PendingInvoice | None:
+    # Последний неоплаченный и не истекший счет пользователя.
+    try:
+        row = _pool.connection().execute(f"""
+            SELECT {_INVOICE_COLUMNS} FROM invoices
+            WHERE user_id = ? AND status = 'pending' AND expires_ts > ?
+            ORDER BY expires_ts DESC LIMIT 1
+        """, (user_id, now_ts)).fetchone()
+        return PendingInvoice(*row) if row else None
     except sqlite3.Error as e:
-        print(f"DEBUG: Ошибка БД при продлении подписки пользователя {user_id}: {e}")
+        log.error("Ошибка при поиске счета пользователя", user_id=user_id, error=e)
+        return None
+
+def set_invoice_message(payload: str, chat_id: int, message_id: int):
+    conn = _pool.connection()
+    try:
+        conn.execute("UPDATE invoices SET chat_id = ?, message_id = ? WHERE payload = ?",
+                     (chat_id, message_id, payload))
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        log.error("Ошибка при сохранении сообщения со счетом", error=e)
+
+def delete_invoice(payload: str):
+    conn = _pool.connection()
+    try:
+        conn.execute("DELETE FROM invoices WHERE payload = ? AND status = 'pending'", (payload,))
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        log.error("Ошибка при удалении счета", error=e)
+
+def prune_invoices(before_ts: int) -> int:
+    # Оплаченные счета остаются в таблице вместе с платежами.
+    conn = _pool.connection()
+    try:
+        deleted = conn.execute("DELETE FROM invoices WHERE status = 'pending' AND expires_ts < ?",
+                               (before_ts,)).rowcount
+        conn.commit()
+        return deleted
+    except sqlite3.Error as e:
+        conn.rollback()
+        log.error("Ошибка при очистке истекших счетов", error=e)
+        return 0
+
+# Колонки broadcasts, которые возвращают функции рассылок.
+_BROADCAST_COLUMNS = "id, text, created_by, created_ts, finished_ts, status, cursor, sent, blocked, failed"
+
+def create_broadcast(text: str, created_by: int) -> int | None:
+    """
+    Создает рассылку в статусе running, если другой незавершенной рассылки нет.
+    Возвращает id новой рассылки или None.
+    """
+    conn = _pool.connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        if conn.execute("SELECT 1 FROM broadcasts WHERE status = 'running'").fetchone():
+            conn.rollback()
+            return None
+        broadcast_id = conn.execute(
+            "INSERT INTO broadcasts (text, created_by, created_ts, status) VALUES (?, ?, ?, 'running')",
+            (text, created_by, int(time.time())),
+        ).lastrowid
+        conn.commit()
+        log.info("Создана рассылка", broadcast_id=broadcast_id, created_by=created_by)
+        return broadcast_id
+    except sqlite3.Error as e:
+        conn.rollback()
+        log.error("Ошибка при создании рассылки", error=e)
+        return None
+
+def get_broadcast(broadcast_id: int | None = None) -> tuple | None:
+    """
+    Возвращает рассылку по id (без id - последнюю созданную): кортеж
+    (id, text, created_by, created_ts, finished_ts, status, cursor, sent, blocked, failed) или None.
+    """
+    try:
+        if broadcast_id is None:
+            return _pool.connection().execute(
+                f"SELECT {_BROADCAST_COLUMNS} FROM broadcasts ORDER BY id DESC LIMIT 1").fetchone()
+        return _pool.connection().execute(
+            f"SELECT {_BROADCAST_COLUMNS} FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+    except sqlite3.Error as e:
+        log.error("Ошибка при получении рассылки", broadcast_id=broadcast_id, error=e)
+        return None
+
+def get_running_broadcasts() -> list[tuple]:
+    try:
+        return _pool.connection().execute(
+            f"SELECT {_BROADCAST_COLUMNS} FROM broadcasts WHERE status = 'running' ORDER BY id").fetchall()
+    except sqlite3.Error as e:
+        log.error("Ошибка при получении незавершенных рассылок", error=e)
+        return []
+
+def get_broadcast_recipients(broadcast_id: int, after_user_id: int, limit: int) -> list[int] | None:
+    """
+    Возвращает следующую страницу получателей рассылки: id пользователей больше after_user_id
+    по возрастанию, кроме тех, кому рассылка уже отправлена. None - ошибка БД.
+    """
+    try:
+        return [row[0] for row in _pool.connection().execute("""
+            SELECT id FROM users
+            WHERE id > ? AND NOT EXISTS (SELECT 1 FROM broadcast_recipients r
+                                         WHERE r.broadcast_id = ? AND r.user_id = users.id)
+            ORDER BY id
+            LIMIT ?
+        """, (after_user_id, broadcast_id, limit))]
+    except sqlite3.Error as e:
+        log.error("Ошибка при получении получателей рассылки", broadcast_id=broadcast_id, error=e)
+        return None
+
+def count_users() -> int | None:
+    try:
+        return _pool.connection().execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    except sqlite3.Error as e:
+        log.error("Ошибка при подсчете пользователей", error=e)
+        return None
+
+def save_broadcast_progress(broadcast_id: int, results: list[tuple[int, str]],
+                            cursor: int | None = None, status: str | None = None) -> bool:
+    """
+    В одной транзакции записывает статусы получателей (user_id, 'sent' | 'blocked' | 'failed'),
+    увеличивает счетчики рассылки и, если переданы, сдвигает курсор и меняет статус.
+    """
+    conn = _pool.connection()
+    now_ts = int(time.time())
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        inserted = {"sent": 0, "blocked": 0, "failed": 0}
+        for user_id, result in results:
+            # Повторная запись того же получателя (после перезапуска) счетчики не меняет.
+            if conn.execute("INSERT OR IGNORE INTO broadcast_recipients (broadcast_id, user_id, status, sent_ts) "
+                            "VALUES (?, ?, ?, ?)", (broadcast_id, user_id, result, now_ts)).rowcount:
+                inserted[result] += 1
+        conn.execute("""
+            UPDATE broadcasts
+            SET sent = sent + ?, blocked = blocked + ?, failed = failed + ?,
+                cursor = MAX(cursor, COALESCE(?, cursor)),
+                status = COALESCE(?, status),
+                finished_ts = CASE WHEN ? IS NULL OR ? = 'running' THEN finished_ts ELSE ? END
+            WHERE id = ?
+        """, (inserted["sent"], inserted["blocked"], inserted["failed"], cursor, status,
+              status, status, now_ts, broadcast_id))
+        conn.commit()
+        return True
+    except sqlite3.Error as e:
+        conn.rollback()
+        log.error("Ошибка при сохранении прогресса рассылки", broadcast_id=broadcast_id, error=e)
+        return False
+
+def add_subscription_listener(callback: Callable[[int, datetime], None]):
+    _subscription_listeners.append(callback)
+
+def remove_subscription_listener(callback: Callable[[int, datetime], None]):
+    if callback in _subscription_listeners:
+        _subscription_listeners.remove(callback)
+
+def _notify_subscription_changed(user_id: int, expiry: datetime):
+    for callback in _subscription_listeners:
+        try:
+            callback(user_id, expiry)
+        except Exception as e:
+            log.error("Ошибка в обработчике изменения подписки", user_id=user_id, error=e)
+
+def get_dialogue_summary(user_id: int) -> tuple[str, int] | None:
+    """
+    Возвращает сводку старой части диалога пользователя и id последнего учтенного
+    в ней сообщения, или None, если сводки еще нет.
+    """
+    conn = _pool.connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT summary, last_dialogue_id FROM dialogue_summaries WHERE user_id = ?", (user_id,))
+        return cursor.fetchone()
+    except sqlite3.Error as e:
+        log.error("Ошибка при получении сводки диалога", user_id=user_id, error=e)
         return None
     finally:
-        conn.close()
+        cursor.close()
 
-def add_payment(user_id: int, amount: int, currency: str, status: str,
-                telegram_charge_id: str | None = None, provider_charge_id: str | None = None,
-                invoice_payload: str | None = None):
+def save_dialogue_summary(user_id: int, summary: str, last_dialogue_id: int):
     """
-    Добавляет запись о платеже в базу данных.
+    Сохраняет (или заменяет) сводку старой части диалога пользователя.
     """
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = _pool.connection()
     cursor = conn.cursor()
     try:
-        timestamp = datetime.now().isoformat()
         cursor.execute("""
-            INSERT INTO payments (user_id, amount, currency, timestamp, status,
-                                 telegram_charge_id, provider_charge_id, invoice_payload)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (user_id, amount, currency, timestamp, status,
-              telegram_charge_id, provider_charge_id, invoice_payload))
+            INSERT INTO dialogue_summaries (user_id, summary, last_dialogue_id, updated_ts)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                summary = excluded.summary,
+                last_dialogue_id = excluded.last_dialogue_id,
+                updated_ts = excluded.updated_ts
+        """, (user_id, summary, last_dialogue_id, int(datetime.now().timestamp())))
         conn.commit()
-        print(f"Добавлена запись о платеже для пользователя {user_id} со статусом {status}")
     except sqlite3.Error as e:
-        print(f"Ошибка при добавлении записи о платеже: {e}")
+        conn.rollback()
+        log.error("Ошибка при сохранении сводки диалога", user_id=user_id, error=e)
     finally:
-        conn.close()
+        cursor.close()
+
+def get_unsummarized_dialogue(user_id: int, after_id: int, keep_recent: int, limit: int) -> list[tuple]:
+    """
+    Возвращает до limit самых старых сообщений пользователя с id > after_id,
+    не трогая keep_recent самых новых, которые и так попадают в контекст дословно.
+    Список кортежей (id, message_text, sender) в хронологическом порядке.
+    """
+    conn = _pool.connection()
+    cursor = conn.cursor()
+    try:
+        # Граница "свежей" части диалога: id самого старого из keep_recent последних сообщений.
+        cursor.execute("""
+            SELECT id FROM dialogues WHERE user_id = ?
+            ORDER BY id DESC LIMIT 1 OFFSET ?
+        """, (user_id, max(keep_recent - 1, 0)))
+        boundary = cursor.fetchone()
+        if boundary is None:
+            return []
+        cursor.execute("""
+            SELECT id, message_text, sender
+            FROM dialogues
+            WHERE user_id = ? AND id > ? AND id < ?
+            ORDER BY id
+            LIMIT ?
+        """, (user_id, after_id, boundary[0], limit))
+        return cursor.fetchall()
+    except sqlite3.Error as e:
+        log.error("Ошибка при получении истории для сводки", user_id=user_id, error=e)
+        return []
+    finally:
+        cursor.close()
+
+def _archive_connection() -> sqlite3.Connection:
+    # Соединение текущего потока с подключенным файлом архива.
+    conn = _pool.connection()
+    attach_archive(conn, DIALOGUE_ARCHIVE_DATABASE)
+    return conn
+
+def get_dialogue_history_page(user_id: int, after_id: int = 0, limit: int = 500) -> list[tuple]:
+    """
+    Возвращает до limit сообщений пользователя с id > after_id в хронологическом порядке,
+    включая перенесенные в архив: список кортежей (id, message_text, timestamp, sender).
+    Для следующей страницы передается id последнего сообщения.
+    Ошибки БД пробрасываются, чтобы выгрузка истории не обрывалась молча.
+    """
+    return read_history_page(_archive_connection(), user_id, after_id, limit)
+
+def get_dialogue_archive_stats() -> dict:
+    """
+    Возвращает размер архива: порции, пользователи, сообщения, байты до и после сжатия.
+    """
+    try:
+        return archive_stats(_archive_connection())
+    except sqlite3.Error as e:
+        log.error("Ошибка при получении статистики архива диалогов", error=e)
+        return {}
+
+def close_db():
+    """
+    Закрывает пул соединений с базой данных. Вызывается при остановке бота.
+    """
+    _pool.close()
+    log.info("Соединения с базой данных закрыты")
+
+
+def create_fsm_storage(shared: bool = False) -> BaseStorage:
+    """
+    Создает хранилище состояний FSM согласно FSM_STORAGE.
+    shared=True означает, что бот запущен в нескольких процессах: хранилище в памяти
+    тогда не подходит, и вместо него используется таблица в общей БД.
+    """
+    storage_kind = FSM_STORAGE
+    if shared and storage_kind == "memory":
+        log.warning("FSM_STORAGE=memory не подходит для нескольких процессов, состояния будут храниться в БД")
+        storage_kind = "sqlite"
+
+    if storage_kind == "redis":
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage(get_redis(REDIS_URL), state_ttl=FSM_STATE_TTL, data_ttl=FSM_STATE_TTL)
+    if storage_kind == "sqlite":
+        return SQLiteStorage(_pool)
+    return BoundedMemoryStorage(max_size=FSM_MEMORY_MAX_KEYS, ttl=FSM_STATE_TTL)
+
+
+async def close_shared_storage():
+    """
+    Закрывает соединение с общим хранилищем (Redis), если оно использовалось.
+    """
+    await close_redis()
+
+
+def get_user_cache_stats() -> dict:
+    """
+    Возвращает счетчики кэша пользователей: попадания, промахи и текущий размер.
+    """
+    if _shared_user_cache is not None:
+        return _shared_user_cache.stats()
+    return _user_cache.stats()
+
+
+def _collect_cache_metrics():
+    for cache_name, stats in (("user", get_user_cache_stats()), ("dialogue", _dialogue_cache.stats())):
+        CACHE_HITS.set(cache_name, value=stats["hits"])
+        CACHE_MISSES.set(cache_name, value=stats["misses"])
+
+register_collector(_collect_cache_metrics)
+
+
+def start_dialogue_writer():
+    """
+    Включает групповую запись сообщений диалога. Вызывается при запуске бота.
+    """
+    _dialogue_buffer.start()
+
+
+async def stop_dialogue_writer():
+    """
+    Останавливает групповую запись и сбрасывает в БД все накопленные сообщения.
+    """
+    await _dialogue_buffer.stop()
+
+
+async def init_db_async():
+    """
+    init_db в потоке пула: миграции не блокируют цикл событий, пока бот готовит остальное.
+    """
+    await _pool.run(init_db)
+
+
+async def backfill_timestamps_async():
+    """
+    Фоново заполняет целочисленные метки времени ts у строк, созданных до их появления.
+    """
+    await backfill_epoch_timestamps(_pool)
+
+
+async def archive_dialogues_async() -> dict:
+    """
+    Один проход архивации: переносит в архив сообщения за пределами горячего окна.
+    """
+    return await archive_old_dialogues(_pool, DIALOGUE_ARCHIVE_DATABASE, DIALOGUE_HOT_MESSAGES, DIALOGUE_HOT_DAYS,
+                                       chunk_rows=DIALOGUE_ARCHIVE_CHUNK_ROWS,
+                                       on_archived=lambda count: DIALOGUE_ARCHIVED.inc(amount=count))
+
+
+async def run_dialogue_archiver():
+    """
+    Фоновая задача: архивация раз в DIALOGUE_ARCHIVE_INTERVAL секунд, пока задачу не отменят.
+    """
+    if DIALOGUE_HOT_MESSAGES <= 0:
+        return
+    while True:
+        try:
+            await archive_dialogues_async()
+        except sqlite3.Error as e:
+            log.error("Ошибка при архивации диалогов", error=e)
+        await asyncio.sleep(DIALOGUE_ARCHIVE_INTERVAL)
+
+
+# --- Асинхронные обертки ---
+# Выполняют те же функции в пуле потоков БД, чтобы запросы не блокировали цикл событий.
+
+def create_db_session() -> DBSession:
+    return DBSession(_pool)
+
+async def _load_user_entry(user_id: int, session: DBSession | None = None) -> tuple[CachedUser | None, bool]:
+    # Ищет пользователя в кэше (локальном или общем), при промахе читает из БД.
+    # Возвращает (запись, взята ли она из кэша). Ошибки sqlite3 пробрасываются.
+    # В рамках одного обновления (session) запись читается один раз.
+    if session is not None and ("user", user_id) in session.cache:
+        return session.cache[("user", user_id)]
+    entry, from_cache = await _lookup_user_entry(user_id)
+    if session is not None:
+        session.cache[("user", user_id)] = (entry, from_cache)
+    return entry, from_cache
+
+def _forget_session_user(session: DBSession | None, user_id: int):
+    if session is not None:
+        session.cache.pop(("user", user_id), None)
+
+async def _lookup_user_entry(user_id: int) -> tuple[CachedUser | None, bool]:
+    if _shared_user_cache is None:
+        entry = _user_cache.get(user_id)
+    else:
+        entry = await _shared_user_cache.get(user_id)
+    if entry is not None:
+        return entry, True
+    entry = await _pool.run(_fetch_user, user_id)
+    if entry is not None and _shared_user_cache is not None:
+        await _shared_user_cache.put(user_id, entry.row)
+    return entry, False
+
+async def _invalidate_shared_user(user_id: int):
+    if _shared_user_cache is not None:
+        await _shared_user_cache.invalidate(user_id)
+
+async def add_user_async(user_id: int, full_name: str, username: str | None,
+                         session: DBSession | None = None) -> datetime | None:
+    result = await _pool.run(add_user, user_id, full_name, username)
+    await _invalidate_shared_user(user_id)
+    _forget_session_user(session, user_id)
+    if result is not None:
+        _notify_subscription_changed(user_id, result)
+    return result
+
+async def get_user_async(user_id: int, session: DBSession | None = None):
+    # При попадании в кэш в памяти отвечаем сразу, без перехода в поток БД.
+    try:
+        entry, _ = await _load_user_entry(user_id, session)
+    except sqlite3.Error as e:
+        log.error("Ошибка при получении пользователя", user_id=user_id, error=e)
+        return None
+    return entry.row if entry is not None else None
+
+async def update_user_name_async(user_id: int, new_name: str, session: DBSession | None = None):
+    result = await _pool.run(update_user_name, user_id, new_name)
+    await _invalidate_shared_user(user_id)
+    _forget_session_user(session, user_id)
+    return result
+
+async def get_recent_dialogue_async(user_id: int, limit: int = 20) -> list[tuple]:
+    return await _pool.run(get_recent_dialogue, user_id, limit)
+
+async def get_dialogue_history_page_async(user_id: int, after_id: int = 0, limit: int = 500) -> list[tuple]:
+    return await _pool.run(get_dialogue_history_page, user_id, after_id, limit)
+
+async def add_dialogue_message_async(user_id: int, message_text: str, sender: str):
+    # Если буфер отложенной записи запущен, сообщение попадет в БД со следующим групповым коммитом.
+    if _dialogue_buffer.running:
+        _dialogue_buffer.add(user_id, message_text, sender)
+        _dialogue_cache.append(user_id, to_chat_message(message_text, sender))
+        return
+    return await _pool.run(add_dialogue_message, user_id, message_text, sender)
+
+async def get_recent_context_async(user_id: int, limit: int) -> list[dict]:
+    """
+    Возвращает последние limit реплик пользователя в формате сообщений OpenAI
+    ({"role": ..., "content": ...}). Для активного диалога ответ берется из памяти,
+    из БД история читается только при первом обращении.
+    """
+    if not DIALOGUE_CACHE_ENABLED:
+        history = await _pool.run(get_recent_dialogue, user_id, limit)
+        return [to_chat_message(msg_text, sender) for msg_text, timestamp, sender in history]
+
+    messages = _dialogue_cache.get(user_id, limit)
+    if messages is not None:
+        return messages
+
+    _dialogue_cache.begin_load(user_id)
+    history = await _pool.run(get_recent_dialogue, user_id, max(limit, DIALOGUE_CACHE_TURNS))
+    messages = [to_chat_message(msg_text, sender) for msg_text, timestamp, sender in history]
+    _dialogue_cache.finish_load(user_id, messages)
+    return messages[-limit:] if limit else []
+
+async def is_subscription_expired_async(user_id: int, session: DBSession | None = None) -> bool:
+    try:
+        entry, from_cache = await _load_user_entry(user_id, session)
+        if entry is not None and not _is_expired(user_id, entry):
+            return False
+        if not from_cache:
+            return True
+        # По кэшу подписка истекла - перепроверяем по БД: ее могли продлить в другом процессе.
+        entry = await _pool.run(_fetch_user, user_id)
+        if entry is not None and _shared_user_cache is not None:
+            await _shared_user_cache.put(user_id, entry.row)
+        if session is not None:
+            session.cache[("user", user_id)] = (entry, False)
+        return _is_expired(user_id, entry)
+    except sqlite3.Error as e:
+        log.error("is_subscription_expired: ошибка БД", user_id=user_id, error=e)
+        return True # В случае ошибки БД тоже считаем, что истек
+
+async def extend_subscription_async(user_id: int, days_to_add: int) -> datetime | None:
+    result = await _pool.run(extend_subscription, user_id, days_to_add)
+    await _invalidate_shared_user(user_id)
+    if result is not None:
+        _notify_subscription_changed(user_id, result)
+    return result
+
+async def add_payment_async(user_id: int, amount: int, currency: str, status: str,
+                            telegram_charge_id: str | None = None, provider_charge_id: str | None = None,
+                            invoice_payload: str | None = None):
+    result = await _pool.run(add_payment, user_id, amount, currency, status,
+                             telegram_charge_id, provider_charge_id, invoice_payload)
+    _paid_users.pop(user_id, None)
+    return result
+
+async def record_successful_payment_async(user_id: int, amount: int, currency: str, telegram_charge_id: str,
+                                          provider_charge_id: str | None, invoice_payload: str | None,
+                                          days_to_add: int,
+                                          session: DBSession | None = None) -> tuple[datetime | None, bool] | None:
+    """
+    Записывает платеж и продлевает подписку одной транзакцией (см. record_successful_payment).
+    Возвращает (дата окончания подписки, был ли платеж записан сейчас) или None при ошибке БД.
+    """
+    session = session or create_db_session()
+    try:
+        new_expiry_date, recorded = await session.atomic(
+            record_successful_payment, user_id, amount, currency, telegram_charge_id,
+            provider_charge_id, invoice_payload, days_to_add)
+    except sqlite3.Error as e:
+        log.error("Ошибка БД при сохранении платежа", user_id=user_id, telegram_charge_id=telegram_charge_id,
+                  error=e)
+        return None
+    if recorded:
+        if invoice_payload and _invoices is not None:
+            _invoices.remove(invoice_payload)
+        _user_cache.invalidate(user_id)
+        _paid_users.pop(user_id, None)
+        await _invalidate_shared_user(user_id)
+        _forget_session_user(session, user_id)
+        log.info("Платеж сохранен, подписка продлена", user_id=user_id, days=days_to_add,
+                 expires=new_expiry_date.isoformat() if new_expiry_date else None)
+        if new_expiry_date is not None:
+            _notify_subscription_changed(user_id, new_expiry_date)
+    return new_expiry_date, recorded
+
+async def issue_invoice_async(user_id: int, amount: int, currency: str, days: int) -> tuple[PendingInvoice, bool] | None:
+    """
+    Возвращает действующий неоплаченный счет пользователя с той же суммой и валютой или выставляет новый.
+    Результат - (счет, новый ли он), None - ошибка БД.
+    """
+    global _invoices_pruned_at
+    now_ts = int(time.time())
+    invoice = _invoices.for_user(user_id, now_ts) if _invoices is not None else None
+    if invoice is None:
+        invoice = await _pool.run(get_live_invoice, user_id, now_ts)
+        if invoice is not None and _invoices is not None:
+            _invoices.put(invoice, now_ts)
+    if invoice is not None and (invoice.amount, invoice.currency, invoice.days) == (amount, currency, days):
+        return invoice, False
+
+    invoice = PendingInvoice(payload=secrets.token_urlsafe(16), user_id=user_id, amount=amount,
+                             currency=currency, days=days, expires_ts=now_ts + INVOICE_TTL)
+    if not await _pool.run(save_invoice, invoice):
+        return None
+    if _invoices is not None:
+        _invoices.put(invoice, now_ts)
+
+    if time.monotonic() - _invoices_pruned_at >= INVOICE_PRUNE_INTERVAL:
+        _invoices_pruned_at = time.monotonic()
+        deleted = await _pool.run(prune_invoices, now_ts - 86400)
+        if deleted:
+            log.info("Удалены истекшие счета", count=deleted)
+    return invoice, True
+
+async def set_invoice_message_async(invoice: PendingInvoice, chat_id: int, message_id: int) -> PendingInvoice:
+    invoice = invoice._replace(chat_id=chat_id, message_id=message_id)
+    if _invoices is not None and _invoices.get(invoice.payload, time.time()) is not None:
+        _invoices.put(invoice, time.time())
+    await _pool.run(set_invoice_message, invoice.payload, chat_id, message_id)
+    return invoice
+
+async def cancel_invoice_async(invoice: PendingInvoice):
+    # Счет, который не удалось отправить, убираем, чтобы следующий запрос выставил новый.
+    if _invoices is not None:
+        _invoices.remove(invoice.payload)
+    await _pool.run(delete_invoice, invoice.payload)
+
+async def get_invoice_async(payload: str) -> tuple[PendingInvoice, str] | None:
+    """
+    Счет по payload и его статус. Неоплаченные счета этого процесса находятся в реестре
+    без обращения к БД (см. INVOICE_REGISTRY_ENABLED), остальные читаются по ключу из БД.
+    """
+    if _invoices is not None:
+        invoice = _invoices.get(payload, time.time())
+        if invoice is not None:
+            return invoice, "pending"
+    return await _pool.run(get_invoice, payload)
+
+async def has_successful_payment_async(user_id: int) -> bool:
+    cached = _paid_users.get(user_id)
+    if cached is not None and (cached[0] or cached[1] > time.monotonic()):
+        _paid_users.move_to_end(user_id)
+        return cached[0]
+    paid = await _pool.run(has_successful_payment, user_id)
+    _paid_users[user_id] = (paid, time.monotonic() + USER_CACHE_TTL)
+    _paid_users.move_to_end(user_id)
+    while len(_paid_users) > USER_CACHE_SIZE:
+        _paid_users.popitem(last=False)
+    return paid
+
+async def get_daily_stats_async(since_day: str) -> list[tuple]:
+    return await _pool.run(get_daily_stats, since_day)
+
+async def get_daily_revenue_async(since_day: str) -> list[tuple]:
+    return await _pool.run(get_daily_revenue, since_day)
+
+async def get_expiring_subscriptions_async(after: tuple[str, int], until: str, limit: int) -> list[tuple] | None:
+    return await _pool.run(get_expiring_subscriptions, after, until, limit)
+
+async def get_subscription_expiries_async(user_ids: list[int]) -> dict[int, str | None] | None:
+    return await _pool.run(get_subscription_expiries, user_ids)
+
+async def record_subscription_notices_async(notices: list[tuple[int, str, str]]) -> bool:
+    return await _pool.run(record_subscription_notices, notices)
+
+async def prune_subscription_notices_async(before_ts: int) -> int:
+    return await _pool.run(prune_subscription_notices, before_ts)
+
+async def create_broadcast_async(text: str, created_by: int) -> int | None:
+    return await _pool.run(create_broadcast, text, created_by)
+
+async def get_broadcast_async(broadcast_id: int | None = None) -> tuple | None:
+    return await _pool.run(get_broadcast, broadcast_id)
+
+async def get_running_broadcasts_async() -> list[tuple]:
+    return await _pool.run(get_running_broadcasts)
+
+async def get_broadcast_recipients_async(broadcast_id: int, after_user_id: int, limit: int) -> list[int] | None:
+    return await _pool.run(get_broadcast_recipients, broadcast_id, after_user_id, limit)
+
+async def count_users_async() -> int | None:
+    return await _pool.run(count_users)
+
+async def save_broadcast_progress_async(broadcast_id: int, results: list[tuple[int, str]],
+                                        cursor: int | None = None, status: str | None = None) -> bool:
+    return await _pool.run(save_broadcast_progress, broadcast_id, results, cursor, status)
+
+async def get_dialogue_summary_async(user_id: int) -> tuple[str, int] | None:
+    return await _pool.run(get_dialogue_summary, user_id)
+
+async def save_dialogue_summary_async(user_id: int, summary: str, last_dialogue_id: int):
+    return await _pool.run(save_dialogue_summary, user_id, summary, last_dialogue_id)
+
+async def get_unsummarized_dialogue_async(user_id: int, after_id: int, keep_recent: int, limit: int) -> list[tuple]:
+    return await _pool.run(get_unsummarized_dialogue, user_id, after_id, keep_recent, limit)
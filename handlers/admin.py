@@ -0,0 +1,155 @@
+import html
+import os
+from collections import defaultdict
+from datetime import date, timedelta
+
+from aiogram import Bot, Router, F
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.filters import Command, CommandObject
+from aiogram.types import Message
+
+from broadcast import cancel_broadcast, current_broadcast, start_broadcast
+from db import get_broadcast_async, get_daily_revenue_async, get_daily_stats_async
+from log_config import get_logger
+
+log = get_logger(__name__)
+
+# Telegram id администраторов через запятую. Для остальных пользователей команды этого роутера не существуют.
+ADMIN_IDS = {int(admin_id) for admin_id in os.getenv("ADMIN_IDS", "").split(",") if admin_id.strip()}
+
+# За сколько дней по умолчанию показывается /daily и считается конверсия пробного периода.
+DAILY_REPORT_DAYS = 14
+CONVERSION_COHORT_DAYS = 30
+
+admin_router = Router()
+admin_router.message.filter(F.from_user.id.in_(ADMIN_IDS))
+
+
+def _format_money(amounts: dict[str, int]) -> str:
+    # Суммы хранятся в минимальных единицах (копейках).
+    if not amounts:
+        return "0"
+    return ", ".join(f"{amount / 100:.2f} {currency}" for currency, amount in sorted(amounts.items()))
+
+
+def _format_day(day: str) -> str:
+    return date.fromisoformat(day).strftime("%d.%m")
+
+
+@admin_router.message(Command("stats"))
+async def handle_stats_command(message: Message) -> None:
+    today = date.today()
+    month_start = today.replace(day=1)
+    cohort_start = today - timedelta(days=CONVERSION_COHORT_DAYS - 1)
+
+    stats = await get_daily_stats_async(min(month_start, cohort_start).isoformat())
+    revenue = await get_daily_revenue_async(month_start.isoformat())
+
+    today_row = next((row for row in stats if row[0] == today.isoformat()), None)
+    _, new_today, active_today, messages_today, _, paying_today, _ = today_row or (None, 0, 0, 0, 0, 0, 0)
+
+    month_rows = [row for row in stats if row[0] >= month_start.isoformat()]
+    month_new_users = sum(row[1] for row in month_rows)
+    month_paying_users = sum(row[5] for row in month_rows)
+    month_revenue = defaultdict(int)
+    for _, currency, amount, _ in revenue:
+        month_revenue[currency] += amount
+    month_payments = sum(row[3] for row in revenue)
+
+    cohort_rows = [row for row in stats if row[0] >= cohort_start.isoformat()]
+    cohort_users = sum(row[1] for row in cohort_rows)
+    cohort_converted = sum(row[6] for row in cohort_rows)
+    conversion = f"{cohort_converted / cohort_users:.1%}" if cohort_users else "нет данных"
+
+    await message.answer(
+        f"📊 <b>Сегодня ({today:%d.%m.%Y})</b>\n"
+        f"Активных пользователей: {active_today}\n"
+        f"Новых пользователей: {new_today}\n"
+        f"Сообщений: {messages_today}\n"
+        f"Впервые оплатили: {paying_today}\n\n"
+        f"<b>С начала месяца ({month_start:%d.%m})</b>\n"
+        f"Выручка: {_format_money(month_revenue)} ({month_payments} платежей)\n"
+        f"Новых пользователей: {month_new_users}\n"
+        f"Впервые оплатили: {month_paying_users}\n\n"
+        f"<b>Конверсия пробного периода</b> (пришли за {CONVERSION_COHORT_DAYS} дней)\n"
+        f"Оплатили {cohort_converted} из {cohort_users}: {conversion}"
+    )
+
+
+@admin_router.message(Command("daily"))
+async def handle_daily_command(message: Message, command: CommandObject) -> None:
+    # /daily [дней] - таблица по дням, по умолчанию за DAILY_REPORT_DAYS дней.
+    try:
+        days = min(max(int(command.args or DAILY_REPORT_DAYS), 1), 366)
+    except ValueError:
+        await message.answer("Использование: /daily [количество дней]")
+        return
+
+    since = (date.today() - timedelta(days=days - 1)).isoformat()
+    stats = await get_daily_stats_async(since)
+    revenue_by_day = defaultdict(dict)
+    for day, currency, amount, _ in await get_daily_revenue_async(since):
+        revenue_by_day[day][currency] = amount
+
+    if not stats:
+        await message.answer("Данных за этот период нет.")
+        return
+
+    lines = [f"📅 <b>Статистика за {days} дн.</b>", "день: активные / новые / сообщения / выручка"]
+    for day, new_users, active_users, messages, _, _, _ in stats:
+        lines.append(f"{_format_day(day)}: {active_users} / {new_users} / {messages} / "
+                     f"{_format_money(revenue_by_day.get(day, {}))}")
+    # Длинные отчеты (до года) режем по лимиту длины сообщения Telegram.
+    text = ""
+    for line in lines:
+        if len(text) + len(line) + 1 > 4096:
+            await message.answer(text)
+            text = ""
+        text += line + "\n"
+    await message.answer(text)
+    log.debug("Отправлена статистика по дням", user_id=message.from_user.id, days=days)
+
+
+@admin_router.message(Command("broadcast"))
+async def handle_broadcast_command(message: Message, command: CommandObject, bot: Bot) -> None:
+    # /broadcast <текст> - сообщение всем пользователям. Текст в HTML-разметке, как у остальных сообщений бота.
+    if not command.args:
+        await message.answer("Использование: /broadcast текст сообщения (можно с HTML-разметкой)\n"
+                             "/broadcast_status - ход рассылки, /broadcast_cancel - остановить")
+        return
+    # Сначала текст уходит самому администратору: видно, как он выглядит, а ошибка разметки
+    # обнаруживается до того, как рассылка начнет падать на каждом получателе.
+    try:
+        await message.answer(command.args)
+    except TelegramBadRequest as e:
+        await message.answer(f"Telegram не принимает этот текст: {html.escape(e.message)}")
+        return
+
+    broadcast_id = await start_broadcast(bot, command.args, message.chat.id)
+    if broadcast_id is None:
+        await message.answer("Предыдущая рассылка еще не завершена. /broadcast_status - ее ход.")
+        return
+    log.info("Администратор запустил рассылку", user_id=message.from_user.id, broadcast_id=broadcast_id)
+
+
+@admin_router.message(Command("broadcast_status"))
+async def handle_broadcast_status_command(message: Message) -> None:
+    broadcast = current_broadcast()
+    if broadcast is not None:
+        await message.answer(broadcast.progress_text())
+        return
+    row = await get_broadcast_async()
+    if row is None:
+        await message.answer("Рассылок еще не было.")
+        return
+    broadcast_id, _, _, _, _, status, _, sent, blocked, failed = row
+    await message.answer(f"Рассылка #{broadcast_id}: {status}\n"
+                         f"Доставлено: {sent}, заблокировали бота: {blocked}, ошибок: {failed}")
+
+
+@admin_router.message(Command("broadcast_cancel"))
+async def handle_broadcast_cancel_command(message: Message) -> None:
+    if not cancel_broadcast():
+        await message.answer("Сейчас нет рассылки, которую можно остановить.")
+        return
+    log.info("Администратор остановил рассылку", user_id=message.from_user.id)
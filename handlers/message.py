@@ -1,19 +1,219 @@
+import asyncio
+import os
+import time
+from contextlib import aclosing
+from typing import Callable
+
 from aiogram import Router, F
 from aiogram.types import Message
 from aiogram.filters.state import StateFilter
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramRetryAfter
 
-from db import add_dialogue_message, get_user, is_subscription_expired
+from database.session import DBSession
+from db import add_dialogue_message_async, get_user_async, is_subscription_expired_async
 from keyboards.payment_keyboard import get_pay_inline_keyboard
 
 from states.form import Form
-from ai_service import get_ai_response
+from ai_service import AIStreamError, stream_ai_response, schedule_summary_refresh
+from message_coalescer import MessageCoalescer
+from log_config import get_logger
+
+log = get_logger(__name__)
 
 message_router = Router()
 
+# Текст, который пользователь видит сразу, пока нейросеть генерирует ответ.
+STREAM_PLACEHOLDER_TEXT = "✍️ Печатаю..."
+# Текст заглушки, пока запрос ждет своей очереди к нейросети.
+STREAM_QUEUE_TEXT = "⏳ Сейчас много обращений, ты в очереди: {position}. Ответ начнется автоматически."
+# Добавляется к уже показанной части ответа, если поток от нейросети оборвался.
+STREAM_INTERRUPTED_TEXT = "⚠️ Ответ прервался из-за ошибки. Пожалуйста, повтори сообщение чуть позже."
+# Минимальный интервал между редактированиями сообщения (Telegram ограничивает частоту правок в одном чате).
+STREAM_EDIT_INTERVAL = 1.5
+# Максимальная длина одного сообщения в Telegram.
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Сообщения, отправленные подряд с паузами меньше этого интервала (в секундах), получают один общий ответ.
+MESSAGE_COALESCE_WINDOW = float(os.getenv("MESSAGE_COALESCE_WINDOW", "1.5"))
+
+
+async def _safe_edit(bot_message: Message, text: str, plain: bool = False) -> float | None:
+    """
+    Редактирует сообщение, игнорируя ошибки "message is not modified".
+    plain=True отключает HTML-разметку: текст нейросети может содержать "<" и "&" или незакрытые теги.
+    Возвращает, сколько секунд Telegram попросил подождать перед следующей правкой (0, если не просил),
+    или None, если Telegram отклонил правку.
+    """
+    try:
+        if plain:
+            await bot_message.edit_text(text, parse_mode=None)
+        else:
+            await bot_message.edit_text(text)
+    except TelegramRetryAfter as e:
+        return float(e.retry_after)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            log.warning("Не удалось отредактировать сообщение", message_id=bot_message.message_id, error=e)
+            return None
+    return 0.0
+
+
+async def _show_final_text(placeholder: Message, message: Message, text: str) -> bool:
+    """
+    Заменяет заглушку итоговым текстом ответа. Если правка не прошла, отправляет текст
+    новым сообщением. Возвращает False, если пользователь так и не получил ответ.
+    """
+    retry_after = await _safe_edit(placeholder, text, plain=True)
+    if retry_after:
+        await asyncio.sleep(retry_after)
+        retry_after = await _safe_edit(placeholder, text, plain=True)
+    if retry_after == 0:
+        return True
+    try:
+        await message.answer(text, parse_mode=None)
+        return True
+    except TelegramAPIError as e:
+        log.error("Не удалось отправить ответ пользователю", chat_id=message.chat.id, error=e)
+        return False
+
+
+async def _delete_placeholder(bot_message: Message):
+    try:
+        await bot_message.delete()
+    except TelegramBadRequest as e:
+        log.warning("Не удалось удалить сообщение", message_id=bot_message.message_id, error=e)
+
+
+async def stream_reply(message: Message, user_id: int, user_text: str,
+                       on_visible: Callable[[], None] | None = None) -> str | None:
+    """
+    Отправляет заглушку и постепенно заменяет ее текстом, который приходит от нейросети.
+    Правки отправляются не чаще, чем раз в STREAM_EDIT_INTERVAL секунд.
+    on_visible вызывается перед тем, как пользователь увидит первый текст ответа;
+    если ответ отменяют раньше, заглушка удаляется.
+    Возвращает итоговый текст ответа или None, если нейросеть ничего не вернула,
+    ответ оборвался на середине (пользователь видит сообщение об ошибке) или его не удалось доставить.
+    """
+    placeholder = await message.answer(STREAM_PLACEHOLDER_TEXT)
+
+    chunks: list[str] = []
+    shown_text = ""
+    next_edit_at = time.monotonic() + STREAM_EDIT_INTERVAL
+
+    async def on_queue(position: int):
+        # Пока запрос ждет в очереди, показываем позицию и статус "печатает".
+        await message.bot.send_chat_action(message.chat.id, "typing")
+        await _safe_edit(placeholder, STREAM_QUEUE_TEXT.format(position=position))
+
+    def mark_visible():
+        nonlocal on_visible
+        if on_visible is not None:
+            on_visible()
+            on_visible = None
+
+    try:
+        # aclosing закрывает поток сразу при выходе из цикла (в том числе при отмене),
+        # и место в очереди к модели освобождается, не дожидаясь сборщика мусора.
+        async with aclosing(stream_ai_response(user_id, user_text, on_queue=on_queue)) as stream:
+            async for delta in stream:
+                chunks.append(delta)
+                now = time.monotonic()
+                if now < next_edit_at:
+                    continue
+
+                current_text = "".join(chunks).strip()[:TELEGRAM_MESSAGE_LIMIT]
+                if current_text and current_text != shown_text:
+                    mark_visible()
+                    retry_after = await _safe_edit(placeholder, current_text, plain=True)
+                    if retry_after is not None:
+                        shown_text = current_text
+                    next_edit_at = time.monotonic() + max(STREAM_EDIT_INTERVAL, retry_after or 0)
+    except asyncio.CancelledError:
+        if not shown_text:
+            await asyncio.shield(_delete_placeholder(placeholder))
+        raise
+    except AIStreamError:
+        # Неполный ответ не выдаем за готовый: оставляем показанную часть и сообщаем об обрыве.
+        mark_visible()
+        partial_text = "".join(chunks).strip()
+        notice = STREAM_INTERRUPTED_TEXT
+        if partial_text:
+            notice = partial_text[:TELEGRAM_MESSAGE_LIMIT - len(notice) - 2] + "\n\n" + notice
+        await _safe_edit(placeholder, notice, plain=True)
+        return None
+
+    mark_visible()
+    final_text = "".join(chunks).strip()
+    if not final_text:
+        await _safe_edit(placeholder,
+                         "Произошла ошибка при получении ответа от AI. Пожалуйста, попробуй перефразировать или повторить позже.")
+        return None
+
+    # Финальная правка: первая часть ответа заменяет заглушку, остаток (если ответ длиннее лимита) уходит новыми сообщениями.
+    # Если ответ так и не дошел до пользователя, он не сохраняется в истории как отправленный.
+    if final_text[:TELEGRAM_MESSAGE_LIMIT] != shown_text:
+        if not await _show_final_text(placeholder, message, final_text[:TELEGRAM_MESSAGE_LIMIT]):
+            return None
+    for offset in range(TELEGRAM_MESSAGE_LIMIT, len(final_text), TELEGRAM_MESSAGE_LIMIT):
+        await message.answer(final_text[offset:offset + TELEGRAM_MESSAGE_LIMIT], parse_mode=None)
+
+    return final_text
+
+
+async def _answer_messages(user_id: int, messages: list[Message], commit: Callable[[], None]) -> None:
+    """
+    Отвечает одним ответом на пачку сообщений пользователя, отправленных подряд.
+    Пока пользователь не увидел текст ответа, обработку может отменить новое сообщение.
+    """
+    # Несколько сообщений подряд - это одна реплика пользователя, разбитая на части.
+    user_text = "\n".join(message.text for message in messages)
+    if len(messages) > 1:
+        log.debug("Сообщения пользователя объединены в одну реплику", user_id=user_id, messages=len(messages))
+
+    ai_response_text = None
+
+    try:
+        # Ответ показывается пользователю по мере генерации, в БД сохраняем итоговый текст.
+        ai_response_text = await stream_reply(messages[-1], user_id, user_text, on_visible=commit)
+
+        if ai_response_text is not None:
+
+            await add_dialogue_message_async(user_id, ai_response_text, 'bot')
+
+            # Старые реплики сворачиваются в сводку в фоне, уже после ответа.
+            schedule_summary_refresh(user_id)
+
+        else:
+            log.warning("Нейросеть не вернула ответ", user_id=user_id)
+
+
+    except Exception:
+        log.exception("Неожиданная ошибка при получении ответа нейросети", user_id=user_id)
+        await messages[-1].answer(
+            "Произошла непредвиденная ошибка при обработке вашего запроса. Мы уже работаем над этим.")
+
+
+_coalescer = MessageCoalescer(_answer_messages, window=MESSAGE_COALESCE_WINDOW)
+
+
+async def close_message_coalescer(drain_timeout: float = 0):
+    """
+    Вызывается при остановке бота: до drain_timeout секунд дает закончить ответы на уже
+    принятые сообщения, а те, что не успели, отменяет.
+    """
+    if drain_timeout > 0:
+        started = time.monotonic()
+        left = await _coalescer.drain(drain_timeout)
+        log.info("Ответы на принятые сообщения завершены", seconds=round(time.monotonic() - started, 2),
+                 cancelled_users=left)
+    await _coalescer.close()
+
+
 @message_router.message(F.text, ~StateFilter(Form.waiting_for_name))
-async def handle_all_messages(message: Message) -> None:
+async def handle_all_messages(message: Message, db_session: DBSession | None = None) -> None:
     """
     Этот хэндлер отвечает на любые сообщения, кроме команд.
+    Ответ нейросети формируется в фоне, после короткой паузы, чтобы несколько
+    сообщений подряд получили один общий ответ.
     """
     user = message.from_user
     if not user or not message.text:
@@ -22,45 +222,25 @@ async def handle_all_messages(message: Message) -> None:
     user_id = user.id
     user_text = message.text
 
-    print(f"Получено сообщение от {user.full_name} (ID: {user_id}): {user_text}")
+    # Текст сообщения в лог не пишем: это лишняя нагрузка и личные данные пользователя.
+    log.info("Получено сообщение", user_id=user_id, chars=len(user_text))
 
-    add_dialogue_message(user_id, user_text, 'user')
+    await add_dialogue_message_async(user_id, user_text, 'user')
 
-    user_data = get_user(user_id)
+    # Строка пользователя читается один раз на обновление, проверка подписки берет ее из сессии.
+    user_data = await get_user_async(user_id, db_session)
     if user_data is None:
         await message.answer("Произошла ошибка при получении ваших данных.")
         return
 
     expiring_date = user_data[4]
 
-    if not is_subscription_expired(user_id):
-        print(f"Подписка пользователя {user_id} активна: {expiring_date}. Обрабатываем сообщение AI.")
-
-        ai_response_text = None
-
-        try:
-            ai_response_text = await get_ai_response(user_id, user_text)
-
-            if ai_response_text is not None:
-
-                await message.answer(ai_response_text)
-
-                add_dialogue_message(user_id, ai_response_text, 'bot')
-
-            else:
-                print(
-                    f"AI service returned error or no valid response for user {user_id}. Response: {ai_response_text}")
-                await message.answer(
-                    "Произошла ошибка при получении ответа от AI. Пожалуйста, попробуй перефразировать или повторить позже.")
-
-
-        except Exception as e:
-            print(f"Неожиданная ошибка при вызове get_ai_response для пользователя {user_id}: {e}")
-            await message.answer(
-                "Произошла непредвиденная ошибка при обработке вашего запроса. Мы уже работаем над этим.")
+    if not await is_subscription_expired_async(user_id, db_session):
+        log.debug("Подписка активна, обрабатываем сообщение AI", user_id=user_id, expires=expiring_date)
+        _coalescer.submit(user_id, message)
 
     else:
-        print(f"Подписка пользователя {user_id} истекла. Просим оплатить.")
+        log.info("Подписка истекла, просим оплатить", user_id=user_id)
         payment_message = "Твоя подписка истекла. Пожалуйста, оплати услугу поддержки, чтобы продолжить общение."
         await message.answer(payment_message,
                              reply_markup=get_pay_inline_keyboard())
@@ -69,6 +249,6 @@ async def handle_all_messages(message: Message) -> None:
 async def handle_non_text_messages(message: Message) -> None:
      user = message.from_user
      if user:
-        print(f"Получено нетекстовое сообщение от {user.full_name} (ID: {user.id}), тип: {message.content_type}")
+        log.info("Получено нетекстовое сообщение", user_id=user.id, content_type=message.content_type)
 
         await message.answer("Это интересное сообщение! Но пока я умею обрабатывать только текст и команды меню.")
\ No newline at end of file
@@ -1,23 +1,84 @@
 import os
+import time
 from datetime import datetime
 from aiogram import Router, F
+from aiogram.exceptions import TelegramBadRequest
 # Убедись, что LabeledPrice импортирован отсюда
-from aiogram.types import Message, LabeledPrice, SuccessfulPayment, PreCheckoutQuery, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import Message, LabeledPrice, SuccessfulPayment, PreCheckoutQuery, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, ReplyParameters
 from aiogram.methods import SendInvoice # Может и не понадобиться, но не помешает
 
 # Импортируем из db.py константу и функции
-from db import add_payment, add_dialogue_message, extend_subscription, SUBSCRIPTION_DAYS_PER_PAYMENT
+from database.session import DBSession
+from db import (cancel_invoice_async, get_invoice_async, issue_invoice_async, record_successful_payment_async,
+                set_invoice_message_async, SUBSCRIPTION_DAYS_PER_PAYMENT)
+from metrics import PAYMENTS_TOTAL
+from log_config import get_logger
+
+log = get_logger(__name__)
 
 # --- Токен Платежного Провайдера ---
 PAYMENTS_PROVIDER_TOKEN = os.getenv("PAYMENTS_PROVIDER_TOKEN")
 
 if not PAYMENTS_PROVIDER_TOKEN:
-     print("ВНИМАНИЕ: PAYMENTS_PROVIDER_TOKEN не установлен! Платежи не будут работать.")
+     log.warning("PAYMENTS_PROVIDER_TOKEN не установлен! Платежи не будут работать.")
 
 
 payment_router = Router()
 
-# --- Хэндлер для нажатия инлайн-кнопки "Оплатить пакет сообщений" (остается без изменений) ---
+# Цена подписки в минимальных единицах валюты (189 RUB = 18900 копеек).
+SUBSCRIPTION_PRICE = 18900
+SUBSCRIPTION_CURRENCY = "RUB"
+
+
+async def send_subscription_invoice(message: Message, user_id: int) -> bool:
+    """
+    Отправляет в чат message счет на продление подписки. Если у пользователя уже есть
+    действующий счет, новый не выставляется: бот отвечает на сообщение с ним
+    (или отправляет тот же счет еще раз, если сообщение удалено).
+    Возвращает False, если счет отправить не удалось.
+    """
+    issued = await issue_invoice_async(user_id, SUBSCRIPTION_PRICE, SUBSCRIPTION_CURRENCY,
+                                       SUBSCRIPTION_DAYS_PER_PAYMENT)
+    if issued is None:
+        return False
+    invoice, is_new = issued
+
+    if not is_new and invoice.message_id is not None and invoice.chat_id == message.chat.id:
+        try:
+            await message.answer(
+                f"👆 Счет на оплату уже выставлен, он действует до "
+                f"{datetime.fromtimestamp(invoice.expires_ts):%d.%m.%Y %H:%M}.",
+                reply_parameters=ReplyParameters(message_id=invoice.message_id),
+            )
+            log.debug("Пользователю повторно показан действующий счет", user_id=user_id)
+            return True
+        except TelegramBadRequest:
+            # Сообщение со счетом удалено - отправляем тот же счет заново.
+            pass
+
+    package_description = f"Продление подписки на {invoice.days} дней."
+    try:
+        invoice_message = await message.answer_invoice(
+            title="Оплата подписки",
+            description=package_description,
+            payload=invoice.payload,
+            provider_token=PAYMENTS_PROVIDER_TOKEN,
+            currency=invoice.currency,
+            prices=[LabeledPrice(label=package_description, amount=invoice.amount)],
+            start_parameter=f"pay_{user_id}", # Параметр, который будет в команде /start после успешной оплаты
+        )
+    except Exception as e:
+        log.error("Ошибка при отправке счета", user_id=user_id, error=e)
+        if is_new:
+            await cancel_invoice_async(invoice)
+        return False
+
+    await set_invoice_message_async(invoice, invoice_message.chat.id, invoice_message.message_id)
+    log.debug("Пользователю отправлен счет на оплату", user_id=user_id, reused=not is_new)
+    return True
+
+
+# --- Хэндлер для нажатия инлайн-кнопки "Оплатить подписку" ---
 @payment_router.callback_query(F.data == "pay_for_subscription")
 async def process_pay_button(callback_query: CallbackQuery):
     user = callback_query.from_user
@@ -28,29 +89,9 @@ async def process_pay_button(callback_query: CallbackQuery):
     user_id = user.id
 
     await callback_query.answer("Переходим к оплате...", show_alert=False)
-    print(f"DEBUG: Пользователь {user_id} нажал кнопку Оплатить.")
-
-    price_amount_kopecks = 18900 # 189 RUB = 18900 копеек
-    package_description = f"Продление подписки на {SUBSCRIPTION_DAYS_PER_PAYMENT} дней."
-
-    prices = [
-        LabeledPrice(label=package_description, amount=price_amount_kopecks),
-    ]
-
-    try:
-        await callback_query.message.answer_invoice(
-            title="Оплата подписки",
-            description=package_description,
-            payload=f"sub_user_{user_id}_{SUBSCRIPTION_DAYS_PER_PAYMENT}d_{int(datetime.now().timestamp())}",
-            provider_token=PAYMENTS_PROVIDER_TOKEN,
-            currency="RUB",
-            prices=prices,
-            start_parameter=f"pay_{user_id}",
-        )
-        print(f"DEBUG: Пользователю {user_id} отправлен счет на оплату.")
+    log.debug("Пользователь нажал кнопку Оплатить", user_id=user_id)
 
-    except Exception as e:
-        print(f"DEBUG: Ошибка при отправке счета пользователю {user_id}: {e}")
+    if not await send_subscription_invoice(callback_query.message, user_id):
         await callback_query.message.answer(
             "🛑 Ой-ой! Кажется, платеж заблудился в цифровом пространстве. \n\n"
             "Возможные причины:\n"
@@ -65,7 +106,7 @@ async def process_pay_button(callback_query: CallbackQuery):
         )
 
 
-# --- НОВЫЙ ХЭНДЛЕР: для кнопки "Подписка" из Reply-клавиатуры ---
+# --- Хэндлер для кнопки "Подписка" из Reply-клавиатуры ---
 @payment_router.message(F.text == "Подписка") # Этот хэндлер сработает при нажатии кнопки "Подписка"
 async def handle_subscription_button_from_menu(message: Message):
     user = message.from_user
@@ -77,83 +118,89 @@ async def handle_subscription_button_from_menu(message: Message):
 
     # Проверяем наличие токена платежного провайдера
     if not PAYMENTS_PROVIDER_TOKEN:
-        print("DEBUG: PAYMENTS_PROVIDER_TOKEN не установлен. Невозможно отправить счет.")
+        log.error("PAYMENTS_PROVIDER_TOKEN не установлен, невозможно отправить счет")
         await message.answer("Извините, сейчас невозможно отправить счет на оплату. Пожалуйста, сообщите администратору.")
         return
 
-    # --- Формируем и отправляем счет, аналогично process_pay_button ---
-    # Сумма и описание пакета должны совпадать
-    price_amount_kopecks = 18900 # 189 RUB = 18900 копеек. Должно совпадать с ценой в инлайн-кнопке!
-    package_description = f"Продление подписки на {SUBSCRIPTION_DAYS_PER_PAYMENT} дней."
-
-    prices = [
-        LabeledPrice(label=package_description, amount=price_amount_kopecks),
-    ]
-
-    try:
-        # Используем message.answer_invoice() для отправки счета, так как это Message-хэндлер
-        await message.answer_invoice(
-            title="Оплата подписки",
-            description=package_description,
-            payload=f"sub_user_{user_id}_{SUBSCRIPTION_DAYS_PER_PAYMENT}d_{int(datetime.now().timestamp())}",
-            provider_token=PAYMENTS_PROVIDER_TOKEN,
-            currency="RUB",
-            prices=prices,
-            start_parameter=f"pay_{user_id}", # Параметр, который будет в команде /start после успешной оплаты
-        )
-        print(f"DEBUG: Пользователю {user_id} отправлен счет на оплату по нажатию кнопки 'Подписка'.")
-
-    except Exception as e:
-        print(f"DEBUG: Ошибка при отправке счета пользователю {user_id} при нажатии кнопки 'Подписка': {e}")
+    if not await send_subscription_invoice(message, user_id):
         await message.answer("Произошла ошибка при формировании счета. Попробуйте позже.")
 
 
 # --- Хэндлер для Pre-Checkout Query (срабатывает ДО оплаты) ---
+# Telegram ждет ответа не дольше 10 секунд. Проверка - поиск счета в реестре в памяти, а если бот
+# работает в нескольких процессах (реестр выключен) или счета там нет - чтение по первичному ключу из БД.
 @payment_router.pre_checkout_query()
 async def process_pre_checkout_query(pre_checkout_query: PreCheckoutQuery):
     user_id = pre_checkout_query.from_user.id
-    print(f"DEBUG: Получен Pre-Checkout Query от пользователя {user_id}!")
-    print(f"DEBUG: Payload: {pre_checkout_query.invoice_payload}")
-    print(f"DEBUG: Сумма: {pre_checkout_query.total_amount / 100} {pre_checkout_query.currency}")
+    log.debug("Получен Pre-Checkout Query", user_id=user_id, payload=pre_checkout_query.invoice_payload,
+              amount=pre_checkout_query.total_amount, currency=pre_checkout_query.currency)
+
+    found = await get_invoice_async(pre_checkout_query.invoice_payload)
+    error_message = None
+    if found is None:
+        error_message = "Этот счет устарел. Нажми «Подписка», чтобы получить новый."
+    else:
+        invoice, status = found
+        if status == "paid":
+            error_message = "Этот счет уже оплачен."
+        elif invoice.user_id != user_id:
+            error_message = "Этот счет выставлен другому пользователю."
+        elif (invoice.amount, invoice.currency) != (pre_checkout_query.total_amount, pre_checkout_query.currency):
+            error_message = "Сумма счета изменилась. Нажми «Подписка», чтобы получить новый."
+        elif invoice.expires_ts <= time.time():
+            error_message = "Этот счет устарел. Нажми «Подписка», чтобы получить новый."
+
+    if error_message is not None:
+        log.warning("Pre-Checkout Query отклонен", user_id=user_id, payload=pre_checkout_query.invoice_payload,
+                    reason=error_message)
+        await pre_checkout_query.answer(ok=False, error_message=error_message)
+        return
 
     await pre_checkout_query.answer(ok=True)
-    print(f"DEBUG: Pre-Checkout Query для пользователя {user_id} подтвержден (ответ OK).")
+    log.debug("Pre-Checkout Query подтвержден", user_id=user_id)
 
 
 # --- Хэндлер для SuccessfulPayment (срабатывает ПОСЛЕ успешной оплаты) ---
 @payment_router.message(F.successful_payment)
-async def process_successful_payment(message: Message):
+async def process_successful_payment(message: Message, db_session: DBSession | None = None):
     user = message.from_user
     if not user or not message.successful_payment:
-         print("DEBUG: Получено невалидное сообщение SuccessfulPayment.")
+         log.warning("Получено невалидное сообщение SuccessfulPayment")
          return
 
     user_id = user.id
     payment = message.successful_payment
 
-    print(f"DEBUG: Получено сообщение об успешной оплате от пользователя {user_id}!")
-    print(f"DEBUG: Сумма: {payment.total_amount / 100} {payment.currency}")
-    print(f"DEBUG: Payload: {payment.invoice_payload}")
-    print(f"DEBUG: Telegram Charge ID: {payment.telegram_payment_charge_id}")
-    print(f"DEBUG: Provider Charge ID: {payment.provider_payment_charge_id}")
+    log.info("Получено сообщение об успешной оплате", user_id=user_id, amount=payment.total_amount,
+             currency=payment.currency, telegram_charge_id=payment.telegram_payment_charge_id)
+    log.debug("Детали платежа", user_id=user_id, payload=payment.invoice_payload,
+              provider_charge_id=payment.provider_payment_charge_id)
+
+    # Срок берется из счета, проверенного при pre-checkout; эта константа - только для платежей без счета.
+    days_to_add = SUBSCRIPTION_DAYS_PER_PAYMENT
 
-    add_payment(
+    # Платеж и продление сохраняются одной транзакцией: сбой между ними не теряет оплаченные дни,
+    # а повторная доставка того же обновления не продлевает подписку второй раз.
+    result = await record_successful_payment_async(
         user_id=user_id,
         amount=payment.total_amount,
         currency=payment.currency,
-        status='successful',
         telegram_charge_id=payment.telegram_payment_charge_id,
         provider_charge_id=payment.provider_payment_charge_id,
-        invoice_payload=payment.invoice_payload
+        invoice_payload=payment.invoice_payload,
+        days_to_add=days_to_add,
+        session=db_session,
     )
-    print(f"DEBUG: Информация о платеже для пользователя {user_id} сохранена в БД.")
-
-    days_to_add = SUBSCRIPTION_DAYS_PER_PAYMENT
-
-    new_expiry_date = extend_subscription(user_id, days_to_add)
+    new_expiry_date, recorded = result if result is not None else (None, False)
+    if result is not None and not recorded:
+        log.warning("Повторное уведомление об уже учтенном платеже", user_id=user_id,
+                    telegram_charge_id=payment.telegram_payment_charge_id)
+        return
+    if recorded:
+        PAYMENTS_TOTAL.inc(payment.currency)
 
     if new_expiry_date is not None:
-         print(f"DEBUG: Подписка пользователя {user_id} продлена на {days_to_add} дней. Новая дата истечения: {new_expiry_date}.")
+         log.info("Подписка продлена", user_id=user_id, days=days_to_add, expires=new_expiry_date)
          confirmation_message = (
              "🎉 Та-дам! Ты официально прокачал(а) свою психическую броню! \n\n"
              "Теперь в твоем доступе: \n"
@@ -165,6 +212,6 @@ async def process_successful_payment(message: Message):
          )
          await message.answer(confirmation_message)
     else:
-         print(f"DEBUG: Ошибка: Не удалось обновить подписку для пользователя {user_id} после успешной оплаты.")
+         log.error("Не удалось обновить подписку после успешной оплаты", user_id=user_id)
          error_msg = "Оплата получена, но произошла ошибка при обновлении вашей подписки. Пожалуйста, свяжитесь с поддержкой."
          await message.answer(error_msg)
\ No newline at end of file
@@ -1,27 +1,41 @@
+import time
+
 from aiogram import Router, F
-from aiogram.types import Message, CallbackQuery
+from aiogram.types import Message, CallbackQuery, FSInputFile
 from aiogram.fsm.context import FSMContext
+from aiogram.filters import Command, CommandObject
 from aiogram.filters.state import StateFilter
 
 from states.form import Form
 
 from keyboards.profile_keyboard import get_profile_inline_keyboard
 
-from db import get_user
+from database.session import DBSession
+from db import get_user_async
+from history_export import EXPORT_FORMATS, TELEGRAM_DOCUMENT_LIMIT, export_history, remove_export
+from log_config import get_logger
 
 from datetime import datetime
 
+log = get_logger(__name__)
+
 profile_router = Router()
 
+# Выгрузка истории читает всю переписку, поэтому пользователь может запрашивать ее не чаще раза в EXPORT_COOLDOWN секунд.
+EXPORT_COOLDOWN = 600
+# Пользователи, для которых сейчас готовится выгрузка, и время последней успешной выгрузки.
+_exports_in_progress: set[int] = set()
+_last_exports: dict[int, float] = {}
+
 @profile_router.message(F.text == "Профиль", ~StateFilter(Form.waiting_for_name))
-async def handle_profile_command(message: Message) -> None:
+async def handle_profile_command(message: Message, db_session: DBSession | None = None) -> None:
     user = message.from_user
     if not user:
         await message.answer("Произошла ошибка при получении ваших данных пользователя.")
         return
 
     user_id = user.id
-    user_data = get_user(user_id)  # Получаем данные пользователя из БД
+    user_data = await get_user_async(user_id, db_session)  # Получаем данные пользователя из БД
 
     if user_data is None:
         await message.answer("Произошла ошибка при получении данных вашего профиля.")
@@ -73,4 +87,62 @@ async def handle_change_name_callback(callback_query: CallbackQuery, state: FSMC
     await callback_query.message.answer("Пожалуйста, введи новое имя, которое будет использоваться.")
 
     await state.set_state(Form.waiting_for_name)
-    print(f"Пользователь {user.id} запросил изменение имени. Установлено состояние waiting_for_name.")
\ No newline at end of file
+    log.debug("Пользователь запросил изменение имени, установлено состояние waiting_for_name", user_id=user.id)
+
+
+async def send_history_export(message: Message, user_id: int, export_format: str = "txt") -> None:
+    """
+    Готовит файл с историей диалога пользователя и отправляет его документом в чат message.
+    """
+    if user_id in _exports_in_progress:
+        await message.answer("Выгрузка истории уже готовится, подожди немного.")
+        return
+    last_export = _last_exports.get(user_id)
+    if last_export is not None and time.monotonic() - last_export < EXPORT_COOLDOWN:
+        await message.answer(f"Историю можно выгружать не чаще раза в {EXPORT_COOLDOWN // 60} минут.")
+        return
+
+    _exports_in_progress.add(user_id)
+    try:
+        await message.bot.send_chat_action(message.chat.id, "upload_document")
+        export = await export_history(user_id, export_format)
+        try:
+            if not export.messages:
+                await message.answer("История диалога пока пуста.")
+                return
+            if export.size > TELEGRAM_DOCUMENT_LIMIT:
+                log.warning("Выгрузка истории больше лимита Telegram", user_id=user_id, size=export.size)
+                await message.answer("История слишком большая для отправки одним файлом. Напиши в поддержку.")
+                return
+            await message.answer_document(FSInputFile(export.path, filename=export.filename),
+                                          caption=f"История диалога: {export.messages} сообщений.")
+        finally:
+            remove_export(export)
+        _last_exports[user_id] = time.monotonic()
+        # Старые отметки уже не ограничивают выгрузку - не даем словарю расти бесконечно.
+        if len(_last_exports) > 10000:
+            now = time.monotonic()
+            for stale_user_id in [key for key, value in _last_exports.items() if now - value >= EXPORT_COOLDOWN]:
+                del _last_exports[stale_user_id]
+    except Exception:
+        log.exception("Ошибка при выгрузке истории диалога", user_id=user_id)
+        await message.answer("Не удалось выгрузить историю. Попробуй позже.")
+    finally:
+        _exports_in_progress.discard(user_id)
+
+@profile_router.message(Command("export"), ~StateFilter(Form.waiting_for_name))
+async def handle_export_command(message: Message, command: CommandObject) -> None:
+    # /export - читаемый текст, /export json - JSON Lines.
+    user = message.from_user
+    if not user:
+        return
+    export_format = (command.args or "txt").strip().lower()
+    if export_format not in EXPORT_FORMATS:
+        await message.answer(f"Доступные форматы: {', '.join(EXPORT_FORMATS)}. Например: /export json")
+        return
+    await send_history_export(message, user.id, export_format)
+
+@profile_router.callback_query(F.data == "export_history")
+async def handle_export_callback(callback_query: CallbackQuery) -> None:
+    await callback_query.answer("Готовлю файл с историей.")
+    await send_history_export(callback_query.message, callback_query.from_user.id)
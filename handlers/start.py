@@ -3,26 +3,30 @@ from aiogram.filters import CommandStart
 from aiogram.types import Message
 from aiogram.fsm.context import FSMContext
 
-from db import add_user, get_user, update_user_name
+from database.session import DBSession
+from db import add_user_async, get_user_async, update_user_name_async
 
 from keyboards.main_menu import get_main_menu_keyboard
 from states.form import Form
+from log_config import get_logger
+
+log = get_logger(__name__)
 
 start_router = Router()
 
 @start_router.message(CommandStart())
-async def command_start_handler(message: Message, state: FSMContext) -> None:
+async def command_start_handler(message: Message, state: FSMContext, db_session: DBSession | None = None) -> None:
     user = message.from_user
     if not user:
         await message.answer("Ошибка! Не могу определить твои данные пользователя.")
         return
 
     user_id = user.id
-    user_in_db = get_user(user_id)
+    user_in_db = await get_user_async(user_id, db_session)
 
     if user_in_db is None:
-        print(f"Новый пользователь: {user_id}")
-        add_user(user_id, user.full_name, user.username)
+        log.info("Новый пользователь", user_id=user_id)
+        await add_user_async(user_id, user.full_name, user.username, db_session)
 
         await message.answer(
             "👋 Привет! Я — бот-психолог с искусственным интеллектом, который: \n"
@@ -39,7 +43,7 @@ async def command_start_handler(message: Message, state: FSMContext) -> None:
                     )
 
     else:
-        print(f"Существующий пользователь: {user_id}")
+        log.debug("Существующий пользователь", user_id=user_id)
         current_name = user_in_db[1]
 
         await message.answer(
@@ -48,7 +52,7 @@ async def command_start_handler(message: Message, state: FSMContext) -> None:
         )
 
 @start_router.message(Form.waiting_for_name, F.text)
-async def process_name(message: Message, state: FSMContext) -> None:
+async def process_name(message: Message, state: FSMContext, db_session: DBSession | None = None) -> None:
     user = message.from_user
     if not user or not message.text:
          await message.answer("Произошла ошибка при получении имени. Попробуй еще раз или начни с /start.")
@@ -61,7 +65,7 @@ async def process_name(message: Message, state: FSMContext) -> None:
         await message.answer("Пожалуйста, введи более подходящее имя (от 2 до 50 символов).")
         return
 
-    update_user_name(user.id, new_name)
+    await update_user_name_async(user.id, new_name, db_session)
 
     await message.answer(
         f"Отлично, буду обращаться к тебе {new_name}!",
@@ -69,5 +73,5 @@ async def process_name(message: Message, state: FSMContext) -> None:
     )
 
     await state.clear()
-    print(f"Пользователь {user.id} завершил ввод/изменение имени. Состояние сброшено.")
+    log.debug("Пользователь завершил ввод/изменение имени, состояние сброшено", user_id=user.id)
 
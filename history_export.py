@@ -0,0 +1,111 @@
+import asyncio
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from dataclasses import dataclass
+from datetime import datetime
+
+from db import get_dialogue_history_page_async
+from log_config import get_logger
+
+log = get_logger(__name__)
+
+# Сколько сообщений читается из БД и дописывается в файл за один раз.
+EXPORT_PAGE_SIZE = 500
+# Файлы больше этого размера (в байтах) отправляются сжатыми в gzip.
+EXPORT_GZIP_THRESHOLD = int(os.getenv("EXPORT_GZIP_THRESHOLD", str(1024 * 1024)))
+# Ограничение Bot API на размер документа, который отправляет бот.
+TELEGRAM_DOCUMENT_LIMIT = 50 * 1024 * 1024
+
+EXPORT_FORMATS = ("txt", "json")
+
+
+@dataclass
+class HistoryExport:
+    path: str
+    filename: str
+    messages: int
+    size: int
+    compressed: bool
+
+
+def _format_timestamp(timestamp: str) -> str:
+    try:
+        return datetime.fromisoformat(timestamp).strftime("%d.%m.%Y %H:%M")
+    except (ValueError, TypeError):
+        return timestamp or ""
+
+
+def _format_row(row: tuple, export_format: str) -> str:
+    message_id, message_text, timestamp, sender = row
+    if export_format == "json":
+        # JSON Lines: по одному объекту на строку, файл можно читать построчно.
+        return json.dumps({"id": message_id, "timestamp": timestamp, "sender": sender, "text": message_text},
+                          ensure_ascii=False) + "\n"
+    author = "Ты" if sender == "user" else "Бот"
+    return f"[{_format_timestamp(timestamp)}] {author}: {message_text}\n\n"
+
+
+def _gzip_file(path: str) -> str:
+    gzip_path = f"{path}.gz"
+    try:
+        with open(path, "rb") as source, gzip.open(gzip_path, "wb", compresslevel=6) as target:
+            shutil.copyfileobj(source, target, 1024 * 1024)
+    except BaseException:
+        _remove(gzip_path)
+        raise
+    finally:
+        _remove(path)
+    return gzip_path
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+async def export_history(user_id: int, export_format: str = "txt") -> HistoryExport:
+    """
+    Выгружает всю историю диалога пользователя (включая архив) во временный файл.
+    Сообщения читаются страницами по id и сразу дописываются в файл, поэтому расход
+    памяти не зависит от длины истории. Большие файлы сжимаются в gzip.
+    Файл нужно удалить после отправки (remove_export).
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Неизвестный формат выгрузки: {export_format}")
+
+    fd, path = tempfile.mkstemp(prefix=f"history_{user_id}_", suffix=f".{export_format}")
+    messages = 0
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as file:
+            after_id = 0
+            while True:
+                page = await get_dialogue_history_page_async(user_id, after_id, EXPORT_PAGE_SIZE)
+                if not page:
+                    break
+                # Запись в файл тоже блокирующая - выполняем ее вне цикла событий.
+                await asyncio.to_thread(file.writelines, [_format_row(row, export_format) for row in page])
+                messages += len(page)
+                after_id = page[-1][0]
+                if len(page) < EXPORT_PAGE_SIZE:
+                    break
+
+        compressed = os.path.getsize(path) > EXPORT_GZIP_THRESHOLD
+        if compressed:
+            path = await asyncio.to_thread(_gzip_file, path)
+    except BaseException:
+        _remove(path)
+        raise
+
+    filename = f"history_{datetime.now():%Y-%m-%d}.{export_format}" + (".gz" if compressed else "")
+    size = os.path.getsize(path)
+    log.info("История диалога выгружена", user_id=user_id, messages=messages, size=size, compressed=compressed)
+    return HistoryExport(path=path, filename=filename, messages=messages, size=size, compressed=compressed)
+
+
+def remove_export(export: HistoryExport):
+    _remove(export.path)
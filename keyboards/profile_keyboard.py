@@ -2,14 +2,17 @@ from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 def get_profile_inline_keyboard():
     """
-    Создает и возвращает InlineKeyboardMarkup с кнопкой "Изменить имя".
+    Создает и возвращает InlineKeyboardMarkup с кнопками "Изменить имя" и "Выгрузить историю".
     """
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
-            [ # Первый и единственный ряд кнопок
+            [ # Первый ряд кнопок
                 # InlineKeyboardButton требует либо url, либо callback_data, либо другие специфичные параметры
                 # callback_data - это данные, которые будут отправлены боту при нажатии
                 InlineKeyboardButton(text="Изменить имя", callback_data="change_name_profile")
+            ],
+            [
+                InlineKeyboardButton(text="Выгрузить историю", callback_data="export_history")
             ]
         ]
     )
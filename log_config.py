@@ -0,0 +1,143 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+_listener: QueueListener | None = None
+
+
+class StructuredLogger:
+    """
+    Логгер с полями ключ=значение: log.info("Получено сообщение", user_id=user_id, chars=42).
+
+    Уровень проверяется до формирования записи, поэтому вызов отключенного уровня
+    стоит одну проверку. Текст сообщения подставляется лениво (в стиле %s),
+    уже в фоновом потоке записи.
+    """
+
+    __slots__ = ("logger",)
+
+    def __init__(self, logger: logging.Logger):
+        self.logger = logger
+
+    def isEnabledFor(self, level: int) -> bool:
+        return self.logger.isEnabledFor(level)
+
+    def _log(self, level: int, msg: str, args: tuple, fields: dict):
+        exc_info = fields.pop("exc_info", None)
+        # stacklevel=3: в записи указывается место вызова log.info(...), а не этот модуль.
+        self.logger.log(level, msg, *args, exc_info=exc_info,
+                        extra={"fields": fields} if fields else None, stacklevel=3)
+
+    def debug(self, msg: str, *args, **fields):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self._log(logging.DEBUG, msg, args, fields)
+
+    def info(self, msg: str, *args, **fields):
+        if self.logger.isEnabledFor(logging.INFO):
+            self._log(logging.INFO, msg, args, fields)
+
+    def warning(self, msg: str, *args, **fields):
+        if self.logger.isEnabledFor(logging.WARNING):
+            self._log(logging.WARNING, msg, args, fields)
+
+    def error(self, msg: str, *args, **fields):
+        if self.logger.isEnabledFor(logging.ERROR):
+            self._log(logging.ERROR, msg, args, fields)
+
+    def exception(self, msg: str, *args, **fields):
+        # Как error, но с трассировкой текущего исключения. _log вызывается напрямую, а не через error:
+        # лишний уровень вызова сдвинул бы stacklevel, и местом записи оказался бы этот модуль.
+        if self.logger.isEnabledFor(logging.ERROR):
+            fields.setdefault("exc_info", True)
+            self._log(logging.ERROR, msg, args, fields)
+
+
+def get_logger(name: str) -> StructuredLogger:
+    return StructuredLogger(logging.getLogger(name))
+
+
+def _format_value(value) -> str:
+    text = str(value)
+    if not text or any(char in text for char in ' ="\n'):
+        return json.dumps(text, ensure_ascii=False)
+    return text
+
+
+class KeyValueFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        line = (f"{datetime.fromtimestamp(record.created).isoformat(sep=' ', timespec='milliseconds')} "
+                f"{record.levelname} {record.name} {record.getMessage()}")
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{key}={_format_value(value)}" for key, value in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            **getattr(record, "fields", {}),
+        }
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class _InProcessQueueHandler(QueueHandler):
+    # Стандартный QueueHandler форматирует запись прямо в вызывающем потоке, чтобы ее можно
+    # было передать в другой процесс. Очередь у нас в памяти процесса, поэтому запись
+    # передается как есть, а форматирование и вывод выполняются в потоке QueueListener.
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup_logging(level: str | None = None, log_format: str | None = None):
+    """
+    Настраивает корневой логгер: записи кладутся в очередь, а выводом в stderr
+    занимается отдельный поток. Повторный вызов ничего не делает.
+
+    По умолчанию уровень берется из LOG_LEVEL (DEBUG, INFO, WARNING, ERROR), формат - из LOG_FORMAT:
+    kv - "время уровень логгер сообщение ключ=значение", json - одна JSON-запись на строку.
+    """
+    global _listener
+    if _listener is not None:
+        return
+    level = (level or os.getenv("LOG_LEVEL", "INFO")).upper()
+    log_format = log_format or os.getenv("LOG_FORMAT", "kv")
+
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(JsonFormatter() if log_format == "json" else KeyValueFormatter())
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers.clear()
+    root.addHandler(_InProcessQueueHandler(records))
+    root.setLevel(level)
+    # Служебные сообщения библиотек на уровне INFO (каждый запрос aiohttp, polling) слишком шумные.
+    for noisy in ("aiohttp.access", "aiogram.event", "httpx"):
+        logging.getLogger(noisy).setLevel(max(logging.getLevelName(level), logging.WARNING))
+
+    _listener = QueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """
+    Дописывает все записи из очереди и останавливает поток вывода.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -1,35 +1,281 @@
-from dotenv import load_dotenv
+import time
 
-from handlers.payment import payment_router
+# Отсюда отсчитывается время запуска бота (STARTUP_BUDGET).
+_PROCESS_STARTED = time.perf_counter()
 
+from dotenv import load_dotenv
+
+# Модули проекта читают настройки при импорте, поэтому .env загружается до них.
 load_dotenv()
 
 import asyncio
+import multiprocessing
+import secrets
+import signal
 from aiogram import Bot, Dispatcher
+from aiogram.client.session.base import BaseSession
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 
+from handlers.admin import admin_router
 from handlers.info import info_router
-from handlers.message import message_router
+from handlers.message import message_router, close_message_coalescer
+from handlers.payment import payment_router
 from handlers.profile import profile_router
 from handlers.start import start_router
 
-from db import init_db
+from db import (init_db, init_db_async, close_db, backfill_timestamps_async, start_dialogue_writer,
+                stop_dialogue_writer, create_fsm_storage, close_shared_storage, run_dialogue_archiver)
+from subscription_reminders import run_expiry_reminders
+from broadcast import resume_broadcasts, stop_broadcasts
+from ai_service import close_ai_client
+from metrics import STARTUP_SECONDS, start_metrics_server
+from middlewares.db_session import DBSessionMiddleware
+from middlewares.in_flight import InFlightUpdatesMiddleware
+from middlewares.metrics import TelegramRequestMetrics, UpdateMetricsMiddleware
+from log_config import get_logger, setup_logging
 
 import os
 
+log = get_logger(__name__)
+
 API_TOKEN = os.getenv('PSY_SUP_API')
 
-async def main():
-    bot = Bot(token=API_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+# --- Режим работы ---
+# polling - один процесс забирает обновления через getUpdates.
+# webhook - Telegram сам присылает обновления на встроенный aiohttp-сервер.
+BOT_MODE = os.getenv("BOT_MODE", "polling")
 
-    dp = Dispatcher()
+# Настройки webhook: внешний адрес (https://example.com), путь и секрет для заголовка
+# X-Telegram-Bot-Api-Secret-Token. Если секрет не задан, он генерируется при запуске.
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+WEB_SERVER_HOST = os.getenv("WEB_SERVER_HOST", "0.0.0.0")
+WEB_SERVER_PORT = int(os.getenv("WEB_SERVER_PORT", "8080"))
+# Количество процессов-воркеров, которые слушают один порт (SO_REUSEPORT, только Linux).
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "1"))
 
-    dp.include_routers(start_router, info_router, profile_router, payment_router, message_router)
+# HTTP-адрес с метриками в формате Prometheus (/metrics). 0 - выключено.
+# У каждого webhook-воркера свой порт: METRICS_PORT + номер воркера.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
 
-    init_db()
+# Сколько секунд при остановке бота ждать ответов на уже принятые сообщения.
+# Должно быть меньше таймаута принудительной остановки (docker stop - 10 секунд, systemd - 90).
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "8"))
+# Ожидаемое время запуска процесса до готовности принимать обновления, секунд.
+# Если запуск занял больше, в лог пишется предупреждение.
+STARTUP_BUDGET = float(os.getenv("STARTUP_BUDGET", "10"))
+
+# message_router отвечает на любой текст, поэтому он последний.
+ROUTERS = (start_router, info_router, profile_router, payment_router, admin_router, message_router)
+
+# Фоновые задачи, которые живут, пока работает бот.
+background_tasks: list[asyncio.Task] = []
+
+def create_bot(session: BaseSession | None = None) -> Bot:
+    # session позволяет подменить HTTP-клиент Bot API (например, в нагрузочных тестах без сети).
+    bot = Bot(token=API_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    bot.session.middleware(TelegramRequestMetrics())
+    return bot
+
+def create_dispatcher(run_background_jobs: bool = True, metrics_port: int = METRICS_PORT) -> Dispatcher:
+    """
+    Создает диспетчер с роутерами и хуками запуска/остановки.
+    Фоновые задачи по обслуживанию БД запускаются только в одном процессе (run_background_jobs).
+    """
+    # Если обновления одного пользователя могут попасть в разные процессы,
+    # состояние FSM должно храниться в общем хранилище, а не в памяти процесса.
+    dp = Dispatcher(storage=create_fsm_storage(shared=BOT_MODE == "webhook" and WEB_WORKERS > 1))
+
+    dp.include_routers(*ROUTERS)
+    # Первый внешний middleware: обновление считается принятым, пока не отработают все остальные.
+    in_flight = InFlightUpdatesMiddleware()
+    dp.update.outer_middleware(in_flight)
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    dp.update.outer_middleware(DBSessionMiddleware())
+
+    metrics_runners = []
+
+    async def start_metrics():
+        if metrics_port:
+            metrics_runners.append(await start_metrics_server(METRICS_HOST, metrics_port))
+
+    async def delete_webhook(bot: Bot):
+        # Если раньше бот работал через webhook, getUpdates не будет работать, пока он установлен.
+        if BOT_MODE != "webhook":
+            await bot.delete_webhook(drop_pending_updates=False)
+
+    async def on_startup(bot: Bot):
+        # Схема БД, сервер метрик и запрос к Bot API не зависят друг от друга - выполняем их одновременно.
+        await asyncio.gather(init_db_async(), start_metrics(), delete_webhook(bot))
+        start_dialogue_writer()
+        if run_background_jobs:
+            # Заполнение меток времени для старых строк идет параллельно с обработкой сообщений.
+            background_tasks.append(asyncio.create_task(backfill_timestamps_async()))
+            # Старые сообщения периодически переносятся из dialogues в сжатый архив.
+            background_tasks.append(asyncio.create_task(run_dialogue_archiver()))
+            # Напоминания об окончании подписки: таймеры в этом процессе, продления из других сверяются с БД.
+            background_tasks.append(asyncio.create_task(run_expiry_reminders(bot)))
+            # Рассылки, прерванные остановкой бота, продолжаются с сохраненного курсора.
+            await resume_broadcasts(bot)
+
+        startup_seconds = time.perf_counter() - _PROCESS_STARTED
+        STARTUP_SECONDS.set(value=startup_seconds)
+        if startup_seconds > STARTUP_BUDGET:
+            log.warning("Запуск бота занял больше ожидаемого", seconds=round(startup_seconds, 2),
+                        budget=STARTUP_BUDGET)
+        else:
+            log.info("Бот запущен", seconds=round(startup_seconds, 2))
+
+    async def on_shutdown():
+        # Новые обновления уже не принимаются. За общий срок SHUTDOWN_DRAIN_TIMEOUT, пока сессия Bot API
+        # и соединения с БД открыты, дожидаемся обработчиков, которые еще выполняются (иначе сообщение
+        # могло бы сохраниться без ответа), а затем ответов на принятые сообщения.
+        deadline = time.monotonic() + SHUTDOWN_DRAIN_TIMEOUT
+        unfinished = await in_flight.wait_idle(SHUTDOWN_DRAIN_TIMEOUT)
+        if unfinished:
+            log.warning("Не все обновления обработаны до остановки", unfinished=unfinished)
+        await close_message_coalescer(max(deadline - time.monotonic(), 0))
+        # Прогресс рассылки сохраняется, пока соединения с БД еще открыты.
+        await stop_broadcasts()
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        background_tasks.clear()
+        # Записываем накопленные сообщения диалога до закрытия соединений с БД.
+        await stop_dialogue_writer()
+        for runner in metrics_runners:
+            await runner.cleanup()
+
+    dp.startup.register(on_startup)
+
+    # Останавливаем фоновые задачи и закрываем пул соединений к AI при остановке
+    dp.shutdown.register(on_shutdown)
+    dp.shutdown.register(close_ai_client)
+    dp.shutdown.register(close_db)
+    dp.shutdown.register(close_shared_storage)
 
+    return dp
+
+async def run_polling():
+    bot = create_bot()
+    dp = create_dispatcher()
+
+    # Схема БД и webhook готовятся в on_startup. Сигналы SIGTERM и SIGINT обрабатывает start_polling:
+    # он прекращает получать обновления и вызывает on_shutdown до закрытия сессии Bot API.
     await dp.start_polling(bot)
 
+async def register_webhook(secret: str):
+    """
+    Регистрирует webhook в Telegram. Выполняется один раз, до запуска воркеров.
+    """
+    bot = create_bot()
+    try:
+        await bot.set_webhook(
+            url=f"{WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=secret,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=sorted(set().union(*(router.resolve_used_update_types() for router in ROUTERS))),
+        )
+        log.info("Webhook установлен", url=f"{WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}")
+    finally:
+        await bot.session.close()
+
+async def run_webhook_worker(worker_id: int, secret: str):
+    """
+    Один процесс webhook-сервера: aiohttp-приложение с обработчиком обновлений,
+    который проверяет секретный токен в заголовке запроса.
+    """
+    bot = create_bot()
+    dp = create_dispatcher(run_background_jobs=worker_id == 0,
+                           metrics_port=METRICS_PORT + worker_id if METRICS_PORT else 0)
+
+    app = web.Application()
+    # Привязывает startup/shutdown диспетчера к жизненному циклу aiohttp-приложения.
+    # Регистрируется раньше обработчика: его on_shutdown закрывает сессию Bot API,
+    # а ответы на принятые сообщения при остановке еще отправляются.
+    setup_application(app, dp, bot=bot)
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret).register(app, path=WEBHOOK_PATH)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+
+    # shutdown_timeout - сколько ждать завершения запросов, которые Telegram уже прислал.
+    runner = web.AppRunner(app, shutdown_timeout=SHUTDOWN_DRAIN_TIMEOUT)
+    await runner.setup()
+    # reuse_port позволяет нескольким процессам слушать один и тот же порт, ядро распределяет соединения.
+    site = web.TCPSite(runner, WEB_SERVER_HOST, WEB_SERVER_PORT, reuse_port=WEB_WORKERS > 1)
+    await site.start()
+    log.info("Воркер принимает webhook", worker_id=worker_id,
+             address=f"{WEB_SERVER_HOST}:{WEB_SERVER_PORT}{WEBHOOK_PATH}")
+
+    try:
+        await stop.wait()
+        log.info("Воркер останавливается", worker_id=worker_id)
+    finally:
+        # Сначала закрывается порт, затем выполняется on_shutdown диспетчера.
+        await runner.cleanup()
+
+def _webhook_worker_process(worker_id: int, secret: str):
+    # Процессы запускаются через spawn и не выполняют блок __main__, логирование настраиваем здесь.
+    setup_logging()
+    try:
+        asyncio.run(run_webhook_worker(worker_id, secret))
+    except KeyboardInterrupt:
+        pass
+
+def run_webhook():
+    if not WEBHOOK_BASE_URL:
+        raise RuntimeError("Для режима webhook нужно задать WEBHOOK_BASE_URL.")
+
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+
+    # Миграции применяем один раз, до запуска воркеров.
+    init_db()
+    close_db()
+
+    asyncio.run(register_webhook(secret))
+
+    if WEB_WORKERS <= 1:
+        _webhook_worker_process(0, secret)
+        return
+
+    # Кэш истории диалога и реестр счетов в памяти не согласованы между процессами - в воркерах их выключаем.
+    os.environ["DIALOGUE_CACHE_ENABLED"] = "0"
+    os.environ["INVOICE_REGISTRY_ENABLED"] = "0"
+
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=_webhook_worker_process, args=(worker_id, secret),
+                               name=f"bot-worker-{worker_id}")
+               for worker_id in range(WEB_WORKERS)]
+    for worker in workers:
+        worker.start()
+
+    def forward_signal(signum, frame):
+        # SIGTERM приходит только главному процессу (например, от docker stop) - передаем его воркерам,
+        # каждый из них завершает ответы и останавливается сам.
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+    signal.signal(signal.SIGTERM, forward_signal)
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.join()
+
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    setup_logging()
+    if BOT_MODE == "webhook":
+        run_webhook()
+    else:
+        asyncio.run(run_polling())
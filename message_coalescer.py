@@ -0,0 +1,117 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+from log_config import get_logger
+
+log = get_logger(__name__)
+
+
+@dataclass
+class _UserQueue:
+    # Сообщения, которые еще не переданы на обработку.
+    pending: list = field(default_factory=list)
+    # Момент (time.monotonic) прихода последнего сообщения.
+    last_arrival: float = 0.0
+    # Фоновая задача пользователя и текущая обработка пачки сообщений.
+    worker: asyncio.Task | None = None
+    generation: asyncio.Task | None = None
+    # Пачка, которую сейчас обрабатывает generation, и можно ли ее еще отменить.
+    batch: list = field(default_factory=list)
+    committed: bool = False
+
+
+class MessageCoalescer:
+    """
+    Объединяет сообщения одного пользователя, пришедшие подряд, в одну пачку.
+
+    Пачка передается в process(user_id, items, commit), когда в течение window секунд
+    не приходит новых сообщений. Если новое сообщение приходит, пока пачка еще
+    обрабатывается, обработка отменяется, а ее сообщения попадают в следующую пачку.
+    После вызова commit() обработку отменить уже нельзя (например, пользователь уже
+    видит начало ответа): следующая пачка дождется ее завершения.
+    Для каждого пользователя одновременно выполняется не больше одной обработки,
+    поэтому ответы не перемешиваются.
+    """
+
+    def __init__(self, process: Callable[[int, list, Callable[[], None]], Awaitable], window: float = 1.5):
+        self.process = process
+        self.window = window
+        self.batches = 0
+        self.superseded = 0
+
+        self._queues: dict[int, _UserQueue] = {}
+
+    def submit(self, user_id: int, item):
+        """
+        Добавляет сообщение пользователя в очередь. Не ждет обработки.
+        """
+        queue = self._queues.get(user_id)
+        if queue is None:
+            queue = self._queues[user_id] = _UserQueue()
+        queue.pending.append(item)
+        queue.last_arrival = time.monotonic()
+
+        if queue.generation is not None and not queue.generation.done() and not queue.committed:
+            # Ответ на предыдущие сообщения еще не начал показываться - заменяем его общим ответом.
+            queue.generation.cancel()
+        if queue.worker is None:
+            queue.worker = asyncio.create_task(self._run(user_id, queue))
+
+    async def _run(self, user_id: int, queue: _UserQueue):
+        while True:
+            # Ждем, пока пользователь сделает паузу в window секунд.
+            while (delay := queue.last_arrival + self.window - time.monotonic()) > 0:
+                await asyncio.sleep(delay)
+
+            queue.batch, queue.pending = queue.pending, []
+            queue.committed = False
+            queue.generation = asyncio.create_task(
+                self.process(user_id, queue.batch, lambda: setattr(queue, "committed", True)))
+            self.batches += 1
+            # asyncio.wait не пробрасывает отмену самой generation, только отмену worker.
+            await asyncio.wait({queue.generation})
+
+            if queue.generation.cancelled():
+                self.superseded += 1
+                queue.pending = queue.batch + queue.pending
+            elif queue.generation.exception() is not None:
+                log.error("Ошибка при обработке сообщений пользователя", user_id=user_id,
+                          exc_info=queue.generation.exception())
+            queue.generation = None
+            queue.batch = []
+
+            if not queue.pending:
+                del self._queues[user_id]
+                return
+
+    def stats(self) -> dict:
+        return {"users": len(self._queues), "batches": self.batches, "superseded": self.superseded}
+
+    async def drain(self, timeout: float) -> int:
+        """
+        Ждет не дольше timeout секунд, пока будут обработаны все принятые сообщения,
+        включая пачки, которые еще ждут паузы пользователя. Новые сообщения при этом
+        по-прежнему принимаются. Возвращает число пользователей, оставшихся без ответа.
+        """
+        deadline = time.monotonic() + timeout
+        while self._queues and (remaining := deadline - time.monotonic()) > 0:
+            workers = {queue.worker for queue in self._queues.values() if queue.worker is not None}
+            if not workers:
+                break
+            await asyncio.wait(workers, timeout=remaining)
+        return len(self._queues)
+
+    async def close(self):
+        """
+        Отменяет ожидающие и выполняющиеся обработки всех пользователей.
+        """
+        tasks = []
+        for queue in self._queues.values():
+            for task in (queue.worker, queue.generation):
+                if task is not None and not task.done():
+                    task.cancel()
+                    tasks.append(task)
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._queues.clear()
@@ -0,0 +1,186 @@
+import bisect
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+from aiohttp import web
+
+from log_config import get_logger
+
+log = get_logger(__name__)
+
+# Простые метрики в формате Prometheus без внешних зависимостей.
+# Обновление метрики - это несколько операций со словарем, поэтому их можно
+# держать включенными постоянно. Все метрики живут в памяти одного процесса.
+
+# Границы корзин гистограмм задержек (в секундах).
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: tuple) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        _registry.append(self)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, *label_values, amount: float = 1.0):
+        self.values[label_values] = self.values.get(label_values, 0.0) + amount
+
+    def render(self) -> list[str]:
+        return self.header() + [f"{self.name}{_format_labels(self.labels, key)} {value}"
+                                for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *label_values, amount: float = 1.0):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, *label_values, value: float):
+        self.values[label_values] = value
+
+    @contextmanager
+    def track_inprogress(self, *label_values):
+        self.inc(*label_values)
+        try:
+            yield
+        finally:
+            self.dec(*label_values)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+        # Для каждого набора меток: [счетчики по корзинам (последняя - +Inf), сумма, количество].
+        self.values: dict[tuple, list] = {}
+
+    def observe(self, value: float, *label_values):
+        series = self.values.get(label_values)
+        if series is None:
+            series = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, *label_values):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, *label_values)
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                labels = _format_labels((*self.labels, "le"), (*key, bound))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+_registry: list[_Metric] = []
+# Функции, которые при каждом запросе /metrics обновляют метрики из счетчиков других модулей.
+_collectors: list[Callable[[], None]] = []
+
+
+def register_collector(collector: Callable[[], None]):
+    _collectors.append(collector)
+
+
+def render_metrics() -> str:
+    for collector in _collectors:
+        try:
+            collector()
+        except Exception as e:
+            log.warning("Ошибка при сборе метрик", error=e)
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- Метрики бота ---
+UPDATE_LATENCY = Histogram("bot_update_duration_seconds", "Время обработки обновления Telegram.",
+                           ("update_type", "status"))
+UPDATES_IN_PROGRESS = Gauge("bot_updates_in_progress", "Обновления, которые сейчас обрабатываются.")
+MESSAGES_TOTAL = Counter("bot_messages_total", "Входящие сообщения пользователей.")
+
+DB_LATENCY = Histogram("bot_db_duration_seconds", "Время выполнения запроса к БД в потоке пула.",
+                       ("operation",))
+DB_QUEUE_WAIT = Histogram("bot_db_queue_wait_seconds", "Ожидание свободного потока БД.")
+
+AI_LATENCY = Histogram("bot_ai_duration_seconds",
+                       "Время ответа модели по этапам: очередь, первый токен, весь ответ.", ("stage",))
+AI_REQUESTS = Counter("bot_ai_requests_total", "Запросы к моделям по исходам (success, error, timeout и т.д.).",
+                      ("model", "outcome"))
+
+TELEGRAM_LATENCY = Histogram("bot_telegram_request_duration_seconds", "Время запроса к Telegram Bot API.",
+                             ("method",))
+TELEGRAM_ERRORS = Counter("bot_telegram_errors_total", "Ошибки запросов к Telegram Bot API.", ("method",))
+
+PAYMENTS_TOTAL = Counter("bot_payments_total", "Успешные платежи.", ("currency",))
+
+DIALOGUE_ARCHIVED = Counter("bot_dialogue_archived_messages_total", "Сообщения диалогов, перенесенные в архив.")
+SUBSCRIPTION_NOTICES = Counter("bot_subscription_notices_total",
+                               "Уведомления об окончании подписки по видам (reminder, expired) и исходам.",
+                               ("kind", "outcome"))
+BROADCAST_MESSAGES = Counter("bot_broadcast_messages_total", "Сообщения рассылок по исходам (sent, blocked, failed).",
+                             ("outcome",))
+
+STARTUP_SECONDS = Gauge("bot_startup_seconds", "Время от запуска процесса до готовности принимать обновления.")
+
+# Значения, которые уже считаются в других модулях, переносятся сюда коллекторами при запросе /metrics.
+CACHE_HITS = Gauge("bot_cache_hits", "Попадания в кэш с момента запуска.", ("cache",))
+CACHE_MISSES = Gauge("bot_cache_misses", "Промахи кэша с момента запуска.", ("cache",))
+AI_QUEUE = Gauge("bot_ai_queue", "Состояние очереди запросов к модели.", ("state",))
+
+
+async def _handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """
+    Запускает отдельный HTTP-сервер с адресом /metrics. Возвращает runner для остановки.
+    """
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info("Метрики доступны", url=f"http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,18 @@
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from db import create_db_session
+
+
+class DBSessionMiddleware(BaseMiddleware):
+    """
+    Внешний middleware диспетчера: создает DBSession на каждое обновление
+    и передает ее обработчикам в аргументе db_session.
+    """
+
+    async def __call__(self, handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: dict[str, Any]) -> Any:
+        data["db_session"] = create_db_session()
+        return await handler(event, data)
@@ -0,0 +1,49 @@
+import time
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.types import TelegramObject, Update
+
+from metrics import MESSAGES_TOTAL, TELEGRAM_ERRORS, TELEGRAM_LATENCY, UPDATE_LATENCY, UPDATES_IN_PROGRESS
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """
+    Внешний middleware диспетчера: время обработки каждого обновления и число обновлений в работе.
+    """
+
+    async def __call__(self, handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: dict[str, Any]) -> Any:
+        update_type = event.event_type if isinstance(event, Update) else type(event).__name__
+        if isinstance(event, Update) and event.message is not None:
+            MESSAGES_TOTAL.inc()
+
+        status = "error"
+        started_at = time.perf_counter()
+        UPDATES_IN_PROGRESS.inc()
+        try:
+            result = await handler(event, data)
+            status = "unhandled" if result is UNHANDLED else "ok"
+            return result
+        finally:
+            UPDATES_IN_PROGRESS.dec()
+            UPDATE_LATENCY.observe(time.perf_counter() - started_at, update_type, status)
+
+
+class TelegramRequestMetrics(BaseRequestMiddleware):
+    """
+    Middleware сессии бота: время каждого запроса к Bot API (sendMessage, editMessageText и т.д.).
+    """
+
+    async def __call__(self, make_request, bot, method):
+        method_name = type(method).__name__
+        started_at = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            TELEGRAM_ERRORS.inc(method_name)
+            raise
+        finally:
+            TELEGRAM_LATENCY.observe(time.perf_counter() - started_at, method_name)
@@ -0,0 +1,42 @@
+import asyncio
+import os
+import time
+
+from ai_scheduler import TokenBucket
+
+# Сообщений в секунду на все массовые отправки бота вместе (рассылки и уведомления о подписке).
+# Telegram допускает около 30 сообщений в секунду от одного бота, остаток оставляем для ответов в диалогах.
+BULK_SEND_RATE = float(os.getenv("BULK_SEND_RATE", "25"))
+
+
+class SendLimiter:
+    """
+    Общий лимит массовых отправок. Источник может дополнительно ограничить свою долю
+    собственным ведром (share), но в сумме источники не превышают общий rate.
+    RetryAfter от Telegram относится ко всему боту, поэтому пауза тоже общая.
+    """
+
+    def __init__(self, rate: float):
+        self._bucket = TokenBucket(rate, max(rate, 1.0))
+        self._paused_until = 0.0
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, share: TokenBucket | None = None):
+        """
+        Ждет, пока можно отправить одно сообщение в пределах общего лимита и доли share.
+        """
+        while True:
+            wait = max(self._paused_until - time.monotonic(), self._bucket.delay(1),
+                       share.delay(1) if share is not None else 0.0)
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        self._bucket.take(1)
+        if share is not None:
+            share.take(1)
+
+
+# Общий лимитер рассылок и уведомлений этого процесса.
+bulk_sends = SendLimiter(BULK_SEND_RATE)
@@ -0,0 +1,287 @@
+import asyncio
+import heapq
+import itertools
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+from ai_scheduler import TokenBucket
+from db import (add_subscription_listener, remove_subscription_listener, get_expiring_subscriptions_async,
+                get_subscription_expiries_async, has_successful_payment_async, prune_subscription_notices_async,
+                record_subscription_notices_async)
+from keyboards.payment_keyboard import get_pay_inline_keyboard
+from log_config import get_logger
+from metrics import SUBSCRIPTION_NOTICES
+from send_limiter import bulk_sends
+
+log = get_logger(__name__)
+
+REMINDER = "reminder"
+EXPIRED = "expired"
+
+SUBSCRIPTION_NOTICES_ENABLED = os.getenv("SUBSCRIPTION_NOTICES_ENABLED", "1") == "1"
+# За сколько часов до окончания подписки (и пробного периода) отправляется напоминание.
+SUBSCRIPTION_REMINDER_HOURS = float(os.getenv("SUBSCRIPTION_REMINDER_HOURS", "24"))
+# После перезапуска уведомление об окончании получают только те, у кого подписка
+# закончилась не раньше чем столько часов назад.
+SUBSCRIPTION_NOTICE_GRACE_HOURS = float(os.getenv("SUBSCRIPTION_NOTICE_GRACE_HOURS", "24"))
+# Доля уведомлений в общем лимите массовых отправок (BULK_SEND_RATE), сообщений в секунду.
+# Меньше, чем у рассылки: уведомления не срочные и не должны вытеснять ее. 0 - только общий лимит.
+SUBSCRIPTION_NOTICE_RATE = float(os.getenv("SUBSCRIPTION_NOTICE_RATE", "5"))
+
+# В памяти держатся таймеры подписок, которые заканчиваются в ближайшие
+# SUBSCRIPTION_REMINDER_HOURS часов + LOOKAHEAD секунд. Окно догружается раз в LOAD_INTERVAL секунд.
+LOOKAHEAD = 3600
+LOAD_INTERVAL = 600
+# Строк за один запрос при загрузке окна и уведомлений за одну сверку с БД.
+LOAD_BATCH = 1000
+SEND_BATCH = 100
+# Через сколько секунд повторить уведомление после сетевой ошибки или ошибки БД.
+RETRY_DELAY = 60
+# Отметки об отправке хранятся, пока по ним можно повторно загрузить дату окончания, и еще сутки.
+PRUNE_INTERVAL = 86400
+
+
+class ExpiryReminderScheduler:
+    """
+    Планировщик напоминаний о скором окончании подписки и уведомлений о том, что она закончилась.
+
+    Таймеры лежат в куче по времени срабатывания. Для каждого пользователя запоминается дата
+    окончания, под которую поставлены его таймеры. Продление добавляет в кучу новые таймеры
+    за O(log n), а старые отбрасываются при извлечении: их дата больше не совпадает с текущей.
+    Перед отправкой даты сверяются с БД, поэтому учитываются и продления из других процессов.
+
+    Ближайшие даты окончания читаются диапазоном по индексу и догружаются по мере хода времени.
+    Отправленные уведомления отмечаются в subscription_notices, поэтому после перезапуска
+    планировщик продолжает с того же места и не отправляет их повторно.
+    """
+
+    def __init__(self, bot: Bot, reminder_before: float, grace: float, rate: float):
+        self.bot = bot
+        self.reminder_before = reminder_before
+        self.grace = grace
+        self._bucket = TokenBucket(rate, max(rate, 1.0))
+        # (время срабатывания, порядковый номер, user_id, вид, дата окончания ISO8601)
+        self._heap: list[tuple[float, int, int, str, str]] = []
+        self._seq = itertools.count()
+        self._expiries: dict[int, str] = {}
+        # Верхняя граница загруженного окна дат окончания.
+        self._loaded_until: str | None = None
+        # Изменения, пришедшие во время загрузки окна, применяются после нее,
+        # иначе более старый снимок из БД перезаписал бы их.
+        self._loading = False
+        self._pending: dict[int, str] = {}
+        self._wakeup = asyncio.Event()
+        self._pruned_at = 0.0
+
+    def _push(self, fire_at: float, user_id: int, kind: str, expiry: str):
+        seq = next(self._seq)
+        heapq.heappush(self._heap, (fire_at, seq, user_id, kind, expiry))
+        if self._heap[0][1] == seq:
+            # Новый таймер стал ближайшим - будим цикл, чтобы он пересчитал время ожидания.
+            self._wakeup.set()
+
+    def _schedule(self, user_id: int, expiry: str, reminder_sent: bool = False, expired_sent: bool = False):
+        try:
+            expires_at = datetime.fromisoformat(expiry).timestamp()
+        except (TypeError, ValueError):
+            log.warning("Некорректная дата окончания подписки", user_id=user_id, value=expiry)
+            self._expiries.pop(user_id, None)
+            return
+        if expired_sent:
+            self._expiries.pop(user_id, None)
+            return
+        self._expiries[user_id] = expiry
+        now = time.time()
+        if not reminder_sent and expires_at > now:
+            self._push(max(expires_at - self.reminder_before, now), user_id, REMINDER, expiry)
+        self._push(expires_at, user_id, EXPIRED, expiry)
+
+    def _apply_change(self, user_id: int, expiry: str):
+        if self._expiries.get(user_id) == expiry:
+            return
+        if self._loaded_until is not None and expiry <= self._loaded_until:
+            self._schedule(user_id, expiry)
+        else:
+            # Дата за пределами окна: таймеры поставит загрузка окна, а старые станут неактуальны.
+            self._expiries.pop(user_id, None)
+
+    def on_subscription_changed(self, user_id: int, expiry: datetime):
+        """
+        Вызывается при регистрации пользователя и продлении подписки в этом процессе.
+        """
+        if self._loading:
+            self._pending[user_id] = expiry.isoformat()
+        else:
+            self._apply_change(user_id, expiry.isoformat())
+
+    async def _load(self):
+        now = datetime.now()
+        until = (now + timedelta(seconds=self.reminder_before + LOOKAHEAD)).isoformat()
+        if self._loaded_until is None:
+            after = ((now - timedelta(seconds=self.grace)).isoformat(), 0)
+        else:
+            # Строки с датой, равной границе, уже загружены: id пользователя меньше sys.maxsize.
+            after = (self._loaded_until, sys.maxsize)
+
+        loaded = 0
+        complete = True
+        self._loading = True
+        try:
+            while True:
+                rows = await get_expiring_subscriptions_async(after, until, LOAD_BATCH)
+                if rows is None:
+                    complete = False
+                    break
+                for user_id, expiry, reminder_sent, expired_sent in rows:
+                    if self._expiries.get(user_id) != expiry:
+                        self._schedule(user_id, expiry, bool(reminder_sent), bool(expired_sent))
+                loaded += len(rows)
+                if len(rows) < LOAD_BATCH:
+                    break
+                after = (rows[-1][1], rows[-1][0])
+        finally:
+            self._loading = False
+            pending, self._pending = self._pending, {}
+
+        # При ошибке БД граница не сдвигается: следующая загрузка дочитает окно с того же места.
+        if complete:
+            self._loaded_until = until
+        for user_id, expiry in pending.items():
+            self._apply_change(user_id, expiry)
+        if loaded:
+            log.debug("Загружены даты окончания подписок", users=loaded, until=until, timers=len(self._heap))
+
+        if time.monotonic() - self._pruned_at >= PRUNE_INTERVAL:
+            self._pruned_at = time.monotonic()
+            before_ts = int(time.time() - self.reminder_before - self.grace - PRUNE_INTERVAL)
+            deleted = await prune_subscription_notices_async(before_ts)
+            if deleted:
+                log.info("Удалены старые отметки об уведомлениях", count=deleted)
+
+    async def _notice_text(self, user_id: int, kind: str, expiry: str) -> str:
+        paid = await has_successful_payment_async(user_id)
+        if kind == EXPIRED:
+            if paid:
+                return "Твоя подписка закончилась. Продли её, чтобы продолжить общение."
+            return "Пробный период закончился. Оформи подписку, чтобы продолжить общение."
+        expires = datetime.fromisoformat(expiry)
+        if paid:
+            return (f"⏳ Твоя подписка закончится {expires:%d.%m.%Y в %H:%M}. "
+                    f"Продли её заранее, чтобы общение не прерывалось.")
+        return (f"⏳ Пробный период закончится {expires:%d.%m.%Y в %H:%M}. "
+                f"Оформи подписку, чтобы продолжить общение без перерыва.")
+
+    async def _deliver(self, user_id: int, kind: str, expiry: str) -> str:
+        text = await self._notice_text(user_id, kind, expiry)
+        while True:
+            await bulk_sends.acquire(self._bucket)
+            try:
+                await self.bot.send_message(user_id, text, reply_markup=get_pay_inline_keyboard())
+                outcome = "sent"
+            except TelegramRetryAfter as e:
+                # Лимит Telegram общий для бота: приостанавливаем все массовые отправки
+                # и продолжаем с этого же сообщения.
+                log.warning("Telegram ограничил отправку уведомлений", retry_after=e.retry_after)
+                bulk_sends.pause(e.retry_after)
+                continue
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                # Пользователь заблокировал бота или чат недоступен - повторять бессмысленно.
+                log.info("Уведомление о подписке не доставлено", user_id=user_id, kind=kind, error=e)
+                outcome = "undeliverable"
+            except TelegramAPIError as e:
+                log.warning("Ошибка при отправке уведомления о подписке", user_id=user_id, kind=kind, error=e)
+                outcome = "retry"
+            SUBSCRIPTION_NOTICES.inc(kind, outcome)
+            return outcome
+
+    async def _send_batch(self, batch: list[tuple[int, str, str]]):
+        current = await get_subscription_expiries_async([user_id for user_id, _, _ in batch])
+        if current is None:
+            for user_id, kind, expiry in batch:
+                self._push(time.time() + RETRY_DELAY, user_id, kind, expiry)
+            return
+
+        delivered = []
+        for user_id, kind, expiry in batch:
+            actual = current.get(user_id)
+            if actual != expiry:
+                # Подписку продлили в другом процессе (или пользователя нет): переставляем таймеры.
+                if actual:
+                    self._apply_change(user_id, actual)
+                elif self._expiries.get(user_id) == expiry:
+                    del self._expiries[user_id]
+                continue
+            if kind == REMINDER and datetime.fromisoformat(expiry).timestamp() <= time.time():
+                # Напоминание опоздало (например, из-за лимита отправки) - достаточно уведомления об окончании.
+                continue
+            try:
+                outcome = await self._deliver(user_id, kind, expiry)
+            except Exception:
+                # Ошибка одного уведомления не должна терять остальные таймеры пачки.
+                log.exception("Ошибка при подготовке уведомления о подписке", user_id=user_id, kind=kind)
+                outcome = "retry"
+            if outcome == "retry":
+                self._push(time.time() + RETRY_DELAY, user_id, kind, expiry)
+                continue
+            delivered.append((user_id, kind, expiry))
+            if kind == EXPIRED and self._expiries.get(user_id) == expiry:
+                del self._expiries[user_id]
+
+        if delivered:
+            await record_subscription_notices_async(delivered)
+
+    async def _send_due(self):
+        while self._heap and self._heap[0][0] <= time.time():
+            batch = []
+            while self._heap and self._heap[0][0] <= time.time() and len(batch) < SEND_BATCH:
+                _, _, user_id, kind, expiry = heapq.heappop(self._heap)
+                # Таймеры, поставленные под прежнюю дату окончания, просто отбрасываются.
+                if self._expiries.get(user_id) == expiry:
+                    batch.append((user_id, kind, expiry))
+            if batch:
+                await self._send_batch(batch)
+
+    async def run(self):
+        next_load = 0.0
+        while True:
+            try:
+                if time.monotonic() >= next_load:
+                    await self._load()
+                    next_load = time.monotonic() + LOAD_INTERVAL
+                await self._send_due()
+            except Exception:
+                # Непредвиденная ошибка не должна останавливать напоминания до перезапуска бота.
+                log.exception("Ошибка в планировщике напоминаний о подписке", retry_in=RETRY_DELAY)
+                await asyncio.sleep(RETRY_DELAY)
+                continue
+
+            self._wakeup.clear()
+            timeout = next_load - time.monotonic()
+            if self._heap:
+                timeout = min(timeout, self._heap[0][0] - time.time())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(timeout, 0))
+            except asyncio.TimeoutError:
+                pass
+
+
+async def run_expiry_reminders(bot: Bot):
+    """
+    Фоновая задача: напоминания об окончании подписки, пока задачу не отменят.
+    """
+    if not SUBSCRIPTION_NOTICES_ENABLED:
+        return
+    scheduler = ExpiryReminderScheduler(bot,
+                                        reminder_before=SUBSCRIPTION_REMINDER_HOURS * 3600,
+                                        grace=SUBSCRIPTION_NOTICE_GRACE_HOURS * 3600,
+                                        rate=SUBSCRIPTION_NOTICE_RATE)
+    add_subscription_listener(scheduler.on_subscription_changed)
+    try:
+        await scheduler.run()
+    finally:
+        remove_subscription_listener(scheduler.on_subscription_changed)
@@ -0,0 +1,57 @@
+import asyncio
+import time
+import unittest
+
+from ai_fallback import CircuitBreaker, ModelPool, hedged_call
+
+
+def _open_breaker(pool: ModelPool, model: str):
+    # Выключает модель и делает вид, что время до пробной попытки уже вышло.
+    breaker = pool.breakers[model]
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+    breaker.opened_at = time.monotonic() - breaker.reset_timeout
+
+
+class HedgedCallBreakerTest(unittest.IsolatedAsyncioTestCase):
+    async def test_unlaunched_model_stays_available_after_reset(self):
+        pool = ModelPool(["primary", "fallback"], failure_threshold=1, reset_timeout=30)
+        _open_breaker(pool, "fallback")
+        launched = []
+
+        async def attempt(model: str):
+            launched.append(model)
+            return "ok"
+
+        # Основная модель отвечает раньше AI_HEDGE_DELAY - резервная так и не запускается.
+        for _ in range(3):
+            self.assertEqual(await hedged_call(pool, attempt, hedge_delay=1.0), ("primary", "ok"))
+
+        self.assertEqual(launched, ["primary"] * 3)
+        self.assertEqual(pool.breakers["fallback"].state, CircuitBreaker.OPEN)
+        self.assertEqual(pool.candidates(), ["primary", "fallback"])
+
+    async def test_probe_starts_only_when_launched(self):
+        pool = ModelPool(["primary", "fallback"], failure_threshold=1, reset_timeout=30)
+        _open_breaker(pool, "fallback")
+
+        async def attempt(model: str):
+            if model == "primary":
+                await asyncio.sleep(1)
+            return model
+
+        self.assertEqual(await hedged_call(pool, attempt, hedge_delay=0.01), ("fallback", "fallback"))
+        self.assertEqual(pool.breakers["fallback"].state, CircuitBreaker.CLOSED)
+        self.assertEqual(pool.hedges_started, 1)
+
+    async def test_probe_in_progress_is_not_started_twice(self):
+        pool = ModelPool(["primary", "fallback"], failure_threshold=1, reset_timeout=30)
+        _open_breaker(pool, "fallback")
+        self.assertTrue(pool.breakers["fallback"].allow())
+        self.assertEqual(pool.breakers["fallback"].state, CircuitBreaker.HALF_OPEN)
+        self.assertEqual(pool.candidates(), ["primary"])
+        self.assertFalse(pool.breakers["fallback"].allow())
+
+
+if __name__ == "__main__":
+    unittest.main()
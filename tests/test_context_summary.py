@@ -0,0 +1,73 @@
+import unittest
+from unittest import mock
+
+import ai_service
+
+
+class FakeDialogue:
+    """
+    Диалог одного пользователя в памяти с той же семантикой, что у функций db, которые
+    использует обновление сводки.
+    """
+
+    def __init__(self):
+        self.ids: list[int] = []
+        self.summary: tuple[str, int] | None = None
+        self.fail_summaries = 0
+
+    async def get_dialogue_summary(self, user_id):
+        return self.summary
+
+    async def get_unsummarized_dialogue(self, user_id, after_id, keep_recent, limit):
+        if len(self.ids) < keep_recent:
+            return []
+        boundary = self.ids[-keep_recent]
+        return [(i, f"реплика {i}", "user") for i in self.ids if after_id < i < boundary][:limit]
+
+    async def save_dialogue_summary(self, user_id, summary, upto_id):
+        self.summary = (summary, upto_id)
+
+    async def summarize(self, previous_summary, rows):
+        if self.fail_summaries:
+            self.fail_summaries -= 1
+            return None
+        return f"сводка до {rows[-1][0]}"
+
+    def lost_turns(self) -> list[int]:
+        # Реплики, которых нет ни в окне дословной истории, ни в сводке.
+        summarized_upto = self.summary[1] if self.summary else 0
+        window = set(self.ids[-ai_service.AI_CONTEXT_MAX_TURNS:])
+        return [i for i in self.ids if i > summarized_upto and i not in window]
+
+
+class SummaryCoverageTest(unittest.IsolatedAsyncioTestCase):
+    def patch_db(self, dialogue: FakeDialogue):
+        for name, fake in (("get_dialogue_summary_async", dialogue.get_dialogue_summary),
+                           ("get_unsummarized_dialogue_async", dialogue.get_unsummarized_dialogue),
+                           ("save_dialogue_summary_async", dialogue.save_dialogue_summary),
+                           ("_summarize", dialogue.summarize)):
+            patcher = mock.patch.object(ai_service, name, fake)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_no_turn_falls_between_window_and_summary(self):
+        dialogue = FakeDialogue()
+        self.patch_db(dialogue)
+        for turn_id in range(1, 301):
+            dialogue.ids.append(turn_id)
+            # Сводка обновляется после каждого ответа бота.
+            await ai_service._refresh_summary(1)
+            self.assertEqual(dialogue.lost_turns(), [], f"после реплики {turn_id}")
+
+    async def test_failed_refreshes_are_caught_up(self):
+        dialogue = FakeDialogue()
+        self.patch_db(dialogue)
+        dialogue.fail_summaries = 5
+        for turn_id in range(1, 101):
+            dialogue.ids.append(turn_id)
+            await ai_service._refresh_summary(1)
+        self.assertEqual(dialogue.lost_turns(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()